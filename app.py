@@ -1,446 +1,445 @@
-import math
-from flask import Flask, render_template, jsonify, request, redirect, url_for, send_file, send_from_directory
-from io import BytesIO
-import requests
+"""
+Eventlet entry point: Flask-SocketIO attached to web.py's Flask app, with this
+worker's scheduler and socket registry. The event handlers do the Socket.IO
+I/O around lobby_core's functions; asgi_app.py is the asyncio equivalent.
+
+    gunicorn --config gunicorn_config.py app:app
+"""
+from flask import request
 from flask_socketio import SocketIO, join_room, leave_room
-import random
-import string
-import json
-import os
-from datetime import datetime
-from dotenv import load_dotenv
-from places_api import get_city_data
-import threading
-from genai_module import get_suggestions
-
-load_dotenv()
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-very-secret-key')
-socketio = SocketIO(app)
-
-# Serve font files located in the top-level 'fonts' directory (outside the default 'static').
-# This lets CSS reference /fonts/Pentagra.woff2 etc.
-@app.route('/fonts/<path:filename>')
-def serve_font(filename):
-    return send_from_directory('fonts', filename)
-
-# Serve images from top-level 'img' directory (outside default 'static')
-@app.route('/img/<path:filename>')
-def serve_image(filename):
-    return send_from_directory('img', filename)
-
-# In-memory storage for lobbies
-LOBBIES = {}
-ARCHIVE_DIR = "archived_lobbies"
-ARCHIVE_TIMERS = {}  # Track pending archive timers
-ARCHIVE_DELAY = 20  # seconds to wait before archiving inactive lobbies
-ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_API_KEY', '')
-os.makedirs(ARCHIVE_DIR, exist_ok=True)
-
-def generate_lobby_code(length=8):
-    """Generate a unique, random, all-caps alphanumeric code."""
-    while True:
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
-        if code not in LOBBIES:
-            return code
-
-@app.route('/')
-def index():
-    """Serves the entry page."""
-    return render_template('index.html')
-
-@app.route('/lobby')
-def lobby():
-    return render_template('lobby.html')
-
-@app.route('/about')
-def about():
-    return render_template('about.html')
-
-@app.route('/planet/<lobby_code>')
-def planet(lobby_code):
-    """Serves the planet/lobby page."""
-    if lobby_code not in LOBBIES:
-        # Redirect to home page if lobby doesn't exist
-        return redirect(url_for('entry'))
-    return render_template('planet.html', lobby_code=lobby_code)
-
-@app.route('/create_lobby', methods=['POST'])
-def create_lobby():
-    """Creates a new lobby and returns the code."""
-    lobby_code = generate_lobby_code()
-    LOBBIES[lobby_code] = {
-        'participants': {},
-        'points': {},
-        'left_participants': {}
-    }
-    print(f"Lobby created: {lobby_code}. Current lobbies: {list(LOBBIES.keys())}")
-    return jsonify({'code': lobby_code})
+import logging
+import time
+import uuid
+from places_api import iter_city_data, category_page, CATEGORY_CATALOG, PLACES_CATEGORIES
+from genai_module import get_suggestions, stream_suggestions, StreamInterrupted
+from lobby_store import lobby_transaction
+from scheduler import DeadlineScheduler
+from connections import ConnectionRegistry
+from lobby_core import (
+    AI_STREAMING, ARCHIVE_DELAY, CLEANUP_INTERVAL, HEARTBEAT_INTERVAL, LOBBIES, PLACES_DEBOUNCE,
+    PLACES_FETCHES, RECONNECT_GRACE, SOCKETIO_MESSAGE_QUEUE, SOCKETIO_PING_INTERVAL, SOCKETIO_PING_TIMEOUT,
+    TOWN_DEBOUNCE, accept_more_places, accept_places_page, add_preferences_prompt, ai_stream_chunk,
+    ai_stream_start, archive_after_delay, awaits_town, cached_lobby_codes, drop_lobby_caches,
+    event_participant, evict_disconnected, expire_archives, find_closest_town_remote, get_derived_state,
+    heartbeat_lobby, is_current_places_fetch, join_participant, lobby_emptied, lobby_snapshot,
+    mark_disconnected, more_places_request, needs_heartbeat, next_patch, parse_chat_message,
+    parse_history_request, parse_midpoint_mode, parse_weight, places_category_payload, places_fetch_args,
+    post_ai_message, post_chat_message, queue_places_fetch, read_history, rehydrate_lobby,
+    remember_derived_state, remove_participant, set_midpoint_mode, set_point, set_weight, travel_info,
+)
+from metrics import SCHEDULER_PENDING, observe_event
+from socket_codec import PACKET_CLASS
+from web import app
+
+log = logging.getLogger(__name__)
+
+# SOCKETIO_SERIALIZER picks the packet encoding (see socket_codec); every packet class
+# records the size of each outgoing event as the server encodes it
+socketio = SocketIO(app, message_queue=SOCKETIO_MESSAGE_QUEUE, serializer=PACKET_CLASS,
+                    ping_interval=SOCKETIO_PING_INTERVAL, ping_timeout=SOCKETIO_PING_TIMEOUT)
+
+# One background task runs every archive, places-debounce, eviction, heartbeat and cleanup deadline
+SCHEDULER = DeadlineScheduler(socketio.start_background_task, socketio.server.eio.create_event)
+# This worker's sockets and the participants they joined as
+CONNECTIONS = ConnectionRegistry()
+
 
 @socketio.on('join_lobby')
+@observe_event('join_lobby')
 def on_join(data):
     """Handles a user joining a lobby."""
-    lobby_code = data.get('code')
-    user_id = data.get('userId')
-
-    if not lobby_code or not user_id:
-        print("Join failed: Missing lobby_code or userId")
-        return
-
-    if lobby_code not in LOBBIES:
-        print(f"Join failed: Lobby {lobby_code} not found.")
-        # Optionally, emit an error back to the client
+    target = event_participant(data, 'Join')
+    if target is None:
         return
-
-    join_room(lobby_code)
-    # Store the session ID to identify the user upon disconnect
-    LOBBIES[lobby_code]['participants'][user_id] = {'id': user_id, 'sid': request.sid}
-
-    print(f"User {user_id} joined lobby {lobby_code}")
-
-    # Cancel any pending archive
-    cancel_lobby_archive(lobby_code)
-    # Notify everyone in the lobby about the current state
-    emit_lobby_update(lobby_code)
+    lobby_code, user_id = target
+
+    rehydrate_lobby(lobby_code)
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            log.info("Join failed: lobby not found", extra={'lobby': lobby_code})
+            # Optionally, emit an error back to the client
+            return
+
+        join_room(lobby_code)
+        CONNECTIONS.bind(request.sid, lobby_code, user_id)
+        ops = join_participant(lobby_code, lobby, user_id, request.sid)
+
+        # Cancel any pending archive, and the eviction of a user coming back within the grace window
+        cancel_lobby_archive(lobby_code)
+        SCHEDULER.cancel(('evict', lobby_code, user_id))
+        if 'cleanup' not in SCHEDULER:
+            SCHEDULER.schedule('cleanup', CLEANUP_INTERVAL, cleanup_lobby_caches)
+        if 'heartbeat' not in SCHEDULER:
+            SCHEDULER.schedule('heartbeat', HEARTBEAT_INTERVAL, heartbeat_participants)
+        # Tell the others about a newcomer, then give the (re)joining user the full state
+        if ops:
+            emit_lobby_update(lobby_code, ops, skip_sid=request.sid, lobby=lobby)
+        emit_lobby_snapshot(lobby_code, request.sid, lobby=lobby)
+        info = travel_info(lobby)
+
+    # Points didn't change, so no new places fetch will run; hand the newcomer the cached details
+    if info['midpoint_details']:
+        socketio.emit('travel_info_update', info, to=request.sid)
 
 @socketio.on('leave_lobby')
+@observe_event('leave_lobby')
 def on_leave(data):
     """Handles a user voluntarily leaving a lobby."""
-    lobby_code = data.get('code')
-    user_id = data.get('userId')
-
-    if not lobby_code or not user_id:
-        print("Leave failed: Missing lobby_code or userId")
+    target = event_participant(data, 'Leave')
+    if target is None:
         return
-
-    if lobby_code not in LOBBIES:
-        print(f"Leave failed: Lobby {lobby_code} not found.")
+    lobby_code, user_id = target
+
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            log.info("Leave failed: lobby not found", extra={'lobby': lobby_code})
+            return
+
+        ops = remove_participant(lobby_code, lobby, user_id)
+        leave_room(lobby_code)
+        CONNECTIONS.release(request.sid, lobby_code, user_id)
+        SCHEDULER.cancel(('evict', lobby_code, user_id))
+        finish_removal(lobby_code, lobby, ops)
+
+
+@socketio.on('disconnect')
+@observe_event('disconnect')
+def on_disconnect(reason=None):
+    """Starts the reconnect grace window for the participant whose socket closed."""
+    entry = CONNECTIONS.unbind(request.sid)
+    if entry is None:
+        # Never joined, left already, or replaced by a newer socket of the same user
         return
+    lobby_code, user_id = entry
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None or not mark_disconnected(lobby, user_id, request.sid):
+            return
+    log.info("User disconnected", extra={'lobby': lobby_code, 'user': user_id, 'reason': reason})
+    SCHEDULER.schedule(('evict', lobby_code, user_id), RECONNECT_GRACE, evict_participant, lobby_code, user_id)
 
-    lobby = LOBBIES[lobby_code]
 
-    # Remove user completely
-    if user_id in lobby['participants']:
-        lobby['left_participants'][user_id] = lobby['participants'][user_id]
-        print(lobby['left_participants'])
-        del lobby['participants'][user_id]
-        print(f"User {user_id} removed from lobby {lobby_code}.")
-    if user_id in lobby['points']:
-        del lobby['points'][user_id]
-        print(f"User {user_id}'s point removed from lobby {lobby_code}.")
+def evict_participant(lobby_code, user_id):
+    """Removes a disconnected participant whose grace window ran out."""
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            return
+        ops = evict_disconnected(lobby_code, lobby, user_id)
+        if ops:
+            finish_removal(lobby_code, lobby, ops)
 
-    leave_room(lobby_code)
 
-    # If no one remains, schedule auto-archive
-    if len(lobby['participants']) == 0:
-        print(f"Lobby {lobby_code} is empty — scheduling archive in {ARCHIVE_DELAY} seconds.")
+def heartbeat_participants():
+    """
+    Stamps the participants connected to this worker as seen and evicts those
+    no worker has stamped for STALE_PARTICIPANT_AFTER. Re-arms itself.
+    """
+    now = time.time()
+    for lobby_code in LOBBIES.codes():
+        users = CONNECTIONS.lobby_users(lobby_code)
+        # Only lobbies with something to stamp or evict are written back
+        if not needs_heartbeat(LOBBIES.get(lobby_code), users, now):
+            continue
+        with lobby_transaction(LOBBIES, lobby_code) as lobby:
+            if lobby is None:
+                continue
+            ops = heartbeat_lobby(lobby_code, lobby, users, now)
+            if ops:
+                finish_removal(lobby_code, lobby, ops)
+    SCHEDULER.schedule('heartbeat', HEARTBEAT_INTERVAL, heartbeat_participants)
+
+
+def finish_removal(lobby_code, lobby, ops):
+    """Tells the room who was removed and schedules the archive once nobody is left."""
+    if lobby_emptied(lobby_code, lobby):
         schedule_lobby_archive(lobby_code)
+    if ops:
+        emit_lobby_update(lobby_code, ops, lobby=lobby)
 
-    emit_lobby_update(lobby_code)
+
+@socketio.on('lobby_resync')
+@observe_event('lobby_resync')
+def on_resync(data):
+    """Sends a full snapshot to a client that missed a patch."""
+    lobby_code = data.get('code')
+    emit_lobby_snapshot(lobby_code, request.sid)
 
 
 @socketio.on('add_point')
+@observe_event('add_point')
 def on_add_point(data):
     """Handles a user adding or updating a point."""
     lobby_code = data.get('code')
-    user_id = data.get('userId')
-    point = data.get('point')
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        ops = set_point(lobby_code, lobby, data.get('userId'), data.get('point')) if lobby is not None else []
+        if ops:
+            emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+@socketio.on('set_midpoint_mode')
+@observe_event('set_midpoint_mode')
+def on_set_midpoint_mode(data):
+    """Switches how the lobby's meeting point is computed."""
+    lobby_code = data.get('code')
+    mode = parse_midpoint_mode(lobby_code, data)
+    if mode is None:
+        return
+
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        ops = set_midpoint_mode(lobby, mode) if lobby is not None else []
+        if ops:
+            emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+@socketio.on('set_weight')
+@observe_event('set_weight')
+def on_set_weight(data):
+    """Sets how much a participant's travel distance counts towards the meeting point."""
+    lobby_code = data.get('code')
+    weight = parse_weight(data)
+    if weight is None:
+        return
+
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        ops = set_weight(lobby, data.get('userId'), weight) if lobby is not None else []
+        if ops:
+            emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+def schedule_places_fetch(lobby_code, city_name, midpoint, reachable_midpoint, version=None, participants=None):
+    """
+    Coalesces bursts of point changes into a single places fetch per lobby.
+    Each call supersedes the previous one; the fetch only starts once no new
+    call has arrived for PLACES_DEBOUNCE seconds.
+    """
+    queue_places_fetch(lobby_code, city_name, midpoint, reachable_midpoint, version, participants)
+    SCHEDULER.schedule(('places', lobby_code), PLACES_DEBOUNCE, start_places_fetch, lobby_code)
+
+
+def start_places_fetch(lobby_code):
+    """Runs when the quiet window has passed: fetches places for the latest point set."""
+    fetch = PLACES_FETCHES.get(lobby_code)
+    if fetch is None:
+        return
+    socketio.start_background_task(
+        get_places_data_async, lobby_code, *fetch['args'], generation=fetch['generation']
+    )
 
-    if lobby_code in LOBBIES and user_id in LOBBIES[lobby_code]['participants']:
-        LOBBIES[lobby_code]['points'][user_id] = point
-        print(f"Point added in lobby {lobby_code} by {user_id}: {point}")
-        emit_lobby_update(lobby_code)
+
+def emit_places_category(lobby_code, lobby, category, places, append=False, complete=False):
+    """Sends one category's results (a full first page, or a further page to append) to the room."""
+    socketio.emit('travel_info_category', places_category_payload(lobby_code, lobby, category, places, append, complete), room=lobby_code)
+
+
+def get_places_data_async(lobby_code, city_name, midpoint, reachable_midpoint, version=None, participants=None, generation=None):
+    """
+    Background task to fetch travel info. Each category is stored and sent to
+    the room as soon as its search returns, so the first results show up after
+    the fastest query rather than the slowest.
+    """
+    fetch_id = uuid.uuid4().hex
+    search = {'city': city_name, 'midpoint': midpoint, 'reachable_midpoint': reachable_midpoint, 'participants': participants}
+    remaining = len(PLACES_CATEGORIES)
+    with app.app_context():
+        for category, places, next_page_token in iter_city_data(city_name, midpoint, reachable_midpoint, participants):
+            remaining -= 1
+            if not is_current_places_fetch(lobby_code, generation):
+                return
+            log.debug("Places fetched for %s: %s", city_name, category, extra={'lobby': lobby_code, 'count': len(places)})
+
+            with lobby_transaction(LOBBIES, lobby_code) as lobby:
+                if not accept_places_page(lobby_code, lobby, fetch_id, search, category, places, next_page_token, version, not remaining):
+                    return
+                emit_places_category(lobby_code, lobby, category, places, complete=not remaining)
+                if remaining:
+                    continue
+
+                # After sending places, send a prompt from the AI
+                prompt = add_preferences_prompt(lobby_code, lobby)
+                if prompt is not None:
+                    emit_lobby_update(lobby_code, [{'op': 'message_appended', 'message': prompt}], animation=False, lobby=lobby)
+
+
+@socketio.on('load_more_places')
+@observe_event('load_more_places')
+def on_load_more_places(data):
+    """Fetches the next page of one category, using the page token from the last search."""
+    lobby_code = data.get('code')
+    category = data.get('category')
+    if category not in CATEGORY_CATALOG:
+        return
+    request_args = more_places_request(LOBBIES.get(lobby_code), category)
+    if request_args is not None:
+        socketio.start_background_task(load_more_places_async, lobby_code, category, *request_args)
 
 
-def get_places_data_async(lobby_code, city_name, midpoint, reachable_midpoint):
-    """Background task to fetch travel info and emit an update."""
+def load_more_places_async(lobby_code, category, page_token, search, fetch_id):
+    """Background task appending the next page of a category and sending it to the room."""
     with app.app_context():
-        data = get_city_data(city_name, midpoint, reachable_midpoint)
-        if data:
-            print(f"Data for {city_name}: {data}")
-            # get_city_data returns a JSON string, so we parse it.
-            parsed_data = json.loads(data)
-            
-            # Store the data on the server-side lobby object
-            if lobby_code in LOBBIES:
-                LOBBIES[lobby_code]['midpoint_details'] = parsed_data
-
-            socketio.emit('travel_info_update', {'midpoint_details': parsed_data}, room=lobby_code)
-            print(f"Sent travel info update for lobby {lobby_code}")
-
-            # After sending places, send a prompt from the AI
-            if lobby_code in LOBBIES:
-                initial_ai_message = {
-                    'name': 'AI Assistant',
-                    'text': "A long list of fun attractions! Let me know your preferences, and I can suggest the best spots for your group."
-                }
-                if 'messages' not in LOBBIES[lobby_code]:
-                    LOBBIES[lobby_code]['messages'] = []
-                
-                # Avoid sending duplicate messages
-                if not any(msg['name'] == 'AI Assistant' and "preferences" in msg['text'] for msg in LOBBIES[lobby_code]['messages']):
-                    LOBBIES[lobby_code]['messages'].append(initial_ai_message)
-                    emit_lobby_update(lobby_code, animation=False)
+        try:
+            places, next_page_token = category_page(
+                search['city'], category, search['midpoint'], search['reachable_midpoint'],
+                search['participants'], page_token=page_token,
+            )
+        except Exception as e:
+            log.warning("Loading more %s failed: %s", category, e, extra={'lobby': lobby_code})
+            return
+
+        with lobby_transaction(LOBBIES, lobby_code) as lobby:
+            if accept_more_places(lobby, category, page_token, fetch_id, places, next_page_token):
+                emit_places_category(lobby_code, lobby, category, places, append=True, complete=True)
 
 
 def schedule_lobby_archive(lobby_code):
     """Schedules a lobby for automatic archiving after a delay."""
-    if lobby_code in ARCHIVE_TIMERS:
+    if ('archive', lobby_code) in SCHEDULER:
         # Already scheduled
         return
-
-    def archive_after_delay():
-        if lobby_code in LOBBIES:
-            all_disconnected = all(u.get('sid') is None for u in LOBBIES[lobby_code]['participants'].values())
-            if all_disconnected:
-                save_lobby_to_file(lobby_code)
-        ARCHIVE_TIMERS.pop(lobby_code, None)
-
-    timer = threading.Timer(ARCHIVE_DELAY, archive_after_delay)
-    ARCHIVE_TIMERS[lobby_code] = timer
-    timer.start()
+    SCHEDULER.schedule(('archive', lobby_code), ARCHIVE_DELAY, archive_after_delay, lobby_code)
 
 
 def cancel_lobby_archive(lobby_code):
     """Cancels a pending archive if someone rejoins."""
-    if lobby_code in ARCHIVE_TIMERS:
-        timer = ARCHIVE_TIMERS.pop(lobby_code)
-        timer.cancel()
-        print(f"Archive canceled for lobby {lobby_code} (participant rejoined).")
-
-def emit_lobby_update(lobby_code, animation=True):
-    """Calculates midpoint and broadcasts the lobby state."""
-    if lobby_code not in LOBBIES:
+    if SCHEDULER.cancel(('archive', lobby_code)):
+        log.info("Archive cancelled: participant rejoined", extra={'lobby': lobby_code})
+
+
+def cleanup_lobby_caches():
+    """Drops per-process caches for lobbies that are no longer active and expires old archives, then re-arms itself."""
+    for lobby_code in cached_lobby_codes():
+        if lobby_code not in LOBBIES:
+            drop_lobby_caches(lobby_code, SCHEDULER)
+    expire_archives()
+    SCHEDULER.schedule('cleanup', CLEANUP_INTERVAL, cleanup_lobby_caches)
+
+
+def emit_lobby_snapshot(lobby_code, sid, lobby=None):
+    """Sends the full lobby state to a single client."""
+    lobby = lobby or LOBBIES.get(lobby_code)
+    if lobby is None:
         return
+    derived, _ = get_derived_state(lobby_code, lobby)
+    socketio.emit('lobby_update', lobby_snapshot(lobby_code, lobby, derived=derived), to=sid)
+    log.debug("Sent snapshot", extra={'lobby': lobby_code, 'sid': sid})
+    if derived.get('town_pending'):
+        schedule_town_lookup(lobby_code, derived)
 
-    lobby = LOBBIES[lobby_code]
-    points = list(lobby['points'].values())
-    
-    geometric_midpoint, reachable_midpoint = None, None
-
-    if len(points) >= 2:
-        geometric_midpoint = calculate_midpoint(points)
-        reachable_midpoint = find_closest_town(geometric_midpoint)
-
-    # Send initial payload without blocking
-    payload = {
-        'code': lobby_code,
-        'participants': list(lobby['participants'].keys()),
-        'points': lobby['points'],
-        'geometric_midpoint': geometric_midpoint,
-        'reachable_midpoint': reachable_midpoint,
-        'midpoint_details': {},  # Initially empty
-        'messages': lobby.get('messages', []),
-        'animation': animation
-    }
-    socketio.emit('lobby_update', payload, room=lobby_code)
-    print(f"Sent initial update for lobby {lobby_code}")
-
-    # If a midpoint is found, start the background task for the heavy lifting
-    if reachable_midpoint and geometric_midpoint:
-        socketio.start_background_task(
-            get_places_data_async, lobby_code, reachable_midpoint['name'], geometric_midpoint, reachable_midpoint
-        )
-
-import requests
-
-def find_closest_town(midpoint):
-    lat = midpoint['lat']
-    lon = midpoint['lon']
-
-    url = "http://getnearbycities.geobytes.com/GetNearbyCities"
-    params = {
-        'latitude': lat,
-        'longitude': lon,
-        'radius': 100000,         
-        'limit': 1            
-    }
 
-    try:
-        resp = requests.get(url, params=params, timeout=5)
-        resp.raise_for_status()
-        data = resp.json()
-        if not data:
-            return None
-
-        # Data is an array of arrays; pick first
-        first = data[0]
-        # According to spec:
-        # [0] = bearing
-        # [1] = city name
-        # [2] = region/state code
-        # [3] = country name
-        # [4] = direction
-        # [5] = nautical miles
-        # [6] = internet country code
-        # [7] = kilometres
-        # [8] = latitude
-        # [9] = geobytes location code
-        # [10] = longitude
-        # [11] = miles
-        # [12] = region or state name
-        city_name = first[1]
-        country = first[3]
-        lat2 = first[8]
-        lon2 = first[10]
-        return {
-            'lat': lat2,
-            'lon': lon2,
-            'name': f"{city_name}, {country}"
-        }
-
-    except Exception as e:
-        print(f"Geobytes lookup failed at {lat},{lon}: {e}")
-        return None
-
-def calculate_midpoint(points):
+def emit_lobby_update(lobby_code, ops, animation=True, skip_sid=None, lobby=None):
     """
-    Calculates the geographic midpoint (centroid) of a list of points.
-    Points are dictionaries with 'lat' and 'lon'.
+    Broadcasts a sequence-numbered patch describing what changed in the lobby.
+    A midpoint_changed op is added, and places are refreshed, only if the points changed.
+    Clients that see a gap in the sequence ask for a snapshot with lobby_resync.
+    Pass the lobby when already inside its lobby_transaction; the caller then saves the new seq.
     """
+    if lobby is None:
+        with lobby_transaction(LOBBIES, lobby_code) as lobby:
+            if lobby is not None:
+                emit_lobby_update(lobby_code, ops, animation, skip_sid, lobby=lobby)
+        return
 
-    from math import radians, degrees, sin, cos, atan2, sqrt
-    
-    x, y, z = 0.0, 0.0, 0.0
-    
-    for p in points:
-        lat = radians(p['lat'])
-        lon = radians(p['lon'])
-        x += cos(lat) * cos(lon)
-        y += cos(lat) * sin(lon)
-        z += sin(lat)
-        
-    num_points = len(points)
-    x /= num_points
-    y /= num_points
-    z /= num_points
-    
-    lon = atan2(y, x)
-    hyp = sqrt(x * x + y * y)
-    lat = atan2(z, hyp)
-    
-    return {'lat': degrees(lat), 'lon': degrees(lon)}
-
-
-def save_lobby_to_file(lobby_code):
-    """Saves a lobby's state to a JSON file and removes it from memory."""
-    if lobby_code not in LOBBIES:
-        print(f"Cannot save: Lobby {lobby_code} not found.")
-        return False
-
-    lobby_data = LOBBIES[lobby_code]
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{ARCHIVE_DIR}/{lobby_code}_{timestamp}.json"
+    derived, points_changed = get_derived_state(lobby_code, lobby)
+    send_lobby_patch(lobby_code, lobby, ops, derived, points_changed, animation, skip_sid)
+
+
+def send_lobby_patch(lobby_code, lobby, ops, derived, points_changed, animation=True, skip_sid=None):
+    """Broadcasts the next patch, then starts whatever new midpoints need: a places fetch or a town lookup."""
+    patch = next_patch(lobby_code, lobby, ops, derived, points_changed, animation)
+    # One emit per room: the packet is encoded once and reused for every recipient
+    socketio.emit('lobby_patch', patch, room=lobby_code, skip_sid=skip_sid)
+    log.debug("Sent patch %d", patch['seq'], extra={'lobby': lobby_code})
+
+    # If the points moved to a new midpoint, schedule the heavy lifting once they settle
+    fetch_args = places_fetch_args(lobby, derived) if points_changed else None
+    if fetch_args is not None:
+        schedule_places_fetch(lobby_code, *fetch_args)
+    elif derived.get('town_pending'):
+        schedule_town_lookup(lobby_code, derived)
+
+
+def schedule_town_lookup(lobby_code, derived):
+    """Looks up the town for a pending midpoint once the points stay put for TOWN_DEBOUNCE seconds."""
+    SCHEDULER.schedule(('town', lobby_code), TOWN_DEBOUNCE, resolve_town, lobby_code, derived)
+
+
+def resolve_town(lobby_code, derived):
+    """Asks Geobytes for a pending midpoint's town outside the lobby lock, then sends the midpoint."""
+    lobby = LOBBIES.get(lobby_code)
+    if lobby is None or not awaits_town(lobby_code, lobby, derived):
+        return
+    town = find_closest_town_remote(derived['geometric_midpoint'])
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is not None and awaits_town(lobby_code, lobby, derived):
+            derived = remember_derived_state(lobby_code, derived['version'], derived['geometric_midpoint'], town)
+            send_lobby_patch(lobby_code, lobby, [], derived, True)
 
-    try:
-        with open(filename, "w") as f:
-            json.dump(lobby_data, f, indent=2)
-        print(f"Lobby {lobby_code} archived as {filename}")
-        del LOBBIES[lobby_code]  # remove from active memory
-        return True
-    except Exception as e:
-        print(f"Error saving lobby {lobby_code}: {e}")
-        return False
-
-
-def load_archived_lobby(lobby_code):
-    """Loads an archived lobby from a JSON file into active memory."""
-    # find the most recent archive for this code
-    files = [f for f in os.listdir(ARCHIVE_DIR) if f.startswith(lobby_code)]
-    if not files:
-        print(f"No archived sessions found for lobby {lobby_code}")
-        return False
-
-    latest_file = max(files, key=lambda f: os.path.getmtime(os.path.join(ARCHIVE_DIR, f)))
-    filepath = os.path.join(ARCHIVE_DIR, latest_file)
 
-    try:
-        with open(filepath, "r") as f:
-            lobby_data = json.load(f)
-        LOBBIES[lobby_code] = lobby_data
-        print(f"Lobby {lobby_code} restored from {filepath}")
-        return True
-    except Exception as e:
-        print(f"Error loading lobby {lobby_code}: {e}")
-        return False
-    
 @socketio.on('chat_message')
+@observe_event('chat_message')
 def on_chat(data):
     lobby_code = data.get('code')
-    name = data.get('name', 'Anon')
-    text = data.get('text', '').strip()
-    if not text:
-        return
-    if lobby_code not in LOBBIES:
-        return
-    
-    lobby = LOBBIES[lobby_code]
-    message = {'name': name, 'text': text}
-    lobby.setdefault('messages', []).append(message)
-
-    # Check if this message is a response to the AI's prompt for preferences or a direct mention
-    messages = lobby.get('messages', [])
-    is_ai_related = False
-
-    if "@ai" in text.lower():
-        is_ai_related = True
-    elif len(messages) > 1:
-        last_message = messages[-2]
-        if last_message.get('name') == 'AI Assistant' and "preferences" in last_message.get('text', ''):
-            is_ai_related = True
-
-    if is_ai_related:
-        user_preferences = text
-        places_data = lobby.get('midpoint_details', {})
-        
-        def get_suggestion_async():
-            with app.app_context():
-                suggestion = get_suggestions(user_preferences, places_data)
-                ai_response_message = {'name': 'AI Assistant', 'text': suggestion}
-                lobby.setdefault('messages', []).append(ai_response_message)
-                emit_lobby_update(lobby_code, animation=False)
-        
-        socketio.start_background_task(get_suggestion_async)
+    message = parse_chat_message(data)
+    if message is None:
         return
 
-    emit_lobby_update(lobby_code, animation=False)
+    with lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            return
+        ops, ai_request = post_chat_message(lobby_code, lobby, message)
+        emit_lobby_update(lobby_code, ops, animation=False, lobby=lobby)
 
+    if ai_request is not None:
+        user_preferences = message['text']
 
-@app.route('/debug')
-def api_debug():
-    return render_template('api_debug.html')
+        def get_suggestion_async():
+            with app.app_context():
+                places_data, places_version = ai_request
+                stream_id = None
+                if AI_STREAMING:
+                    suggestion, stream_id = stream_suggestion_to_lobby(lobby_code, user_preferences, places_data, places_version)
+                else:
+                    suggestion = get_suggestions(user_preferences, places_data, version=places_version)
+                with lobby_transaction(LOBBIES, lobby_code) as lobby:
+                    if lobby is None:
+                        return
+                    emit_lobby_update(lobby_code, post_ai_message(lobby_code, lobby, suggestion, stream_id), animation=False, lobby=lobby)
 
+        socketio.start_background_task(get_suggestion_async)
 
-@app.route('/tts', methods=['POST'])
-def text_to_speech():
-    data = request.json
-    text = data.get('text', '').strip()
-    if not text:
-        return jsonify({"error": "Missing text"}), 400
 
-    # Example voice (you can change this)
-    voice_id = "L1aJrPa7pLJEyYlh3Ilq"  # or "Antoni", or custom voice ID
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+@socketio.on('load_history')
+@observe_event('load_history')
+def on_load_history(data):
+    """Sends the requesting client the page of messages before the oldest one it has."""
+    page_args = parse_history_request(data)
+    if page_args is None:
+        return
+    page = read_history(data.get('code'), *page_args)
+    if page is not None:
+        socketio.emit('chat_history', page, to=request.sid)
 
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": ELEVENLABS_API_KEY
-    }
 
-    payload = {
-        "text": text,
-        "model_id": "eleven_multilingual_v2"
-    }
+def stream_suggestion_to_lobby(lobby_code, user_preferences, places_data, places_version=None, model=None):
+    """
+    Broadcasts an AI suggestion to the lobby as it is generated. Clients render
+    ai_stream_start/ai_stream_chunk as a provisional message, which the final
+    message_appended op (carrying the same stream_id) replaces.
+    Returns the full text and the stream id. If the answer breaks off, the
+    text is the apology, so the final message replaces the partial answer.
+    """
+    stream_id = uuid.uuid4().hex
+    socketio.emit('ai_stream_start', ai_stream_start(lobby_code, stream_id), room=lobby_code)
+    parts = []
+    try:
+        for chunk in stream_suggestions(user_preferences, places_data, model=model, version=places_version):
+            parts.append(chunk)
+            socketio.emit('ai_stream_chunk', ai_stream_chunk(lobby_code, stream_id, chunk), room=lobby_code)
+    except StreamInterrupted as e:
+        parts = [str(e)]
+    return ''.join(parts), stream_id
+
 
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code != 200:
-        print("Error:", response.text)
-        return jsonify({"error": "TTS request failed"}), 500
+SCHEDULER_PENDING.set_function(lambda: len(SCHEDULER))
 
-    # Send back audio as a playable file
-    return send_file(BytesIO(response.content), mimetype='audio/mpeg')
 
 if __name__ == '__main__':
     socketio.run(app, debug=True)
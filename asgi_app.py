@@ -0,0 +1,577 @@
+"""
+Asyncio entry point: the same Socket.IO events and payloads as app.py, served by
+python-socketio's AsyncServer under an ASGI server instead of Flask-SocketIO on
+eventlet. Outbound calls (Geobytes, Places, Gemini, ElevenLabs, photos) go
+through httpx on the event loop rather than relying on monkey-patching.
+
+    uvicorn asgi_app:asgi --port 5001 [--workers N]
+
+The event handling itself (checking event data, changing the lobby and building
+the patches) is lobby_core's; the handlers here only do the I/O around it.
+
+Lobby state, the archive and the caches are the ones lobby_core sets up, so with a
+Redis LOBBY_STORE_URL this server can run next to the eventlet workers and share
+their rooms. Plain HTTP routes are web.py's Flask views, run in a thread pool;
+only the upstream fetches behind /photo and /tts are done here.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+import httpx
+import socketio
+from a2wsgi import WSGIMiddleware
+
+from connections import ConnectionRegistry
+from gateway import provider, ProviderUnavailable
+from genai_module import get_suggestions_async, stream_suggestions_async, StreamInterrupted
+from http_pool import get_async_client, async_timeout_for, close_async_client
+from lobby_core import (
+    ARCHIVE_DELAY, AI_STREAMING, AUDIO_CACHE, CLEANUP_INTERVAL, ELEVENLABS_API_KEY, ELEVENLABS_BASE_URL,
+    GEOBYTES_URL, HEARTBEAT_INTERVAL, LOBBIES, PLACES_DEBOUNCE, PLACES_FETCHES,
+    RECONNECT_GRACE, SOCKETIO_MESSAGE_QUEUE, SOCKETIO_PING_INTERVAL, SOCKETIO_PING_TIMEOUT, TOWN_DEBOUNCE,
+    accept_more_places, accept_places_page, add_preferences_prompt, ai_stream_chunk, ai_stream_start,
+    awaits_town, cached_lobby_codes, drop_lobby_caches, event_participant, evict_disconnected, expire_archives,
+    geobytes_params, get_derived_state, heartbeat_lobby, hibernate_lobby, indexed_town, is_current_places_fetch,
+    is_idle, join_participant, lobby_emptied, lobby_snapshot, mark_disconnected, more_places_request,
+    needs_heartbeat, next_patch, parse_chat_message, parse_history_request, parse_midpoint_mode, parse_weight,
+    places_category_payload, places_fetch_args, post_ai_message, post_chat_message, queue_places_fetch,
+    read_history, rehydrate_lobby, remember_derived_state, remove_participant, set_midpoint_mode, set_point,
+    set_weight, town_from_geobytes, travel_info,
+)
+from lobby_store import async_lobby_lock, async_lobby_transaction, run_store
+from metrics import SCHEDULER_PENDING, observe_event
+from photo_cache import PHOTO_VARIANTS, DEFAULT_VARIANT
+from places_api import PHOTO_CACHE, CATEGORY_CATALOG, PLACES_CATEGORIES, category_page_async, cached_photo_async, iter_city_data_async
+from scheduler import DeadlineScheduler
+from socket_codec import PACKET_CLASS
+import web
+
+log = logging.getLogger(__name__)
+
+# Broadcasts go through the same Redis channel as Flask-SocketIO's, so rooms span both kinds of worker
+client_manager = None
+if SOCKETIO_MESSAGE_QUEUE:
+    client_manager = socketio.AsyncRedisManager(SOCKETIO_MESSAGE_QUEUE, channel='flask-socketio')
+sio = socketio.AsyncServer(async_mode='asgi', client_manager=client_manager, serializer=PACKET_CLASS,
+                           ping_interval=SOCKETIO_PING_INTERVAL, ping_timeout=SOCKETIO_PING_TIMEOUT)
+
+# This process's deadlines and sockets; the scheduler runs as an asyncio task
+SCHEDULER = DeadlineScheduler(sio.start_background_task, sio.eio.create_event)
+SCHEDULER_PENDING.set_function(lambda: len(SCHEDULER))
+CONNECTIONS = ConnectionRegistry()
+
+
+@sio.on('join_lobby')
+@observe_event('join_lobby')
+async def on_join(sid, data):
+    """Handles a user joining a lobby."""
+    target = event_participant(data, 'Join')
+    if target is None:
+        return
+    lobby_code, user_id = target
+
+    await asyncio.to_thread(rehydrate_lobby, lobby_code)
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            log.info("Join failed: lobby not found", extra={'lobby': lobby_code})
+            return
+
+        await sio.enter_room(sid, lobby_code)
+        CONNECTIONS.bind(sid, lobby_code, user_id)
+        ops = join_participant(lobby_code, lobby, user_id, sid)
+
+        cancel_lobby_archive(lobby_code)
+        SCHEDULER.cancel(('evict', lobby_code, user_id))
+        if 'cleanup' not in SCHEDULER:
+            SCHEDULER.schedule('cleanup', CLEANUP_INTERVAL, cleanup_lobby_caches)
+        if 'heartbeat' not in SCHEDULER:
+            SCHEDULER.schedule('heartbeat', HEARTBEAT_INTERVAL, heartbeat_participants)
+        # Tell the others about a newcomer, then give the (re)joining user the full state
+        if ops:
+            await emit_lobby_update(lobby_code, ops, skip_sid=sid, lobby=lobby)
+        await emit_lobby_snapshot(lobby_code, sid, lobby=lobby)
+        info = travel_info(lobby)
+
+    # Points didn't change, so no new places fetch will run; hand the newcomer the cached details
+    if info['midpoint_details']:
+        await sio.emit('travel_info_update', info, to=sid)
+
+
+@sio.on('leave_lobby')
+@observe_event('leave_lobby')
+async def on_leave(sid, data):
+    """Handles a user voluntarily leaving a lobby."""
+    target = event_participant(data, 'Leave')
+    if target is None:
+        return
+    lobby_code, user_id = target
+
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            log.info("Leave failed: lobby not found", extra={'lobby': lobby_code})
+            return
+
+        ops = remove_participant(lobby_code, lobby, user_id)
+        await sio.leave_room(sid, lobby_code)
+        CONNECTIONS.release(sid, lobby_code, user_id)
+        SCHEDULER.cancel(('evict', lobby_code, user_id))
+        await finish_removal(lobby_code, lobby, ops)
+
+
+@sio.on('disconnect')
+@observe_event('disconnect')
+async def on_disconnect(sid, reason=None):
+    """Starts the reconnect grace window for the participant whose socket closed."""
+    entry = CONNECTIONS.unbind(sid)
+    if entry is None:
+        return
+    lobby_code, user_id = entry
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None or not mark_disconnected(lobby, user_id, sid):
+            return
+    log.info("User disconnected", extra={'lobby': lobby_code, 'user': user_id, 'reason': reason})
+    SCHEDULER.schedule(('evict', lobby_code, user_id), RECONNECT_GRACE, evict_participant, lobby_code, user_id)
+
+
+async def evict_participant(lobby_code, user_id):
+    """Removes a disconnected participant whose grace window ran out."""
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            return
+        ops = evict_disconnected(lobby_code, lobby, user_id)
+        if ops:
+            await finish_removal(lobby_code, lobby, ops)
+
+
+async def heartbeat_participants():
+    """app.heartbeat_participants for this process's sockets."""
+    now = time.time()
+    for lobby_code in await run_store(LOBBIES, LOBBIES.codes):
+        users = CONNECTIONS.lobby_users(lobby_code)
+        if not needs_heartbeat(await run_store(LOBBIES, LOBBIES.get, lobby_code), users, now):
+            continue
+        async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+            if lobby is None:
+                continue
+            ops = heartbeat_lobby(lobby_code, lobby, users, now)
+            if ops:
+                await finish_removal(lobby_code, lobby, ops)
+    SCHEDULER.schedule('heartbeat', HEARTBEAT_INTERVAL, heartbeat_participants)
+
+
+async def finish_removal(lobby_code, lobby, ops):
+    """Tells the room who was removed and schedules the archive once nobody is left."""
+    if lobby_emptied(lobby_code, lobby):
+        schedule_lobby_archive(lobby_code)
+    if ops:
+        await emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+@sio.on('lobby_resync')
+@observe_event('lobby_resync')
+async def on_resync(sid, data):
+    """Sends a full snapshot to a client that missed a patch."""
+    await emit_lobby_snapshot(data.get('code'), sid)
+
+
+@sio.on('add_point')
+@observe_event('add_point')
+async def on_add_point(sid, data):
+    """Handles a user adding or updating a point."""
+    lobby_code = data.get('code')
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        ops = set_point(lobby_code, lobby, data.get('userId'), data.get('point')) if lobby is not None else []
+        if ops:
+            await emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+@sio.on('set_midpoint_mode')
+@observe_event('set_midpoint_mode')
+async def on_set_midpoint_mode(sid, data):
+    """Switches how the lobby's meeting point is computed."""
+    lobby_code = data.get('code')
+    mode = parse_midpoint_mode(lobby_code, data)
+    if mode is None:
+        return
+
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        ops = set_midpoint_mode(lobby, mode) if lobby is not None else []
+        if ops:
+            await emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+@sio.on('set_weight')
+@observe_event('set_weight')
+async def on_set_weight(sid, data):
+    """Sets how much a participant's travel distance counts towards the meeting point."""
+    lobby_code = data.get('code')
+    weight = parse_weight(data)
+    if weight is None:
+        return
+
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        ops = set_weight(lobby, data.get('userId'), weight) if lobby is not None else []
+        if ops:
+            await emit_lobby_update(lobby_code, ops, lobby=lobby)
+
+
+@sio.on('chat_message')
+@observe_event('chat_message')
+async def on_chat(sid, data):
+    lobby_code = data.get('code')
+    message = parse_chat_message(data)
+    if message is None:
+        return
+
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            return
+        # Adding a message can move the overflow into the SQLite archive
+        ops, ai_request = await asyncio.to_thread(post_chat_message, lobby_code, lobby, message)
+        await emit_lobby_update(lobby_code, ops, animation=False, lobby=lobby)
+
+    if ai_request is not None:
+        sio.start_background_task(answer_preferences, lobby_code, message['text'], *ai_request)
+
+
+async def answer_preferences(lobby_code, user_preferences, places_data, places_version):
+    """Background task posting the AI's suggestion, streamed to the room as it is generated."""
+    stream_id = None
+    if AI_STREAMING:
+        stream_id = uuid.uuid4().hex
+        await sio.emit('ai_stream_start', ai_stream_start(lobby_code, stream_id), room=lobby_code)
+        parts = []
+        try:
+            async for chunk in stream_suggestions_async(user_preferences, places_data, version=places_version):
+                parts.append(chunk)
+                await sio.emit('ai_stream_chunk', ai_stream_chunk(lobby_code, stream_id, chunk), room=lobby_code)
+        except StreamInterrupted as e:
+            # The final message replaces the partial answer the room has seen
+            parts = [str(e)]
+        suggestion = ''.join(parts)
+    else:
+        suggestion = await get_suggestions_async(user_preferences, places_data, version=places_version)
+
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is None:
+            return
+        ops = await asyncio.to_thread(post_ai_message, lobby_code, lobby, suggestion, stream_id)
+        await emit_lobby_update(lobby_code, ops, animation=False, lobby=lobby)
+
+
+@sio.on('load_history')
+@observe_event('load_history')
+async def on_load_history(sid, data):
+    """Sends the requesting client the page of messages before the oldest one it has."""
+    page_args = parse_history_request(data)
+    if page_args is None:
+        return
+    # Older pages come from the SQLite archive
+    page = await asyncio.to_thread(read_history, data.get('code'), *page_args)
+    if page is not None:
+        await sio.emit('chat_history', page, to=sid)
+
+
+@sio.on('load_more_places')
+@observe_event('load_more_places')
+async def on_load_more_places(sid, data):
+    """Fetches the next page of one category, using the page token from the last search."""
+    lobby_code = data.get('code')
+    category = data.get('category')
+    if category not in CATEGORY_CATALOG:
+        return
+    request_args = more_places_request(await run_store(LOBBIES, LOBBIES.get, lobby_code), category)
+    if request_args is not None:
+        sio.start_background_task(load_more_places, lobby_code, category, *request_args)
+
+
+async def load_more_places(lobby_code, category, page_token, search, fetch_id):
+    """Background task appending the next page of a category and sending it to the room."""
+    try:
+        places, next_page_token = await category_page_async(
+            search['city'], category, search['midpoint'], search['reachable_midpoint'],
+            search['participants'], page_token=page_token,
+        )
+    except Exception as e:
+        log.warning("Loading more %s failed: %s", category, e, extra={'lobby': lobby_code})
+        return
+
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if accept_more_places(lobby, category, page_token, fetch_id, places, next_page_token):
+            await emit_places_category(lobby_code, lobby, category, places, append=True, complete=True)
+
+
+def schedule_places_fetch(lobby_code, city_name, midpoint, reachable_midpoint, version=None, participants=None):
+    """Coalesces bursts of point changes into one places fetch per lobby (see app.schedule_places_fetch)."""
+    queue_places_fetch(lobby_code, city_name, midpoint, reachable_midpoint, version, participants)
+    SCHEDULER.schedule(('places', lobby_code), PLACES_DEBOUNCE, start_places_fetch, lobby_code)
+
+
+def start_places_fetch(lobby_code):
+    fetch = PLACES_FETCHES.get(lobby_code)
+    if fetch is None:
+        return
+    sio.start_background_task(fetch_places, lobby_code, *fetch['args'], generation=fetch['generation'])
+
+
+async def fetch_places(lobby_code, city_name, midpoint, reachable_midpoint, version=None, participants=None, generation=None):
+    """Background task sending each category to the room as soon as its search returns."""
+    fetch_id = uuid.uuid4().hex
+    search = {'city': city_name, 'midpoint': midpoint, 'reachable_midpoint': reachable_midpoint, 'participants': participants}
+    remaining = len(PLACES_CATEGORIES)
+    async for category, places, next_page_token in iter_city_data_async(city_name, midpoint, reachable_midpoint, participants):
+        remaining -= 1
+        if not is_current_places_fetch(lobby_code, generation):
+            return
+        log.debug("Places fetched for %s: %s", city_name, category, extra={'lobby': lobby_code, 'count': len(places)})
+
+        async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+            if not accept_places_page(lobby_code, lobby, fetch_id, search, category, places, next_page_token, version, not remaining):
+                return
+            await emit_places_category(lobby_code, lobby, category, places, complete=not remaining)
+            if remaining:
+                continue
+
+            # After sending places, send a prompt from the AI
+            prompt = await asyncio.to_thread(add_preferences_prompt, lobby_code, lobby)
+            if prompt is not None:
+                await emit_lobby_update(lobby_code, [{'op': 'message_appended', 'message': prompt}], animation=False, lobby=lobby)
+
+
+async def emit_places_category(lobby_code, lobby, category, places, append=False, complete=False):
+    payload = places_category_payload(lobby_code, lobby, category, places, append, complete)
+    await sio.emit('travel_info_category', payload, room=lobby_code)
+
+
+def schedule_lobby_archive(lobby_code):
+    """Schedules a lobby for automatic archiving after a delay."""
+    if ('archive', lobby_code) in SCHEDULER:
+        return
+    SCHEDULER.schedule(('archive', lobby_code), ARCHIVE_DELAY, archive_if_idle, lobby_code)
+
+
+async def archive_if_idle(lobby_code):
+    """Hibernates a lobby whose participants are all gone."""
+    # Re-read the lobby: someone may have rejoined through another worker
+    async with async_lobby_lock(LOBBIES, lobby_code):
+        if is_idle(await run_store(LOBBIES, LOBBIES.get, lobby_code)):
+            # Writes the SQLite archive as well as the store
+            await asyncio.to_thread(hibernate_lobby, lobby_code)
+
+
+def cancel_lobby_archive(lobby_code):
+    """Cancels a pending archive if someone rejoins."""
+    if SCHEDULER.cancel(('archive', lobby_code)):
+        log.info("Archive cancelled: participant rejoined", extra={'lobby': lobby_code})
+
+
+async def cleanup_lobby_caches():
+    """Drops per-process caches for lobbies that are no longer active and expires old archives, then re-arms itself."""
+    for lobby_code in cached_lobby_codes():
+        if not await run_store(LOBBIES, LOBBIES.__contains__, lobby_code):
+            drop_lobby_caches(lobby_code, SCHEDULER)
+    await asyncio.to_thread(expire_archives)
+    SCHEDULER.schedule('cleanup', CLEANUP_INTERVAL, cleanup_lobby_caches)
+
+
+async def emit_lobby_snapshot(lobby_code, sid, lobby=None):
+    """Sends the full lobby state to a single client."""
+    lobby = lobby or await run_store(LOBBIES, LOBBIES.get, lobby_code)
+    if lobby is None:
+        return
+    derived, _ = get_derived_state(lobby_code, lobby)
+    await sio.emit('lobby_update', lobby_snapshot(lobby_code, lobby, derived=derived), to=sid)
+    log.debug("Sent snapshot", extra={'lobby': lobby_code, 'sid': sid})
+    if derived.get('town_pending'):
+        schedule_town_lookup(lobby_code, derived)
+
+
+async def emit_lobby_update(lobby_code, ops, animation=True, skip_sid=None, lobby=None):
+    """Broadcasts a sequence-numbered patch (see app.emit_lobby_update)."""
+    if lobby is None:
+        async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+            if lobby is not None:
+                await emit_lobby_update(lobby_code, ops, animation, skip_sid, lobby=lobby)
+        return
+
+    derived, points_changed = get_derived_state(lobby_code, lobby)
+    await send_lobby_patch(lobby_code, lobby, ops, derived, points_changed, animation, skip_sid)
+
+
+async def send_lobby_patch(lobby_code, lobby, ops, derived, points_changed, animation=True, skip_sid=None):
+    """Broadcasts the next patch, then starts a places fetch or town lookup (see app.send_lobby_patch)."""
+    patch = next_patch(lobby_code, lobby, ops, derived, points_changed, animation)
+    await sio.emit('lobby_patch', patch, room=lobby_code, skip_sid=skip_sid)
+    log.debug("Sent patch %d", patch['seq'], extra={'lobby': lobby_code})
+
+    fetch_args = places_fetch_args(lobby, derived) if points_changed else None
+    if fetch_args is not None:
+        schedule_places_fetch(lobby_code, *fetch_args)
+    elif derived.get('town_pending'):
+        schedule_town_lookup(lobby_code, derived)
+
+
+def schedule_town_lookup(lobby_code, derived):
+    SCHEDULER.schedule(('town', lobby_code), TOWN_DEBOUNCE, resolve_town, lobby_code, derived)
+
+
+async def resolve_town(lobby_code, derived):
+    """Awaits the Geobytes lookup outside the lobby lock, then sends the midpoint (see app.resolve_town)."""
+    lobby = await run_store(LOBBIES, LOBBIES.get, lobby_code)
+    if lobby is None or not awaits_town(lobby_code, lobby, derived):
+        return
+    town = await find_closest_town_remote(derived['geometric_midpoint'])
+    async with async_lobby_transaction(LOBBIES, lobby_code) as lobby:
+        if lobby is not None and awaits_town(lobby_code, lobby, derived):
+            derived = remember_derived_state(lobby_code, derived['version'], derived['geometric_midpoint'], town)
+            await send_lobby_patch(lobby_code, lobby, [], derived, True)
+
+
+async def find_closest_town_remote(midpoint):
+    """Asks Geobytes for the town nearest a midpoint (see lobby_core.find_closest_town_remote)."""
+    lat = midpoint['lat']
+    lon = midpoint['lon']
+    try:
+        # If Geobytes is down or saturated, take the nearest indexed town, however far
+        return await provider('geobytes').acall(
+            geobytes_nearest_town, lat, lon,
+            key=(round(lat, 4), round(lon, 4)), fallback=lambda: indexed_town(midpoint),
+        )
+    except Exception as e:
+        log.warning("Geobytes lookup failed at %s,%s: %s", lat, lon, e)
+        return None
+
+
+async def geobytes_nearest_town(lat, lon):
+    resp = await get_async_client().get(GEOBYTES_URL, params=geobytes_params(lat, lon), timeout=async_timeout_for('geobytes'))
+    resp.raise_for_status()
+    return town_from_geobytes(resp.json())
+
+
+# --- HTTP ---
+
+flask_app = WSGIMiddleware(web.app)
+PHOTO_PATH = re.compile(r'^/photo/([0-9a-f]{32})(?:/(\w+))?$')
+TTS_PATH = re.compile(r'^/tts/([0-9a-f]{64})\.mp3$')
+
+
+async def http_app(scope, receive, send):
+    """
+    Fetches a missing photo or relays uncached speech on the event loop; every
+    other request, and the cached photo itself, is served by the Flask app.
+    """
+    if scope['type'] == 'http':
+        match = PHOTO_PATH.match(scope['path'])
+        if match and await fetch_photo(match[1], match[2] or DEFAULT_VARIANT, send):
+            return
+        match = TTS_PATH.match(scope['path'])
+        if match and await asyncio.to_thread(AUDIO_CACHE.get, match[1]) is None and await relay_tts(match[1], send):
+            return
+    await flask_app(scope, receive, send)
+
+
+async def send_json(send, status, body, headers=()):
+    payload = json.dumps(body).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode()), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def fetch_photo(photo_id, variant, send):
+    """Makes sure a photo is in the cache. Returns True if it already answered the request with an error."""
+    if variant not in PHOTO_VARIANTS or await asyncio.to_thread(os.path.exists, PHOTO_CACHE.variant_path(photo_id, variant)):
+        return False
+    try:
+        await cached_photo_async(photo_id, variant)
+    except ProviderUnavailable as e:
+        log.warning("Photo fetch refused: %s", e)
+        await send_json(send, 503, {"error": "Photos are busy, try again shortly"}, [(b'retry-after', b'5')])
+        return True
+    except (httpx.HTTPError, OSError) as e:
+        log.warning("Photo fetch failed for %s: %s", photo_id, e)
+        await send_json(send, 502, {"error": "Photo fetch failed"})
+        return True
+    return False
+
+
+async def open_tts_stream(url, headers, payload):
+    """Starts a streamed ElevenLabs request; anything but a 200 is raised so the gateway counts it."""
+    client = get_async_client()
+    request = client.build_request('POST', url, headers=headers, json=payload, timeout=async_timeout_for('elevenlabs'))
+    upstream = await client.send(request, stream=True)
+    if upstream.status_code != 200:
+        await upstream.aread()
+        log.error("ElevenLabs returned %s: %s", upstream.status_code, upstream.text)
+        await upstream.aclose()
+        raise httpx.HTTPStatusError(f"ElevenLabs returned {upstream.status_code}", request=request, response=upstream)
+    return upstream
+
+
+async def relay_tts(key, send):
+    """
+    Relays uncached speech from ElevenLabs chunk by chunk while writing it into
+    the cache. Returns False for unknown keys, which the Flask view answers.
+    """
+    tts_request = await asyncio.to_thread(AUDIO_CACHE.load_request, key)
+    if tts_request is None:
+        return False
+
+    url = f"{ELEVENLABS_BASE_URL}/v1/text-to-speech/{tts_request['voice_id']}"
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": ELEVENLABS_API_KEY
+    }
+    payload = {
+        "text": tts_request['text'],
+        "model_id": tts_request['model_id']
+    }
+
+    try:
+        upstream = await provider('elevenlabs').acall(open_tts_stream, url, headers, payload)
+    except ProviderUnavailable as e:
+        log.warning("TTS unavailable: %s", e)
+        await send_json(send, 503, {"error": "TTS is busy, try again shortly"}, [(b'retry-after', b'5')])
+        return True
+    except httpx.HTTPError as e:
+        log.warning("TTS request error: %s", e)
+        await send_json(send, 502, {"error": "TTS request failed"})
+        return True
+
+    temp_path = AUDIO_CACHE.temp_path(key)
+    complete = False
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'audio/mpeg'), (b'cache-control', b'no-store')],
+        })
+        with open(temp_path, 'wb') as f:
+            async for chunk in upstream.aiter_bytes(16384):
+                f.write(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        complete = True
+    finally:
+        await upstream.aclose()
+        if complete:
+            await asyncio.to_thread(AUDIO_CACHE.commit, key, temp_path)
+        elif os.path.exists(temp_path):
+            # The listener went away or the upstream failed; don't cache a truncated file
+            os.remove(temp_path)
+    return True
+
+
+asgi = socketio.ASGIApp(sio, other_asgi_app=http_app, on_shutdown=close_async_client)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(asgi, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
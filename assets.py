@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # gzip alone is still served
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# Text formats worth compressing; fonts (woff2) and images are already compressed
+COMPRESSIBLE = {'.js', '.css', '.svg', '.html', '.json', '.txt', '.map'}
+MIN_COMPRESS_BYTES = 512
+# url('/fonts/x.woff2') and friends inside stylesheets
+CSS_URL = re.compile(r"""url\((['"]?)(/[^'")]+)\1\)""")
+
+
+class Asset:
+    __slots__ = ('body', 'encoded', 'digest', 'mimetype')
+
+    def __init__(self, body, digest, mimetype):
+        self.body = body
+        self.digest = digest
+        self.mimetype = mimetype
+        self.encoded = {}  # content-encoding -> compressed body, only kept when smaller
+
+
+class AssetManifest:
+    """
+    In-memory copy of the static files, built once at startup.
+
+    Every file under the given roots (URL prefix -> directory) is read,
+    hashed and, for text formats, gzip- and (if available) brotli-compressed.
+    Each file is then reachable under its plain name and under a fingerprinted
+    name (style.3f2a9c1e04b7.css) whose content can never change, so the
+    latter is served with an immutable Cache-Control. Stylesheet url(...)
+    references to other assets are rewritten to their fingerprinted URLs.
+    """
+
+    def __init__(self, roots):
+        self.roots = roots
+        self._assets = {}  # (prefix, filename) -> Asset, under both plain and hashed names
+        self._urls = {}  # (prefix, filename) -> fingerprinted URL
+        self._mtime = None
+
+    def build(self):
+        files = []
+        for prefix, directory in self.roots.items():
+            for base, _, names in os.walk(directory):
+                for name in names:
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(base, name)
+                    files.append((prefix, os.path.relpath(path, directory).replace(os.sep, '/'), path))
+
+        assets, urls = {}, {}
+        # Stylesheets last, so the files they point at already have their final URLs
+        for prefix, filename, path in sorted(files, key=lambda f: f[1].endswith('.css')):
+            with open(path, 'rb') as f:
+                body = f.read()
+            if filename.endswith('.css'):
+                body = self._rewrite_css(body, urls)
+            digest = hashlib.sha256(body).hexdigest()[:12]
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            asset = Asset(body, digest, mimetype)
+            if os.path.splitext(filename)[1] in COMPRESSIBLE and len(body) >= MIN_COMPRESS_BYTES:
+                self._compress(asset)
+
+            stem, ext = os.path.splitext(filename)
+            hashed = f"{stem}.{digest}{ext}"
+            assets[(prefix, filename)] = asset
+            assets[(prefix, hashed)] = asset
+            urls[(prefix, filename)] = f"/{prefix}/{hashed}"
+
+        self._assets, self._urls = assets, urls
+        self._mtime = self._latest_mtime()
+        log.info("Built asset manifest with %d files", len(urls))
+        return self
+
+    @staticmethod
+    def _compress(asset):
+        encoded = {'gzip': gzip.compress(asset.body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            encoded['br'] = brotli.compress(asset.body, quality=11)
+        asset.encoded = {k: v for k, v in encoded.items() if len(v) < len(asset.body)}
+
+    @staticmethod
+    def _rewrite_css(body, urls):
+        def replace(match):
+            prefix, _, filename = match.group(2).lstrip('/').partition('/')
+            url = urls.get((prefix, filename))
+            return f"url({match.group(1)}{url}{match.group(1)})" if url else match.group(0)
+        return CSS_URL.sub(replace, body.decode('utf-8')).encode('utf-8')
+
+    def _latest_mtime(self):
+        latest = 0.0
+        for directory in self.roots.values():
+            for base, _, names in os.walk(directory):
+                for name in names:
+                    latest = max(latest, os.path.getmtime(os.path.join(base, name)))
+        return latest
+
+    def reload_if_changed(self):
+        """Rebuilds when a file changed since the last build (for the debug server)."""
+        if self._latest_mtime() != self._mtime:
+            self.build()
+
+    def url(self, prefix, filename):
+        """Fingerprinted URL of an asset; the plain URL if the file is unknown."""
+        return self._urls.get((prefix, filename), f"/{prefix}/{filename}")
+
+    def get(self, prefix, filename):
+        """Returns (asset, immutable) for a plain or fingerprinted name, or (None, False)."""
+        asset = self._assets.get((prefix, filename))
+        if asset is None:
+            return None, False
+        return asset, (prefix, filename) not in self._urls
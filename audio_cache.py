@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class AudioCache:
+    """
+    Content-addressed store for generated speech. Files are named by a hash of
+    (voice_id, model_id, text), so identical requests share one file, and the
+    directory is kept under max_bytes by evicting the least recently used files.
+    Next to each audio file sits a small JSON file with the request that
+    produced it, so any worker can regenerate a key it is asked for. The two
+    make up one cache entry: both count towards max_bytes and are evicted
+    together, including requests whose audio was never fetched.
+    """
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()  # key -> {'.mp3': size, '.json': size}, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(voice_id, model_id, text):
+        return hashlib.sha256(f"{voice_id}\0{model_id}\0{text}".encode('utf-8')).hexdigest()
+
+    def audio_path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def _request_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _scan(self):
+        """Rebuilds the LRU index from the files on disk, oldest access first."""
+        entries = {}
+        used = {}
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext not in ('.mp3', '.json'):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.setdefault(key, {})[ext] = st.st_size
+            used[key] = max(used.get(key, 0), st.st_mtime)
+        for key in sorted(entries, key=used.get):
+            self._files[key] = entries[key]
+            self.bytes_used += sum(entries[key].values())
+
+    def _store(self, key, ext, size):
+        """
+        Records a file of key's entry, marks the entry recently used and evicts
+        down to max_bytes. Call with the lock held; returns the evicted keys.
+        """
+        entry = self._files.pop(key, {})
+        self.bytes_used += size - entry.get(ext, 0)
+        entry[ext] = size
+        self._files[key] = entry
+        evicted = []
+        while self.bytes_used > self.max_bytes and len(self._files) > 1:
+            old_key, old_entry = self._files.popitem(last=False)
+            self.bytes_used -= sum(old_entry.values())
+            evicted.append(old_key)
+        return evicted
+
+    def _remove(self, keys):
+        for key in keys:
+            for path in (self.audio_path(key), self._request_path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        """Returns the path of a cached file (marking it recently used), or None."""
+        with self._lock:
+            if '.mp3' not in self._files.get(key, ()):
+                self.misses += 1
+                return None
+            self._files.move_to_end(key)
+            self.hits += 1
+        path = self.audio_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another worker sharing the directory
+            with self._lock:
+                self.bytes_used -= sum(self._files.pop(key, {}).values())
+            return None
+        return path
+
+    def remember_request(self, key, request):
+        path = self._request_path(key)
+        with open(path, 'w') as f:
+            json.dump(request, f)
+        size = os.path.getsize(path)
+        with self._lock:
+            evicted = self._store(key, '.json', size)
+        self._remove(evicted)
+
+    def load_request(self, key):
+        try:
+            with open(self._request_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def temp_path(self, key):
+        return os.path.join(self.directory, f"{key}.{os.getpid()}.{threading.get_ident()}.part")
+
+    def commit(self, key, temp_path):
+        """Moves a completely written temp file into the cache and enforces the size bound."""
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, self.audio_path(key))
+        with self._lock:
+            evicted = self._store(key, '.mp3', size)
+        self._remove(evicted)
+
+    def stats(self):
+        return {
+            'files': len(self._files),
+            'pending': sum('.mp3' not in entry for entry in self._files.values()),
+            'bytes': self.bytes_used,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
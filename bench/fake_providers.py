@@ -0,0 +1,270 @@
+"""
+Local stand-ins for Geobytes, Google Places (search and photos), Gemini and ElevenLabs.
+
+Each provider answers with plausible, deterministic payloads after a
+configurable delay, and fails a configurable fraction of requests with a
+503, so the app can be load tested without touching (or paying for) the
+real services. Run it on its own to point a dev server at it:
+
+    python bench/fake_providers.py --port 8089 --latency places=0.3 --error-rate gemini=0.05
+"""
+import argparse
+import functools
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from PIL import Image
+
+PROVIDERS = ('geobytes', 'places', 'photos', 'gemini', 'elevenlabs')
+DEFAULT_LATENCY = {'geobytes': 0.05, 'places': 0.25, 'photos': 0.15, 'gemini': 0.6, 'elevenlabs': 0.4}
+SUGGESTION_WORDS = (
+    "I'd suggest starting at the first place on the list, it is central and well rated. "
+    "If you prefer something quieter, the second option is a short walk away. "
+    "Either way you'll all travel a similar distance."
+).split(' ')
+
+
+class Profile:
+    """Latency (seconds, +/- jitter fraction) and error rate for one provider."""
+
+    def __init__(self, latency, jitter=0.2, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(max(0.0, random.uniform(1 - self.jitter, 1 + self.jitter) * self.latency))
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+def _rng(*parts):
+    seed = hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+    return random.Random(int(seed[:12], 16))
+
+
+def nearby_city(lat, lon):
+    """Geobytes row format: see find_closest_town_remote in lobby_core.py."""
+    rng = _rng(round(lat, 2), round(lon, 2))
+    name = f"Benchtown {rng.randint(1, 9999)}"
+    return [[0, name, 'BT', 'Benchland', 'N', 1.0, 'BL', 2.0, lat + rng.uniform(-0.05, 0.05),
+             'BLBT', lon + rng.uniform(-0.05, 0.05), 1.2, 'Bench Region']]
+
+
+def search_places(query, center, page_token=None, count=20, pages=3):
+    """One page of results; like the real API, a nextPageToken is returned until the last page."""
+    page = int(page_token or 0)
+    rng = _rng(query, page, center and round(center['latitude'], 2), center and round(center['longitude'], 2))
+    lat = center['latitude'] if center else 0.0
+    lon = center['longitude'] if center else 0.0
+    places = []
+    for i in range(page * count, (page + 1) * count):
+        places.append({
+            'id': f"bench-{rng.getrandbits(40):x}",
+            'displayName': {'text': f"{query.split(' in ')[0].title()} #{i + 1}", 'languageCode': 'en'},
+            'rating': round(rng.uniform(3.0, 5.0), 1),
+            'userRatingCount': rng.randint(5, 5000),
+            'location': {'latitude': lat + rng.uniform(-0.2, 0.2), 'longitude': lon + rng.uniform(-0.2, 0.2)},
+            'googleMapsUri': f"https://maps.example/bench/{i}",
+            'photos': [{'name': f"places/bench-{i}/photos/p{i}"}],
+        })
+    result = {'places': places}
+    if page + 1 < pages:
+        result['nextPageToken'] = str(page + 1)
+    return result
+
+
+@functools.lru_cache(maxsize=1)
+def photo_jpeg(height):
+    """A gradient JPEG roughly the size of a real place photo."""
+    width = height * 3 // 2
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def gemini_chunks(n=6):
+    words = SUGGESTION_WORDS
+    step = max(1, len(words) // n)
+    return [' '.join(words[i:i + step]) + ' ' for i in range(0, len(words), step)]
+
+
+def gemini_response(text):
+    return {
+        'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+        'usageMetadata': {'promptTokenCount': 100, 'candidatesTokenCount': 40, 'totalTokenCount': 140},
+    }
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    profiles = {}
+    counts = {}
+    counts_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _provider(self):
+        path = urlparse(self.path).path
+        if path.startswith('/GetNearbyCities'):
+            return 'geobytes'
+        if path.startswith('/v1/places/') and path.endswith('/media'):
+            return 'photos'
+        if path.startswith('/v1/places'):
+            return 'places'
+        if re.match(r'^/v1(beta)?/models/', path):
+            return 'gemini'
+        if path.startswith('/v1/text-to-speech/'):
+            return 'elevenlabs'
+        return None
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        provider = self._provider()
+        body = self._body() if self.command == 'POST' else {}
+        if provider is None:
+            return self._send(404, {'error': 'unknown endpoint'})
+        with self.counts_lock:
+            self.counts[provider] = self.counts.get(provider, 0) + 1
+
+        profile = self.profiles[provider]
+        profile.delay()
+        if profile.fails():
+            return self._send(503, {'error': f'injected {provider} failure'})
+
+        url = urlparse(self.path)
+        if provider == 'geobytes':
+            qs = parse_qs(url.query)
+            return self._send(200, nearby_city(float(qs['latitude'][0]), float(qs['longitude'][0])))
+        if provider == 'places':
+            center = body.get('locationBias', {}).get('circle', {}).get('center')
+            return self._send(200, search_places(body.get('textQuery', ''), center, body.get('pageToken')))
+        if provider == 'photos':
+            height = int(parse_qs(url.query).get('maxHeightPx', ['400'])[0])
+            return self._send(200, photo_jpeg(min(height, 1600)), content_type='image/jpeg')
+        if provider == 'gemini':
+            if ':streamGenerateContent' in url.path:
+                return self._stream_gemini(profile, sse=parse_qs(url.query).get('alt') == ['sse'])
+            return self._send(200, gemini_response(''.join(gemini_chunks())))
+        if provider == 'elevenlabs':
+            # ~2 s of silence-sized MP3 payload
+            return self._send(200, b'\xff\xf3' + bytes(32 * 1024), content_type='audio/mpeg')
+
+    def _stream_gemini(self, profile, sse=False):
+        """
+        Streams a JSON array of responses, which is what the SDK's REST transport
+        reads, or server-sent events for ?alt=sse (the asyncio entry point).
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream' if sse else 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunks = gemini_chunks()
+        for i, text in enumerate(chunks):
+            if sse:
+                piece = f"data: {json.dumps(gemini_response(text))}\r\n\r\n"
+            else:
+                piece = ('[' if i == 0 else ',\n') + json.dumps(gemini_response(text))
+                if i == len(chunks) - 1:
+                    piece += ']'
+            data = piece.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+            # Token-by-token generation: spread part of the latency over the stream
+            time.sleep(profile.latency / (2 * len(chunks)))
+        self.wfile.write(b"0\r\n\r\n")
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+def parse_overrides(values, cast=float):
+    """Parses ['places=0.3', 'gemini=1'] into {'places': 0.3, 'gemini': 1.0}."""
+    result = {}
+    for value in values or []:
+        name, _, amount = value.partition('=')
+        if name not in PROVIDERS:
+            raise ValueError(f"Unknown provider {name!r}, expected one of {PROVIDERS}")
+        result[name] = cast(amount)
+    return result
+
+
+def build_profiles(latency=None, error_rate=None, jitter=0.2, scale=1.0):
+    latency = {**DEFAULT_LATENCY, **(latency or {})}
+    error_rate = error_rate or {}
+    return {name: Profile(latency[name] * scale, jitter, error_rate.get(name, 0.0)) for name in PROVIDERS}
+
+
+def start_server(profiles, host='127.0.0.1', port=0):
+    """Starts the fake providers on a background thread. Returns (server, base_url)."""
+    handler = type('Handler', (FakeProviderHandler,), {'profiles': profiles, 'counts': {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def provider_env(base_url):
+    """Environment variables that point the app at the fake providers."""
+    return {
+        'GEOBYTES_URL': f"{base_url}/GetNearbyCities",
+        'PLACES_TEXT_SEARCH_URL': f"{base_url}/v1/places:searchText",
+        'PLACES_PHOTO_URL': f"{base_url}/v1",
+        'GEMINI_API_ENDPOINT': base_url,
+        'ELEVENLABS_BASE_URL': base_url,
+        'GOOGLE_PLACES_API_KEY': 'bench',
+        'GEMINI_API_KEY': 'bench',
+        'ELEVENLABS_API_KEY': 'bench',
+    }
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--latency', action='append', metavar='PROVIDER=SECONDS',
+                        help=f"mean upstream latency per provider (defaults: {DEFAULT_LATENCY})")
+    parser.add_argument('--error-rate', action='append', metavar='PROVIDER=FRACTION',
+                        help="fraction of requests that fail with 503")
+    parser.add_argument('--jitter', type=float, default=0.2, help="latency jitter as a fraction of the mean")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplies every provider latency")
+
+
+def profiles_from_args(args):
+    return build_profiles(parse_overrides(args.latency), parse_overrides(args.error_rate),
+                          args.jitter, args.latency_scale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    server, base_url = start_server(profiles_from_args(args), args.host, args.port)
+    print(f"Fake providers on {base_url}. Point the app at them with:")
+    for key, value in provider_env(base_url).items():
+        print(f"  export {key}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,368 @@
+"""
+Load test: starts the app under gunicorn against the fake providers and
+drives simulated lobbies through join -> add_point -> chat -> leave.
+
+    python bench/run.py --lobbies 50 --participants 4 --out bench_report.json
+    python bench/run.py --baseline bench_report.json --max-regression 0.25
+    python bench/run.py --server asgi --baseline bench_report.json
+    python bench/run.py --serializer msgpack --baseline bench_report.json
+
+--server asgi runs the asyncio entry point (asgi_app.py) under uvicorn
+instead of the eventlet workers, for comparing the two. --serializer sets the
+app's SOCKETIO_SERIALIZER and makes the simulated clients decode to match.
+
+The report is JSON: run settings, throughput, and count/mean/p50/p95/p99/max
+latency (ms) for each measured path. Latencies are taken on the client side
+from the emit to the matching broadcast arriving at every other participant,
+so they include the server's fan-out. With --baseline, the run fails (exit
+status 1) if any p95 got more than --max-regression worse.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_providers import add_profile_arguments, profiles_from_args, provider_env, start_server  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS = ('join', 'point_fanout', 'chat_fanout', 'ai_first_chunk', 'ai_reply', 'places_first', 'places_update', 'photo')
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {name: [] for name in METRICS}
+        self.errors = {}
+        self.deliveries = 0
+        self.pending = {}  # (kind, key) -> (sent_at, set of clients still waiting)
+
+    def expect(self, kind, key, waiting):
+        self.pending[(kind, key)] = (time.perf_counter(), set(waiting))
+
+    def arrived(self, kind, key, client):
+        entry = self.pending.get((kind, key))
+        if entry is None or client not in entry[1]:
+            return
+        entry[1].discard(client)
+        self.samples[kind].append(time.perf_counter() - entry[0])
+        self.deliveries += 1
+        if not entry[1]:
+            del self.pending[(kind, key)]
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    ms = lambda v: None if v is None else round(v * 1000, 2)  # noqa: E731
+    return {
+        'count': len(ordered),
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+        'max_ms': ms(ordered[-1]) if ordered else None,
+    }
+
+
+class Participant:
+    def __init__(self, base_url, code, user_id, recorder, serializer='json'):
+        self.base_url = base_url
+        self.code = code
+        self.user_id = user_id
+        self.recorder = recorder
+        self.joined = asyncio.Event()
+        self.places = asyncio.Event()
+        self.details = {}
+        self.fetch = None
+        # The client only needs to know binary (msgpack) frames; json and orjson are the same text
+        self.sio = socketio.AsyncClient(reconnection=False, serializer='msgpack' if serializer == 'msgpack' else 'default')
+        self.sio.on('lobby_update', self.on_snapshot)
+        self.sio.on('lobby_patch', self.on_patch)
+        self.sio.on('travel_info_category', self.on_travel_info_category)
+        self.sio.on('ai_stream_chunk', self.on_ai_chunk)
+
+    async def on_snapshot(self, data):
+        if data.get('code', self.code) == self.code:
+            self.recorder.arrived('join', (self.code, self.user_id), self.user_id)
+            self.joined.set()
+
+    async def on_patch(self, data):
+        for op in data.get('ops', []):
+            if op['op'] == 'point_changed':
+                point = op['point']
+                self.recorder.arrived('point_fanout', (self.code, op['id'], point['lat'], point['lon']), self.user_id)
+            elif op['op'] == 'message_appended':
+                message = op['message']
+                if message.get('name') == 'AI Assistant' and message.get('stream_id'):
+                    self.recorder.arrived('ai_reply', self.code, self.user_id)
+                else:
+                    self.recorder.arrived('chat_fanout', (self.code, message.get('text')), self.user_id)
+
+    async def on_travel_info_category(self, data):
+        # places_first: the fastest category reached us; places_update: all of them did
+        if data.get('fetch') != self.fetch:
+            self.fetch = data.get('fetch')
+            self.details = {}
+        if data.get('append'):
+            self.details.setdefault(data['category'], []).extend(data['places'])
+        else:
+            self.details[data['category']] = data['places']
+        self.recorder.arrived('places_first', self.code, self.user_id)
+        if data.get('complete'):
+            self.recorder.arrived('places_update', self.code, self.user_id)
+            self.places.set()
+
+    async def on_ai_chunk(self, data):
+        self.recorder.arrived('ai_first_chunk', self.code, self.user_id)
+
+    async def connect(self):
+        await self.sio.connect(self.base_url, transports=['websocket'])
+
+    async def join(self, timeout):
+        self.recorder.expect('join', (self.code, self.user_id), {self.user_id})
+        await self.sio.emit('join_lobby', {'code': self.code, 'userId': self.user_id})
+        await asyncio.wait_for(self.joined.wait(), timeout)
+
+    async def view_photos(self, http, count):
+        """Loads the first few place photos, like a browser rendering the cards."""
+        places = [place for category in self.details.values() for place in category]
+        for place in places[:count]:
+            if not place.get('photo_url'):
+                continue
+            started = time.perf_counter()
+            async with http.get(self.base_url + place['photo_url']) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    self.recorder.error(f"photo_{resp.status}")
+                    continue
+            self.recorder.samples['photo'].append(time.perf_counter() - started)
+
+    async def leave(self):
+        await self.sio.emit('leave_lobby', {'code': self.code, 'userId': self.user_id})
+        await self.sio.disconnect()
+
+
+async def run_lobby(http, base_url, index, args, recorder):
+    async with http.post(f"{base_url}/create_lobby") as resp:
+        code = (await resp.json())['code']
+    rng = random.Random(args.seed + index)
+    people = [Participant(base_url, code, f"bench-{index}-{i}", recorder, args.serializer) for i in range(args.participants)]
+    ids = {p.user_id for p in people}
+    try:
+        for person in people:
+            await person.connect()
+            await person.join(args.timeout)
+
+        # Everyone starts somewhere around a shared region, then moves a few times
+        center = (rng.uniform(-50, 60), rng.uniform(-120, 140))
+        for move in range(args.moves):
+            for person in people:
+                point = {'lat': round(center[0] + rng.uniform(-1, 1), 6), 'lon': round(center[1] + rng.uniform(-1, 1), 6)}
+                recorder.expect('point_fanout', (code, person.user_id, point['lat'], point['lon']), ids)
+                await person.sio.emit('add_point', {'code': code, 'userId': person.user_id, 'point': point})
+                await asyncio.sleep(args.think)
+
+        recorder.expect('places_first', code, ids)
+        recorder.expect('places_update', code, ids)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.places.wait() for p in people)), args.timeout)
+        except asyncio.TimeoutError:
+            recorder.error('places_update_timeout')
+        await asyncio.gather(*(p.view_photos(http, args.photos) for p in people))
+
+        for n, person in enumerate(people):
+            text = f"bench message {n} from {person.user_id}"
+            recorder.expect('chat_fanout', (code, text), ids)
+            await person.sio.emit('chat_message', {'code': code, 'userId': person.user_id, 'text': text})
+            await asyncio.sleep(args.think)
+
+        if args.ai:
+            recorder.expect('ai_first_chunk', code, ids)
+            recorder.expect('ai_reply', code, ids)
+            asker = people[0]
+            await asker.sio.emit('chat_message', {'code': code, 'userId': asker.user_id, 'text': '@ai somewhere quiet please'})
+            deadline = time.perf_counter() + args.timeout
+            while ('ai_reply', code) in recorder.pending and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            if ('ai_reply', code) in recorder.pending:
+                recorder.error('ai_reply_timeout')
+
+        # Give the last broadcasts a moment before people walk away
+        await asyncio.sleep(args.settle)
+    except Exception as e:
+        recorder.error(type(e).__name__)
+    finally:
+        for person in people:
+            try:
+                await person.leave()
+            except Exception:
+                recorder.error('leave')
+
+
+async def drive(base_url, args, recorder):
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        gate = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with gate:
+                await run_lobby(http, base_url, i, args, recorder)
+
+        await asyncio.gather(*(one(i) for i in range(args.lobbies)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def start_app(port, provider_url, workdir, args):
+    env = dict(os.environ)
+    env.update(provider_env(provider_url))
+    env.update({
+        'PORT': str(port),
+        'WEB_CONCURRENCY': str(args.workers),
+        'LOG_LEVEL': args.log_level,
+        'PLACES_CACHE_PATH': '',  # every run starts cold
+        'TTS_CACHE_DIR': os.path.join(workdir, 'tts'),
+        'PHOTO_CACHE_DIR': os.path.join(workdir, 'photos'),
+        'ARCHIVE_PATH': os.path.join(workdir, 'archive.sqlite3'),
+        'GAZETTEER_PATH': args.gazetteer,
+        'SOCKETIO_SERIALIZER': args.serializer,
+    })
+    if args.store:
+        env['LOBBY_STORE_URL'] = args.store
+    if args.server == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', '--app-dir', ROOT, '--host', '127.0.0.1', '--port', str(port),
+               '--workers', str(args.workers), '--log-level', args.log_level.lower(), 'asgi_app:asgi']
+    else:
+        cmd = [sys.executable, '-m', 'gunicorn', '--config', os.path.join(ROOT, 'gunicorn_config.py'),
+               '--chdir', ROOT, '--bind', f"127.0.0.1:{port}", 'app:app']
+    return subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL if not args.app_output else None,
+                            stderr=subprocess.STDOUT if not args.app_output else None)
+
+
+def compare(report, baseline, max_regression):
+    """Returns a list of metrics whose p95 regressed by more than max_regression (a fraction)."""
+    regressions = []
+    for name, current in report['latency'].items():
+        before = baseline.get('latency', {}).get(name, {}).get('p95_ms')
+        now = current.get('p95_ms')
+        if before and now and now > before * (1 + max_regression):
+            regressions.append({'metric': name, 'baseline_p95_ms': before, 'p95_ms': now})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the lobby server against fake providers.")
+    parser.add_argument('--lobbies', type=int, default=20)
+    parser.add_argument('--participants', type=int, default=4, help="clients per lobby")
+    parser.add_argument('--concurrency', type=int, default=20, help="lobbies running at the same time")
+    parser.add_argument('--moves', type=int, default=3, help="add_point rounds per participant")
+    parser.add_argument('--think', type=float, default=0.05, help="pause between a client's actions (s)")
+    parser.add_argument('--settle', type=float, default=0.5, help="wait before leaving (s)")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--photos', type=int, default=5, help="place photos each client loads")
+    parser.add_argument('--no-ai', dest='ai', action='store_false', help="skip the @ai question")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--server', choices=('eventlet', 'asgi'), default='eventlet',
+                        help="eventlet workers (app.py) or uvicorn (asgi_app.py)")
+    parser.add_argument('--serializer', choices=('json', 'orjson', 'msgpack'), default='json',
+                        help="Socket.IO packet encoding (SOCKETIO_SERIALIZER)")
+    parser.add_argument('--store', default='', help="LOBBY_STORE_URL for the app (e.g. redis://localhost:6379/0)")
+    parser.add_argument('--gazetteer', default='', help="GAZETTEER_PATH for the app; empty uses the fake Geobytes")
+    parser.add_argument('--url', help="drive an already running server instead of starting one")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--app-output', action='store_true', help="show the app's output")
+    parser.add_argument('--out', help="write the JSON report here as well as to stdout")
+    parser.add_argument('--baseline', help="previous report to compare p95 latencies against")
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    providers, provider_url = start_server(profiles_from_args(args))
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    app_proc = None
+    base_url = args.url
+    try:
+        if base_url is None:
+            port = free_port()
+            app_proc = start_app(port, provider_url, workdir, args)
+            if not wait_for_port(port):
+                sys.exit("App did not start; rerun with --app-output to see why")
+            base_url = f"http://127.0.0.1:{port}"
+
+        recorder = Recorder()
+        started = time.perf_counter()
+        asyncio.run(drive(base_url, args, recorder))
+        elapsed = time.perf_counter() - started
+    finally:
+        if app_proc is not None:
+            app_proc.terminate()
+            app_proc.wait(timeout=10)
+        providers.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    sent = args.lobbies * args.participants * (args.moves + 2) + (args.lobbies if args.ai else 0)
+    report = {
+        'settings': {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'app_output')},
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'duration_s': round(elapsed, 3),
+        'throughput': {
+            'events_sent_per_s': round(sent / elapsed, 1),
+            'broadcasts_received_per_s': round(recorder.deliveries / elapsed, 1),
+        },
+        'latency': {name: summarize(samples) for name, samples in recorder.samples.items()},
+        'undelivered': sum(len(waiting) for _, waiting in recorder.pending.values()),
+        'errors': recorder.errors,
+        'provider_requests': dict(providers.RequestHandlerClass.counts),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(report, json.load(f), args.max_regression)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of the Socket.IO serializers (socket_codec): encode time and
+frame size of representative payloads, for every serializer installed.
+
+    python bench/serializers.py
+    python bench/serializers.py --places 20 --messages 100 --out serializers.json
+
+The payloads are built the way the app builds them: ranked Place records as
+sent by a places fetch, the same places as plain dicts as sent on join, and a
+lobby snapshot. Each encode goes through the server's packet class, so the
+time is what one broadcast costs the server before it is written to sockets.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Keep place_details() from touching the app's caches
+os.environ.setdefault('PLACES_CACHE_PATH', '')
+os.environ.setdefault('PHOTO_CACHE_DIR', os.path.join(tempfile.mkdtemp(prefix='bench-'), 'photos'))
+
+from fake_providers import search_places  # noqa: E402
+from places_api import place_details  # noqa: E402
+from place_ranking import rank_places  # noqa: E402
+from socket_codec import PACKET_CLASSES  # noqa: E402
+
+CENTER = {'latitude': 48.8566, 'longitude': 2.3522}
+
+
+def build_payloads(places_count, participants_count, messages_count):
+    lat, lon = CENTER['latitude'], CENTER['longitude']
+    participants = [{'lat': lat + i * 0.05, 'lon': lon - i * 0.05} for i in range(participants_count)]
+    midpoint = {'lat': lat, 'lon': lon}
+    results = search_places('restaurant', CENTER, count=places_count)['places']
+    places = rank_places([place_details(p) for p in results], participants, midpoint=midpoint, top_k=places_count)
+
+    category = {
+        'code': 'ABC123', 'city': 'Paris', 'fetch': '0' * 32, 'category': 'restaurants',
+        'label': 'Restaurants', 'index': 0, 'places': places, 'has_more': True,
+        'append': False, 'complete': False,
+    }
+    travel_info = {
+        'code': 'ABC123', 'version': '1' * 32, 'fetch': '0' * 32, 'categories': [],
+        'midpoint_details': {
+            'city': 'Paris',
+            'hotels': [place.as_dict() for place in places],
+            'attractions': [place.as_dict() for place in places],
+        },
+    }
+    snapshot = {
+        'code': 'ABC123', 'seq': 42,
+        'participants': [f"user-{i}" for i in range(participants_count)],
+        'points': {f"user-{i}": {**p, 'name': f"User {i}"} for i, p in enumerate(participants)},
+        'geometric_midpoint': midpoint, 'reachable_midpoint': midpoint,
+        'midpoint_details': {}, 'midpoint_mode': 'fair', 'weights': {},
+        'messages': [
+            {'id': i, 'name': f"User {i % participants_count}", 'text': f"Message number {i} about where to meet"}
+            for i in range(messages_count)
+        ],
+        'has_older_messages': False, 'animation': True,
+    }
+    return {'travel_info_category': category, 'travel_info_update': travel_info, 'lobby_update': snapshot}
+
+
+def measure(packet_class, event, payload, repeat):
+    def encode():
+        return packet_class(data=[event, payload]).encode()
+
+    encoded = encode()
+    size = len(encoded) if isinstance(encoded, (str, bytes)) else sum(len(part) for part in encoded)
+    # Best of 5 runs, per encode
+    seconds = min(timeit.repeat(encode, number=repeat, repeat=5)) / repeat
+    return {'bytes': size, 'encode_us': round(seconds * 1e6, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--places', type=int, default=15, help="places per category")
+    parser.add_argument('--participants', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=50, help="chat messages in the snapshot")
+    parser.add_argument('--repeat', type=int, default=2000, help="encodes per timing run")
+    parser.add_argument('--out', help="write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    report = {'settings': vars(args), 'serializers': sorted(PACKET_CLASSES), 'payloads': {}}
+    for event, payload in build_payloads(args.places, args.participants, args.messages).items():
+        results = {name: measure(cls, event, payload, args.repeat) for name, cls in PACKET_CLASSES.items()}
+        base = results['json']
+        for result in results.values():
+            result['size_vs_json'] = round(result['bytes'] / base['bytes'], 3)
+            result['speedup_vs_json'] = round(base['encode_us'] / result['encode_us'], 2)
+        report['payloads'][event] = results
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+
+# Messages kept on the lobby itself (and so in every snapshot); older ones move to the archive
+MESSAGE_BUFFER_SIZE = int(os.environ.get('MESSAGE_BUFFER_SIZE', 100))
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+
+def is_preferences_prompt(message):
+    return message.get('name') == 'AI Assistant' and "preferences" in message.get('text', '')
+
+
+def upgrade_messages(lobby):
+    """
+    Brings a lobby from before message ids up to date: numbers its messages
+    and sets the preferences_prompted flag. Does nothing once done.
+    """
+    if 'next_message_id' in lobby:
+        return
+    messages = lobby.setdefault('messages', [])
+    for i, message in enumerate(messages, 1):
+        message['id'] = i
+    lobby['next_message_id'] = len(messages) + 1
+    lobby['preferences_prompted'] = any(is_preferences_prompt(m) for m in messages)
+    lobby.setdefault('has_older_messages', False)
+
+
+def append_message(lobby, message, limit=MESSAGE_BUFFER_SIZE):
+    """
+    Gives the message the lobby's next id and appends it to the lobby's
+    ring buffer. Returns the messages pushed out of the buffer, oldest first;
+    the caller is responsible for keeping them (see LobbyArchive.append_messages).
+    """
+    upgrade_messages(lobby)
+    message['id'] = lobby['next_message_id']
+    lobby['next_message_id'] += 1
+    messages = lobby['messages']
+    messages.append(message)
+    if is_preferences_prompt(message):
+        lobby['preferences_prompted'] = True
+
+    excess = len(messages) - limit
+    if excess <= 0:
+        return []
+    overflow = messages[:excess]
+    del messages[:excess]
+    lobby['has_older_messages'] = True
+    return overflow
+
+
+def history_page(lobby, archive, code, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Returns (messages, has_more): up to limit messages with ids below `before`
+    (the newest ones if before is None), oldest first. The live buffer is
+    read first, then the archived overflow.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    messages = lobby.get('messages', [])
+    live = [m for m in messages if before is None or m.get('id', 0) < before]
+    page = live[-limit:]
+    has_more = len(live) > limit
+    if not has_more and lobby.get('has_older_messages'):
+        oldest = page[0].get('id') if page else before
+        # One extra row tells us whether there is another page after this one
+        older = archive.messages_before(code, oldest, limit - len(page) + 1)
+        has_more = len(older) > limit - len(page)
+        if has_more:
+            older = older[1:]
+        page = older + page
+    return page, has_more
@@ -0,0 +1,60 @@
+import threading
+
+
+class ConnectionRegistry:
+    """
+    Maps this process's sockets to the lobby participant they joined as, and
+    each participant back to their socket. A disconnect is resolved with one
+    lookup instead of a scan of every lobby. Sockets of other workers are not
+    known here; the lobby store stays the shared record of who is in a lobby.
+    """
+
+    def __init__(self):
+        self._sids = {}  # sid -> (lobby_code, user_id)
+        self._lobbies = {}  # lobby_code -> {user_id: sid}
+        self._lock = threading.Lock()
+
+    def bind(self, sid, lobby_code, user_id):
+        """Records that sid is user_id in lobby_code, taking over from any earlier socket of theirs."""
+        with self._lock:
+            self._unbind(sid)
+            users = self._lobbies.setdefault(lobby_code, {})
+            previous = users.get(user_id)
+            if previous is not None:
+                # e.g. a reload whose old socket hasn't timed out yet; its disconnect is then a no-op
+                self._sids.pop(previous, None)
+            users[user_id] = sid
+            self._sids[sid] = (lobby_code, user_id)
+
+    def unbind(self, sid):
+        """Forgets sid. Returns its (lobby_code, user_id), or None if it isn't the user's current socket."""
+        with self._lock:
+            return self._unbind(sid)
+
+    def release(self, sid, lobby_code, user_id):
+        """Forgets sid if it is still user_id's socket in lobby_code, e.g. when they leave it."""
+        with self._lock:
+            if self._sids.get(sid) == (lobby_code, user_id):
+                self._unbind(sid)
+
+    def _unbind(self, sid):
+        entry = self._sids.pop(sid, None)
+        if entry is None:
+            return None
+        lobby_code, user_id = entry
+        users = self._lobbies[lobby_code]
+        del users[user_id]
+        if not users:
+            del self._lobbies[lobby_code]
+        return entry
+
+    def lookup(self, sid):
+        return self._sids.get(sid)
+
+    def lobby_users(self, lobby_code):
+        """{user_id: sid} for the participants of a lobby connected to this process."""
+        with self._lock:
+            return dict(self._lobbies.get(lobby_code, {}))
+
+    def __len__(self):
+        return len(self._sids)
@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from metrics import PROVIDER_CALL_SECONDS, PROVIDER_IN_FLIGHT, PROVIDER_REJECTIONS
+
+log = logging.getLogger(__name__)
+
+# How often a coroutine waiting for a concurrency slot checks again; slots are shared with threads
+SLOT_POLL_INTERVAL = 0.01
+
+
+class ProviderUnavailable(Exception):
+    """Raised when a provider call is refused without being attempted (circuit open, queue full, rate limited)."""
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self):
+        """Takes a token if there is one. Returns (taken, now, seconds until the next token)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True, now, 0.0
+            return False, now, (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=0.0):
+        """Takes a token, waiting up to timeout seconds for one. Returns False if none came."""
+        deadline = time.monotonic() + timeout
+        while True:
+            taken, now, wait = self._take()
+            if taken:
+                return True
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout=0.0):
+        """acquire() for coroutines: waits on the event loop instead of blocking it."""
+        deadline = time.monotonic() + timeout
+        while True:
+            taken, now, wait = self._take()
+            if taken:
+                return True
+            if now + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and refuses calls for
+    reset_timeout seconds. After that a single trial call is let through
+    (half-open): success closes the circuit, failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def cancel_trial(self):
+        """Gives back an admission that never reached the upstream."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Provider:
+    """
+    Guards calls to one upstream service. Every call must pass the circuit
+    breaker, take a rate-limit token and a concurrency slot; waiting for either
+    is bounded by queue_timeout, so a degraded upstream turns into fast
+    ProviderUnavailable errors (or the caller's fallback) instead of a pile of
+    blocked green threads. Identical concurrent calls made through call() with
+    the same key share one upstream request. slot()/call() serve threads and
+    green threads; aslot()/acall() are the same limits for asyncio coroutines.
+    """
+
+    def __init__(self, name, max_concurrency=8, rate=10.0, burst=20, failure_threshold=5,
+                 reset_timeout=30.0, queue_timeout=2.0):
+        self.name = name
+        self.queue_timeout = queue_timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.bucket = TokenBucket(rate, burst)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._async_flights = {}  # key -> task shared by concurrent acall()s
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.fallbacks = 0
+
+    @contextmanager
+    def slot(self):
+        """
+        Admits one upstream call. Raises ProviderUnavailable if it is refused;
+        an exception inside the block counts as a provider failure.
+        """
+        if not self.breaker.allow():
+            self._reject('circuit_open')
+        if not self.bucket.acquire(self.queue_timeout):
+            self.breaker.cancel_trial()
+            self._reject('rate_limited')
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.breaker.cancel_trial()
+            self._reject('saturated')
+        with self._running():
+            yield
+
+    @asynccontextmanager
+    async def aslot(self):
+        """slot() for coroutines: waiting for a token or a free slot doesn't block the event loop."""
+        if not self.breaker.allow():
+            self._reject('circuit_open')
+        if not await self.bucket.acquire_async(self.queue_timeout):
+            self.breaker.cancel_trial()
+            self._reject('rate_limited')
+        if not await self._acquire_slot_async():
+            self.breaker.cancel_trial()
+            self._reject('saturated')
+        with self._running():
+            yield
+
+    async def _acquire_slot_async(self):
+        deadline = time.monotonic() + self.queue_timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+        return True
+
+    @contextmanager
+    def _running(self):
+        """Accounts for an admitted call and gives its slot back when it ends."""
+        self.in_flight += 1
+        self.calls += 1
+        PROVIDER_IN_FLIGHT.labels(self.name).inc()
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except Exception:
+            outcome = 'error'
+            self.failures += 1
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # Stopped before it had an outcome: a stream the consumer closed, a cancelled task
+            # or an eventlet Timeout. Without this a half-open trial would stay taken forever.
+            outcome = 'cancelled'
+            self.breaker.cancel_trial()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            PROVIDER_CALL_SECONDS.labels(self.name, outcome).observe(time.perf_counter() - start)
+            PROVIDER_IN_FLIGHT.labels(self.name).dec()
+            self.in_flight -= 1
+            self._slots.release()
+
+    def _reject(self, reason):
+        self.rejected += 1
+        PROVIDER_REJECTIONS.labels(self.name, reason).inc()
+        raise ProviderUnavailable(f"{self.name}: {reason.replace('_', ' ')}")
+
+    def call(self, fn, *args, key=None, fallback=None, **kwargs):
+        """
+        Runs fn(*args, **kwargs) through the provider's limits. With a key,
+        concurrent calls with the same key wait for the first one's result. If
+        the call is refused and a fallback is given, fallback() is returned
+        instead; upstream errors are re-raised.
+        """
+        if key is None:
+            return self._call(fn, args, kwargs, fallback)
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.coalesced += 1
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._call(fn, args, kwargs, fallback)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _call(self, fn, args, kwargs, fallback):
+        try:
+            with self.slot():
+                return fn(*args, **kwargs)
+        except ProviderUnavailable as e:
+            if fallback is None:
+                raise
+            self.fallbacks += 1
+            log.warning("Using fallback: %s", e, extra={'provider': self.name})
+            return fallback()
+
+    async def acall(self, fn, *args, key=None, fallback=None, **kwargs):
+        """
+        call() for coroutine functions: awaits fn(*args, **kwargs) through the
+        provider's limits. Concurrent acall()s with the same key await one shared
+        task, which a cancelled caller doesn't cancel for the others.
+        """
+        if key is None:
+            return await self._acall(fn, args, kwargs, fallback)
+
+        task = self._async_flights.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._acall(fn, args, kwargs, fallback))
+            self._async_flights[key] = task
+            task.add_done_callback(lambda _: self._async_flights.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _acall(self, fn, args, kwargs, fallback):
+        try:
+            async with self.aslot():
+                return await fn(*args, **kwargs)
+        except ProviderUnavailable as e:
+            if fallback is None:
+                raise
+            self.fallbacks += 1
+            log.warning("Using fallback: %s", e, extra={'provider': self.name})
+            return fallback()
+
+    def stats(self):
+        return {
+            'state': self.breaker.state,
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'calls': self.calls,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'coalesced': self.coalesced,
+            'fallbacks': self.fallbacks,
+        }
+
+
+def _provider_from_env(name, **defaults):
+    """Builds a Provider whose limits can be overridden with GATEWAY_<NAME>_<SETTING> variables."""
+    prefix = f"GATEWAY_{name.upper()}_"
+    settings = {}
+    for setting, default in defaults.items():
+        value = os.environ.get(prefix + setting.upper())
+        settings[setting] = type(default)(value) if value else default
+    return Provider(name, **settings)
+
+
+PROVIDERS = {
+    'geobytes': _provider_from_env('geobytes', max_concurrency=4, rate=5.0, burst=10),
+    'places': _provider_from_env('places', max_concurrency=8, rate=10.0, burst=20),
+    'photos': _provider_from_env('photos', max_concurrency=8, rate=10.0, burst=30),
+    'gemini': _provider_from_env('gemini', max_concurrency=4, rate=2.0, burst=5, queue_timeout=5.0),
+    'elevenlabs': _provider_from_env('elevenlabs', max_concurrency=4, rate=2.0, burst=5, queue_timeout=5.0),
+}
+
+
+def provider(name):
+    return PROVIDERS[name]
+
+
+def gateway_stats():
+    return {name: p.stats() for name, p in PROVIDERS.items()}
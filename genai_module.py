@@ -1,77 +1,349 @@
 import google.generativeai as genai
 import os
+import re
 import json
+import logging
+import hashlib
+import threading
 from dotenv import load_dotenv
+from ttl_cache import TTLCache
+from gateway import provider, ProviderUnavailable
+from http_pool import get_async_client, async_timeout_for
 
 load_dotenv()
 
-def get_suggestions(user_preferences, places_data):
+log = logging.getLogger(__name__)
+
+# "rest" goes through requests, which eventlet can make cooperative; the default gRPC transport blocks the hub
+GEMINI_TRANSPORT = os.environ.get("GEMINI_TRANSPORT", "rest")
+# Overrides the API host, e.g. http://127.0.0.1:8081 for the benchmark's fake providers
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT")
+
+# Answers for the same (normalized) question over the same places are reused
+SUGGESTION_CACHE = TTLCache(
+    max_entries=int(os.environ.get("SUGGESTION_CACHE_SIZE", 256)),
+    ttl=int(os.environ.get("SUGGESTION_CACHE_TTL", 3600)),
+)
+# Rendered "- name (category)" blocks, keyed by places version
+PLACES_BLOCK_CACHE = TTLCache(max_entries=128, ttl=3600)
+
+BUSY_MESSAGE = "I'm getting a lot of questions right now. Please ask me again in a moment!"
+ERROR_MESSAGE = "Sorry, I encountered a problem while thinking of a suggestion."
+
+
+class StreamInterrupted(Exception):
+    """
+    Raised by the streaming functions when the answer fails after part of it was
+    yielded. str(e) is the message that should replace the partial answer.
+    """
+
+GEMINI_MODEL = "gemini-2.5-flash-lite"
+GENERATION_CONFIG = {
+    "temperature": 0.9,
+    "top_p": 1,
+    "top_k": 1,
+    "max_output_tokens": 2048,
+}
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def build_model():
+    """Configures the SDK and builds the Gemini model. Returns None if no API key is set."""
+    google_api_key = os.environ.get("GEMINI_API_KEY")
+    if not google_api_key:
+        return None
+
+    client_options = {"api_endpoint": GEMINI_API_ENDPOINT} if GEMINI_API_ENDPOINT else None
+    genai.configure(api_key=google_api_key, transport=GEMINI_TRANSPORT, client_options=client_options)
+
+    # Set up the model
+    return genai.GenerativeModel(model_name=GEMINI_MODEL,
+                                 generation_config=GENERATION_CONFIG,
+                                 safety_settings=SAFETY_SETTINGS)
+
+
+def get_model():
+    """Returns the process-wide Gemini model, building it on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = build_model()
+    return _model
+
+
+def places_version(places_data):
+    """Stable hash of a places payload, for callers that don't track a version themselves."""
+    blob = json.dumps(places_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def normalize_preferences(text):
+    """Folds case, punctuation, whitespace and the @ai mention so equivalent questions share a cache entry."""
+    text = re.sub(r'@ai\b', ' ', text.lower())
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def render_places_block(places_data, version=None):
+    """Renders the places list for the prompt, cached per places version."""
+    version = version or places_version(places_data)
+    cached = PLACES_BLOCK_CACHE.get(version)
+    if cached is not None:
+        return cached
+
+    # Create a clean, readable list of places for the prompt
+    places_list = []
+    for category, items in places_data.items():
+        # Skip scalar entries such as the city name; only category lists hold places
+        if isinstance(items, list):
+            for item in items:
+                # Defensive check: ensure item is a dictionary before access
+                if isinstance(item, dict) and 'name' in item:
+                    places_list.append(f"- {item['name']} ({category})")
+                else:
+                    # Log if the structure is not what we expect
+                    log.warning("Skipping malformed item in %r: %r", category, item)
+
+    places_string = "\n".join(places_list)
+    PLACES_BLOCK_CACHE.set(version, places_string)
+    return places_string
+
+
+def build_prompt(user_preferences, places_data, version=None):
+    """
+    Builds the prompt parts for a suggestion request.
+    Returns (prompt_parts, None), or (None, message) when there is nothing to suggest from.
+    """
+    if not places_data or not any(places_data.values()):
+        return None, "I can't suggest any places right now. Once we have some options, ask me again!"
+
+    places_string = render_places_block(places_data, version)
+
+    if not places_string:
+        return None, "I couldn't find any valid places to suggest from. Please try again."
+
+    prompt_parts = [
+        "You are a helpful assistant for a group of friends trying to decide where to go.",
+        "Your task is to suggest the best places from a given list based on the user's stated preferences.",
+        "Do not suggest any places that are not on the provided list.",
+        "Be friendly, concise, and explain *why* you are recommending a place.",
+        "\n",
+        "Here is the list of available places:",
+        places_string,
+        "\n",
+        f"The user's preference is: '{user_preferences}'",
+        "\n",
+        "Based on this, what are your top 1-3 suggestions? Explain your choices briefly."
+    ]
+    return prompt_parts, None
+
+
+def suggestion_cache_key(user_preferences, places_data, version=None):
+    return f"{normalize_preferences(user_preferences)}|{version or places_version(places_data)}"
+
+
+def cache_suggestion(cache_key, text):
+    """Caches an answer, unless the model returned no text (e.g. a blocked response) that asking again could fix."""
+    if text and text.strip():
+        SUGGESTION_CACHE.set(cache_key, text)
+
+
+def get_suggestions(user_preferences, places_data, model=None, version=None):
     """
     Given user preferences and a list of places, returns AI-powered suggestions.
+    version identifies the places data (e.g. the lobby's midpoint_details version); it is hashed if omitted.
     """
     try:
-        google_api_key = os.environ.get("GEMINI_API_KEY")
-        if not google_api_key:
+        version = version or places_version(places_data)
+        cache_key = suggestion_cache_key(user_preferences, places_data, version)
+        cached = SUGGESTION_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+        model = model or get_model()
+        if model is None:
             return "Error: GEMINI_API_KEY not configured on the server."
-        
-        genai.configure(api_key=google_api_key)
-
-        # Set up the model
-        generation_config = {
-            "temperature": 0.9,
-            "top_p": 1,
-            "top_k": 1,
-            "max_output_tokens": 2048,
-        }
-
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        ]
-
-        model = genai.GenerativeModel(model_name="gemini-2.5-flash-lite",
-                                      generation_config=generation_config,
-                                      safety_settings=safety_settings)
-
-        if not places_data or not any(places_data.values()):
-            return "I can't suggest any places right now. Once we have some options, ask me again!"
-
-        # Create a clean, readable list of places for the prompt
-        places_list = []
-        for category, items in places_data.items():
-            if items:
-                for item in items:
-                    # Defensive check: ensure item is a dictionary before access
-                    if isinstance(item, dict) and 'name' in item:
-                        places_list.append(f"- {item['name']} ({category})")
-                    else:
-                        # Log if the structure is not what we expect
-                        print(f"Skipping malformed item in '{category}': {item}")
-        
-        places_string = "\n".join(places_list)
-
-        if not places_string:
-            return "I couldn't find any valid places to suggest from. Please try again."
-
-        prompt_parts = [
-            "You are a helpful assistant for a group of friends trying to decide where to go.",
-            "Your task is to suggest the best places from a given list based on the user's stated preferences.",
-            "Do not suggest any places that are not on the provided list.",
-            "Be friendly, concise, and explain *why* you are recommending a place.",
-            "\n",
-            "Here is the list of available places:",
-            places_string,
-            "\n",
-            f"The user's preference is: '{user_preferences}'",
-            "\n",
-            "Based on this, what are your top 1-3 suggestions? Explain your choices briefly."
-        ]
-
-        response = model.generate_content(prompt_parts)
+
+        prompt_parts, message = build_prompt(user_preferences, places_data, version)
+        if prompt_parts is None:
+            return message
+
+        # The same question about the same places, asked concurrently, is answered once
+        response = provider("gemini").call(model.generate_content, prompt_parts, key=cache_key)
+        cache_suggestion(cache_key, response.text)
         return response.text
 
+    except ProviderUnavailable as e:
+        log.warning("Suggestion refused: %s", e)
+        return BUSY_MESSAGE
+    except Exception as e:
+        log.exception("An error occurred in get_suggestions: %s", e)
+        return ERROR_MESSAGE
+
+
+def stream_suggestions(user_preferences, places_data, model=None, version=None):
+    """
+    Like get_suggestions, but yields the answer in chunks as the model generates it.
+    Any object whose generate_content(prompt, stream=True) returns an iterable of
+    objects with a .text attribute can stand in for the model. A cached answer is
+    yielded as a single chunk. A failure before any text is yielded as the
+    answer; one after it raises StreamInterrupted instead of being appended.
+    """
+    parts = []
+    try:
+        version = version or places_version(places_data)
+        cache_key = suggestion_cache_key(user_preferences, places_data, version)
+        cached = SUGGESTION_CACHE.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        model = model or get_model()
+        if model is None:
+            yield "Error: GEMINI_API_KEY not configured on the server."
+            return
+
+        prompt_parts, message = build_prompt(user_preferences, places_data, version)
+        if prompt_parts is None:
+            yield message
+            return
+
+        # The concurrency slot is held for the whole stream
+        with provider("gemini").slot():
+            for chunk in model.generate_content(prompt_parts, stream=True):
+                text = getattr(chunk, "text", "")
+                if text:
+                    parts.append(text)
+                    yield text
+        # Only complete answers are cached
+        cache_suggestion(cache_key, "".join(parts))
+
+    except ProviderUnavailable as e:
+        log.warning("Suggestion refused: %s", e)
+        failure = BUSY_MESSAGE
+    except Exception as e:
+        log.exception("An error occurred in stream_suggestions: %s", e)
+        failure = ERROR_MESSAGE
+    else:
+        return
+    if parts:
+        raise StreamInterrupted(failure)
+    yield failure
+
+
+# The SDK's async calls don't work over the REST transport, so the asyncio entry
+# point talks to the Gemini REST API directly with httpx.
+
+def gemini_rest_url(method):
+    endpoint = GEMINI_API_ENDPOINT or "generativelanguage.googleapis.com"
+    if "://" not in endpoint:
+        endpoint = f"https://{endpoint}"
+    return f"{endpoint}/v1beta/models/{GEMINI_MODEL}:{method}"
+
+
+def gemini_request(prompt_parts):
+    return {
+        "contents": [{"role": "user", "parts": [{"text": part} for part in prompt_parts]}],
+        "generationConfig": GENERATION_CONFIG,
+        "safetySettings": SAFETY_SETTINGS,
+    }
+
+
+def response_text(response):
+    """Joins the text parts of a generateContent response (or one streamed chunk of it)."""
+    candidates = response.get("candidates") or [{}]
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+def prepare_suggestion(user_preferences, places_data, version=None):
+    """
+    The checks both async suggestion functions start with.
+    Returns (cache_key, api_key, prompt_parts, answer); answer is set when it can be given right away.
+    """
+    version = version or places_version(places_data)
+    cache_key = suggestion_cache_key(user_preferences, places_data, version)
+    cached = SUGGESTION_CACHE.get(cache_key)
+    if cached is not None:
+        return cache_key, None, None, cached
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        return cache_key, None, None, "Error: GEMINI_API_KEY not configured on the server."
+    prompt_parts, message = build_prompt(user_preferences, places_data, version)
+    return cache_key, api_key, prompt_parts, message
+
+
+async def get_suggestions_async(user_preferences, places_data, version=None):
+    """get_suggestions() for the asyncio entry point."""
+    try:
+        cache_key, api_key, prompt_parts, answer = prepare_suggestion(user_preferences, places_data, version)
+        if answer is not None:
+            return answer
+
+        async def generate():
+            response = await get_async_client().post(
+                gemini_rest_url("generateContent"), json=gemini_request(prompt_parts),
+                headers={"x-goog-api-key": api_key}, timeout=async_timeout_for("gemini"),
+            )
+            response.raise_for_status()
+            return response_text(response.json())
+
+        text = await provider("gemini").acall(generate, key=cache_key)
+        cache_suggestion(cache_key, text)
+        return text
+
+    except ProviderUnavailable as e:
+        log.warning("Suggestion refused: %s", e)
+        return BUSY_MESSAGE
+    except Exception as e:
+        log.exception("An error occurred in get_suggestions_async: %s", e)
+        return ERROR_MESSAGE
+
+
+async def stream_suggestions_async(user_preferences, places_data, version=None):
+    """stream_suggestions() for the asyncio entry point, reading the server-sent event stream."""
+    parts = []
+    try:
+        cache_key, api_key, prompt_parts, answer = prepare_suggestion(user_preferences, places_data, version)
+        if answer is not None:
+            yield answer
+            return
+
+        # The concurrency slot is held for the whole stream
+        async with provider("gemini").aslot():
+            async with get_async_client().stream(
+                "POST", gemini_rest_url("streamGenerateContent"), params={"alt": "sse"},
+                json=gemini_request(prompt_parts), headers={"x-goog-api-key": api_key},
+                timeout=async_timeout_for("gemini"),
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    text = response_text(json.loads(line[5:]))
+                    if text:
+                        parts.append(text)
+                        yield text
+        # Only complete answers are cached
+        cache_suggestion(cache_key, "".join(parts))
+
+    except ProviderUnavailable as e:
+        log.warning("Suggestion refused: %s", e)
+        failure = BUSY_MESSAGE
     except Exception as e:
-        print(f"An error occurred in get_suggestions: {e}")
-        return "Sorry, I encountered a problem while thinking of a suggestion."
+        log.exception("An error occurred in stream_suggestions_async: %s", e)
+        failure = ERROR_MESSAGE
+    else:
+        return
+    if parts:
+        raise StreamInterrupted(failure)
+    yield failure
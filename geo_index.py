@@ -0,0 +1,279 @@
+import csv
+import itertools
+import logging
+import mmap
+import os
+import struct
+from heapq import heappush, heappushpop
+from math import radians, cos, sin, asin, sqrt
+
+log = logging.getLogger(__name__)
+
+# On-disk layout of a compiled gazetteer index:
+#   header   : magic, version, record count, byte offset of the names blob, and the
+#              min_population it was compiled with
+#   records  : count * (x, y, z, lat, lon) float32, in implicit KD-tree order
+#   name offs: (count + 1) * uint32 offsets into the names blob
+#   names    : utf-8 "Name, Country" strings, back to back
+MAGIC = b'GZIX'
+VERSION = 2
+HEADER = struct.Struct('<4sIIII')
+RECORD_FIELDS = 5
+EARTH_RADIUS_KM = 6371.0
+
+# GeoNames dump columns (cities500.txt, cities1000.txt, ... are tab separated, no header)
+GEONAMES_COLUMNS = {'name': 1, 'lat': 4, 'lon': 5, 'country': 8, 'population': 14}
+HEADER_ALIASES = {
+    'name': ('name', 'asciiname', 'city'),
+    'lat': ('latitude', 'lat'),
+    'lon': ('longitude', 'lon', 'lng'),
+    'country': ('country', 'country_name', 'country_code', 'countrycode'),
+    'population': ('population', 'pop'),
+}
+
+
+def _to_unit_vector(lat, lon):
+    lat, lon = radians(lat), radians(lon)
+    return cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+
+
+def _chord_to_km(chord):
+    """Converts a straight-line distance on the unit sphere to great-circle kilometres."""
+    return 2 * asin(min(1.0, chord / 2)) * EARTH_RADIUS_KM
+
+
+def _km_to_chord(km):
+    angle = min(km / EARTH_RADIUS_KM, 3.141592653589793)
+    return 2 * sin(angle / 2)
+
+
+def read_gazetteer(csv_path, min_population=0):
+    """
+    Reads a GeoNames dump or a CSV with a header row (name, country, latitude,
+    longitude and optionally population) into a list of places.
+    """
+    places = []
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        first_line = f.readline()
+        f.seek(0)
+        delimiter = '\t' if '\t' in first_line else ','
+        quoting = csv.QUOTE_NONE if delimiter == '\t' else csv.QUOTE_MINIMAL
+        reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
+
+        first_row = next(reader, [])
+        header = [c.strip().lower() for c in first_row]
+        columns = {}
+        for field, aliases in HEADER_ALIASES.items():
+            for alias in aliases:
+                if alias in header:
+                    columns[field] = header.index(alias)
+                    break
+
+        rows = reader
+        if not {'name', 'lat', 'lon'} <= columns.keys():
+            # No usable header: treat the file as a raw GeoNames dump, first row included as read
+            columns = GEONAMES_COLUMNS
+            rows = itertools.chain([first_row], reader)
+
+        for row in rows:
+            try:
+                name = row[columns['name']].strip()
+                lat = float(row[columns['lat']])
+                lon = float(row[columns['lon']])
+            except (IndexError, ValueError):
+                continue
+            if not name:
+                continue
+            country = row[columns['country']].strip() if 'country' in columns and len(row) > columns['country'] else ''
+            population = 0
+            if 'population' in columns:
+                try:
+                    population = int(float(row[columns['population']] or 0))
+                except (IndexError, ValueError):
+                    population = 0
+            if population < min_population:
+                continue
+            places.append((f"{name}, {country}" if country else name, lat, lon))
+    return places
+
+
+def _build_kd_order(records):
+    """Reorders records in place so that every sub-range's median is its KD-tree node."""
+    stack = [(0, len(records), 0)]
+    while stack:
+        lo, hi, depth = stack.pop()
+        if hi - lo <= 1:
+            continue
+        axis = depth % 3
+        records[lo:hi] = sorted(records[lo:hi], key=lambda r: r[0][axis])
+        mid = (lo + hi) // 2
+        stack.append((lo, mid, depth + 1))
+        stack.append((mid + 1, hi, depth + 1))
+
+
+def compile_index(csv_path, index_path, min_population=0):
+    """Compiles a gazetteer file into a memory-mappable KD-tree index."""
+    places = read_gazetteer(csv_path, min_population=min_population)
+    records = [(_to_unit_vector(lat, lon), lat, lon, name) for name, lat, lon in places]
+    _build_kd_order(records)
+
+    coords = bytearray()
+    names = bytearray()
+    offsets = [0]
+    for (x, y, z), lat, lon, name in records:
+        coords += struct.pack('<5f', x, y, z, lat, lon)
+        names += name.encode('utf-8')
+        offsets.append(len(names))
+
+    names_offset = HEADER.size + len(coords) + 4 * len(offsets)
+    tmp_path = f"{index_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), names_offset, min_population))
+        f.write(coords)
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(names)
+    # Atomic swap so concurrently starting workers never map a half-written file
+    os.replace(tmp_path, index_path)
+    log.info("Compiled gazetteer index %s with %d places", index_path, len(records))
+    return len(records)
+
+
+def read_header(buffer):
+    """(magic, version, count, names_offset, min_population) of an index; version 1 files had no min_population."""
+    if len(buffer) < HEADER.size:
+        return b'', 0, 0, 0, 0
+    return HEADER.unpack_from(buffer, 0)
+
+
+def _index_matches(index_path, min_population):
+    """True if the index at index_path is of this version and was compiled with min_population."""
+    try:
+        with open(index_path, 'rb') as f:
+            magic, version, _, _, built_min_population = read_header(f.read(HEADER.size))
+    except OSError:
+        return False
+    return magic == MAGIC and version == VERSION and built_min_population == min_population
+
+
+class GeoIndex:
+    """Nearest-place queries over a compiled, memory-mapped gazetteer index."""
+
+    def __init__(self, index_path):
+        self._file = open(index_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, names_offset, min_population = read_header(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{index_path} is not a gazetteer index (version {VERSION})")
+        self.count = count
+        self.min_population = min_population
+        coords_end = HEADER.size + count * RECORD_FIELDS * 4
+        view = memoryview(self._mmap)
+        self._coords = view[HEADER.size:coords_end].cast('f')
+        self._name_offsets = view[coords_end:names_offset].cast('I')
+        self._names = view[names_offset:]
+
+    def __len__(self):
+        return self.count
+
+    def _place(self, i, chord=None):
+        base = i * RECORD_FIELDS
+        start, end = self._name_offsets[i], self._name_offsets[i + 1]
+        place = {
+            'lat': round(self._coords[base + 3], 6),
+            'lon': round(self._coords[base + 4], 6),
+            'name': bytes(self._names[start:end]).decode('utf-8'),
+        }
+        if chord is not None:
+            place['distance_km'] = _chord_to_km(chord)
+        return place
+
+    def _search(self, lat, lon, k, max_km=None):
+        """Returns up to k (squared chord, index) pairs, nearest first."""
+        if not self.count or k <= 0:
+            return []
+        q = _to_unit_vector(lat, lon)
+        coords = self._coords
+        best = []  # max-heap on squared distance via negation
+        bound = _km_to_chord(max_km) ** 2 if max_km is not None else float('inf')
+
+        stack = [(0, self.count, 0, 0.0)]
+        while stack:
+            lo, hi, depth, plane_d2 = stack.pop()
+            # plane_d2 is re-checked here because the bound may have tightened since the push
+            if lo >= hi or plane_d2 > bound:
+                continue
+            mid = (lo + hi) // 2
+            base = mid * RECORD_FIELDS
+            dx = coords[base] - q[0]
+            dy = coords[base + 1] - q[1]
+            dz = coords[base + 2] - q[2]
+            d2 = dx * dx + dy * dy + dz * dz
+            if d2 <= bound:
+                if len(best) < k:
+                    heappush(best, (-d2, mid))
+                else:
+                    heappushpop(best, (-d2, mid))
+                if len(best) == k:
+                    bound = -best[0][0]
+
+            axis = depth % 3
+            diff = q[axis] - coords[base + axis]
+            near, far = ((mid + 1, hi), (lo, mid)) if diff > 0 else ((lo, mid), (mid + 1, hi))
+            # Far side is pushed first so the near side is explored (and tightens the bound) first
+            if diff * diff <= bound:
+                stack.append((far[0], far[1], depth + 1, diff * diff))
+            stack.append((near[0], near[1], depth + 1, 0.0))
+
+        return sorted((-neg_d2, i) for neg_d2, i in best)
+
+    def nearest(self, lat, lon, max_km=None):
+        """Returns the closest place as {'lat', 'lon', 'name'}, or None."""
+        found = self._search(lat, lon, 1, max_km)
+        return self._place(found[0][1]) if found else None
+
+    def k_nearest(self, lat, lon, k, max_km=None):
+        """Returns up to k places nearest first, each with a 'distance_km' field."""
+        return [self._place(i, sqrt(d2)) for d2, i in self._search(lat, lon, k, max_km)]
+
+    def close(self):
+        self._coords.release()
+        self._name_offsets.release()
+        self._names.release()
+        self._mmap.close()
+        self._file.close()
+
+
+def load_index(csv_path, index_path=None, min_population=0):
+    """
+    Opens the compiled index for a gazetteer, (re)compiling it first if it is
+    missing, older than the gazetteer file, or compiled with another
+    min_population or format version. Returns None if neither exists.
+    """
+    index_path = index_path or f"{csv_path}.idx"
+    try:
+        csv_mtime = os.path.getmtime(csv_path) if csv_path and os.path.exists(csv_path) else None
+        if csv_mtime is not None and (
+            not os.path.exists(index_path) or os.path.getmtime(index_path) < csv_mtime
+            or not _index_matches(index_path, min_population)
+        ):
+            compile_index(csv_path, index_path, min_population=min_population)
+        if not os.path.exists(index_path):
+            return None
+        index = GeoIndex(index_path)
+        if index.min_population != min_population:
+            log.warning("Gazetteer index %s was compiled with min_population=%d, not %d, and %s is missing",
+                        index_path, index.min_population, min_population, csv_path)
+        return index
+    except Exception as e:
+        log.warning("Could not load gazetteer index %s: %s", index_path, e)
+        return None
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python geo_index.py <gazetteer.csv|cities500.txt> [index_path]")
+        sys.exit(1)
+    index = load_index(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    if index is not None:
+        print(f"{len(index)} places indexed; nearest to London: {index.nearest(51.5074, -0.1278)}")
@@ -1,6 +1,10 @@
+import multiprocessing
 import os
 
 wsgi_app = "app:app"
 worker_class = 'eventlet'
-workers = 1
+# Several workers only make sense when lobbies live in a shared store (see LOBBY_STORE_URL);
+# with the in-memory store every room must stay in a single process.
+_shared_store = os.environ.get('LOBBY_STORE_URL', '').startswith('redis')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() if _shared_store else 1))
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
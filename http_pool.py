@@ -0,0 +1,63 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds for each outbound provider
+TIMEOUTS = {
+    'places': (3.05, float(os.environ.get('PLACES_TIMEOUT', 10))),
+    'geobytes': (3.05, float(os.environ.get('GEOBYTES_TIMEOUT', 5))),
+    'elevenlabs': (3.05, float(os.environ.get('ELEVENLABS_TIMEOUT', 30))),
+    'photos': (3.05, float(os.environ.get('PHOTOS_TIMEOUT', 10))),
+    'gemini': (3.05, float(os.environ.get('GEMINI_TIMEOUT', 30))),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))
+
+_session = None
+_async_client = None
+
+
+def get_session():
+    """
+    Returns the process-wide requests session. Connections are kept alive and
+    pooled per host, so repeated calls to a provider skip the TCP/TLS handshake.
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+    return _session
+
+
+def timeout_for(provider):
+    return TIMEOUTS.get(provider, DEFAULT_TIMEOUT)
+
+
+def get_async_client():
+    """
+    The asyncio counterpart of get_session() for the ASGI entry point: one
+    process-wide httpx.AsyncClient with the same keep-alive pooling.
+    """
+    global _async_client
+    if _async_client is None:
+        import httpx
+        limits = httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+        _async_client = httpx.AsyncClient(limits=limits, timeout=async_timeout_for(None))
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def async_timeout_for(provider):
+    """timeout_for() as an httpx.Timeout."""
+    import httpx
+    connect, read = timeout_for(provider)
+    return httpx.Timeout(read, connect=connect)
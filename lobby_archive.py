@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+CODECS = ('json', 'zlib')
+
+
+class LobbyArchive:
+    """
+    Archive of lobby snapshots in a single SQLite file.
+    Every archive event adds a row; the `latest` table maps each lobby code to
+    its newest row, so restoring a lobby is one primary-key lookup no matter
+    how many archives exist. Snapshots are stored as compact JSON, optionally
+    zlib-compressed. WAL mode with synchronous=NORMAL means commits only
+    fsync at checkpoints, so archive writes are batched onto disk.
+
+    Retention: only the newest keep_per_code snapshots and keep_messages
+    stored messages of each lobby are kept (None keeps all), and expire()
+    drops lobbies that haven't been archived for a while.
+    """
+
+    def __init__(self, path, compression='zlib', level=6, keep_per_code=None, keep_messages=None):
+        if compression not in CODECS:
+            raise ValueError(f"Unknown archive compression {compression!r}, expected one of {CODECS}")
+        self.path = path
+        self.codec = compression
+        self.level = level
+        self.keep_per_code = keep_per_code
+        self.keep_messages = keep_messages
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.created = not os.path.exists(path)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS archives ("
+            "id INTEGER PRIMARY KEY, code TEXT NOT NULL, archived_at REAL NOT NULL, "
+            "codec TEXT NOT NULL, data BLOB NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS latest ("
+            "code TEXT PRIMARY KEY, archive_id INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        # Chat messages that overflowed a lobby's live buffer, for paging back through history
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "code TEXT NOT NULL, id INTEGER NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (code, id)) WITHOUT ROWID"
+        )
+        # For pruning a lobby's older snapshots and finding expired lobbies
+        self._db.execute("CREATE INDEX IF NOT EXISTS archives_code ON archives (code, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS archives_archived_at ON archives (archived_at)")
+
+    def _encode(self, lobby):
+        blob = json.dumps(lobby, separators=(',', ':')).encode('utf-8')
+        if self.codec == 'zlib':
+            blob = zlib.compress(blob, self.level)
+        return blob
+
+    @staticmethod
+    def _decode(codec, blob):
+        if codec == 'zlib':
+            blob = zlib.decompress(blob)
+        return json.loads(blob)
+
+    def save(self, code, lobby, archived_at=None):
+        """Appends a snapshot of the lobby, points the code at it and prunes its oldest ones. Returns the row id."""
+        blob = self._encode(lobby)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                cur = self._db.execute(
+                    "INSERT INTO archives (code, archived_at, codec, data) VALUES (?, ?, ?, ?)",
+                    (code, archived_at or time.time(), self.codec, blob),
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO latest (code, archive_id) VALUES (?, ?)",
+                    (code, cur.lastrowid),
+                )
+                if self.keep_per_code:
+                    self._db.execute(
+                        "DELETE FROM archives WHERE code = ? AND id < ("
+                        "SELECT MIN(id) FROM (SELECT id FROM archives WHERE code = ? ORDER BY id DESC LIMIT ?))",
+                        (code, code, self.keep_per_code),
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return cur.lastrowid
+
+    def load(self, code):
+        """Returns the newest archived state of a lobby, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT a.codec, a.data FROM latest l JOIN archives a ON a.id = l.archive_id WHERE l.code = ?",
+                (code,),
+            ).fetchone()
+        return self._decode(*row) if row else None
+
+    def latest_id(self, code):
+        """Row id of the newest snapshot of a lobby, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT archive_id FROM latest WHERE code = ?", (code,)).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, code):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM latest WHERE code = ?", (code,)).fetchone() is not None
+
+    def history(self, code):
+        """Returns (row id, archived_at) for every snapshot kept of a lobby, oldest first."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, archived_at FROM archives WHERE code = ? ORDER BY id", (code,)
+            ).fetchall()
+
+    def append_messages(self, code, messages):
+        """Stores chat messages (dicts with an 'id') that left a lobby's live buffer, dropping its oldest beyond keep_messages."""
+        rows = [(code, m['id'], json.dumps(m, separators=(',', ':'))) for m in messages]
+        with self._lock:
+            # One transaction: in autocommit mode every row would be committed on its own
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO messages (code, id, data) VALUES (?, ?, ?)", rows)
+                if self.keep_messages:
+                    self._db.execute(
+                        "DELETE FROM messages WHERE code = ? AND id < ("
+                        "SELECT MIN(id) FROM (SELECT id FROM messages WHERE code = ? ORDER BY id DESC LIMIT ?))",
+                        (code, code, self.keep_messages),
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def expire(self, max_age, keep=None):
+        """
+        Deletes the snapshots and stored messages of every lobby last archived
+        more than max_age seconds ago, except those for which keep(code) is
+        true (e.g. lobbies that are live again). Returns how many were deleted.
+        """
+        cutoff = time.time() - max_age
+        with self._lock:
+            codes = [row[0] for row in self._db.execute(
+                "SELECT a.code FROM archives a JOIN latest l ON l.archive_id = a.id WHERE a.archived_at < ?",
+                (cutoff,),
+            )]
+        codes = [code for code in codes if keep is None or not keep(code)]
+        expired = 0
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for code in codes:
+                    # Skip lobbies archived again since they were selected
+                    cur = self._db.execute(
+                        "DELETE FROM latest WHERE code = ? AND archive_id IN "
+                        "(SELECT id FROM archives WHERE code = ? AND archived_at < ?)",
+                        (code, code, cutoff),
+                    )
+                    if cur.rowcount:
+                        self._db.execute("DELETE FROM archives WHERE code = ?", (code,))
+                        self._db.execute("DELETE FROM messages WHERE code = ?", (code,))
+                        expired += 1
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return expired
+
+    def messages_before(self, code, before_id=None, limit=50):
+        """Returns up to limit stored messages with ids below before_id, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM messages WHERE code = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (code, before_id if before_id is not None else 2 ** 62, limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def import_json_dir(self, directory):
+        """Imports legacy `<CODE>_<timestamp>.json` archive files, oldest first."""
+        try:
+            names = [f for f in os.listdir(directory) if f.endswith('.json')]
+        except FileNotFoundError:
+            return 0
+        paths = sorted((os.path.join(directory, f) for f in names), key=os.path.getmtime)
+        imported = 0
+        for path in paths:
+            code = os.path.basename(path).split('_', 1)[0]
+            try:
+                with open(path, 'r') as f:
+                    self.save(code, json.load(f), archived_at=os.path.getmtime(path))
+                imported += 1
+            except (OSError, ValueError) as e:
+                log.warning("Skipping legacy archive %s: %s", path, e)
+        return imported
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,765 @@
+"""
+Lobby state and event handling shared by both servers, app.py (Flask-SocketIO
+on eventlet) and asgi_app.py: configuration, the lobby store, archive and
+caches, and the functions that check event data, change a lobby and build its
+patches. Nothing here builds a Socket.IO server or a scheduler; each server
+does the emitting and scheduling around these functions.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import string
+import time
+
+from dotenv import load_dotenv
+
+from audio_cache import AudioCache
+from chat_history import append_message, history_page, is_preferences_prompt, upgrade_messages, HISTORY_PAGE_SIZE
+from gateway import provider
+from geo_index import load_index
+from http_pool import get_session, timeout_for
+from lobby_archive import LobbyArchive
+from lobby_store import create_lobby_store
+from lobby_tiers import HibernationTier
+from log_config import configure_logging
+from meeting_point import meeting_point, MODES as MIDPOINT_MODES
+from metrics import ACTIVE_LOBBIES, HIBERNATED_LOBBIES
+from places_api import CATEGORY_CATALOG, PLACES_CATEGORIES
+
+load_dotenv()
+configure_logging()
+log = logging.getLogger(__name__)
+
+# Lobby state lives in LOBBY_STORE_URL (e.g. redis://...) when set, so several workers can share
+# rooms; Socket.IO then relays broadcasts between workers through the same Redis.
+LOBBY_STORE_URL = os.environ.get('LOBBY_STORE_URL', '')
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or (LOBBY_STORE_URL if LOBBY_STORE_URL.startswith('redis') else None)
+# Engine.IO heartbeat: a client that stops answering pings is disconnected after
+# SOCKETIO_PING_INTERVAL + SOCKETIO_PING_TIMEOUT seconds, which starts its reconnect grace window
+SOCKETIO_PING_INTERVAL = int(os.environ.get('SOCKETIO_PING_INTERVAL', 25))
+SOCKETIO_PING_TIMEOUT = int(os.environ.get('SOCKETIO_PING_TIMEOUT', 20))
+
+# Storage for lobbies (in-memory unless LOBBY_STORE_URL points at Redis)
+LOBBIES = create_lobby_store(LOBBY_STORE_URL)
+ARCHIVE_DIR = "archived_lobbies"
+ARCHIVE_DELAY = 20  # seconds to wait before archiving inactive lobbies
+CLEANUP_INTERVAL = 300  # seconds between sweeps of per-process lobby caches
+# A participant whose socket closed keeps their place and point this long, so a reload or a
+# dropped connection resumes the session; then they are removed like a leaver
+RECONNECT_GRACE = float(os.environ.get('RECONNECT_GRACE', 30))
+# Every worker stamps its connected participants as seen this often. Participants nobody stamped
+# for STALE_PARTICIPANT_AFTER (e.g. their worker died) are evicted; keep it above RECONNECT_GRACE.
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 30))
+STALE_PARTICIPANT_AFTER = float(os.environ.get('STALE_PARTICIPANT_AFTER', 3 * HEARTBEAT_INTERVAL))
+LEFT_PARTICIPANTS_LIMIT = int(os.environ.get('LEFT_PARTICIPANTS_LIMIT', 20))  # most recent leavers kept per lobby
+DEFAULT_MIDPOINT_MODE = os.environ.get('DEFAULT_MIDPOINT_MODE', 'centroid')  # centroid, median or minimax
+AI_STREAMING = os.environ.get('AI_STREAMING', '1') != '0'  # stream AI replies chunk by chunk
+PLACES_FETCHES = {}  # Per-lobby coalescing state for places fetches
+LOBBY_DERIVED = {}  # Per-lobby midpoint/town cache, versioned by a hash of the points
+TOWN_DEBOUNCE = float(os.environ.get('TOWN_DEBOUNCE', 0.25))  # quiet window (s) before a Geobytes town lookup
+PLACES_DEBOUNCE = float(os.environ.get('PLACES_DEBOUNCE', 1.0))  # quiet window (s) before fetching places
+ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_API_KEY', '')
+ELEVENLABS_BASE_URL = os.environ.get('ELEVENLABS_BASE_URL', 'https://api.elevenlabs.io')
+TTS_VOICE_ID = os.environ.get('TTS_VOICE_ID', 'L1aJrPa7pLJEyYlh3Ilq')
+TTS_MODEL_ID = os.environ.get('TTS_MODEL_ID', 'eleven_multilingual_v2')
+# Synthesized speech, content-addressed on (voice, model, text) and bounded to TTS_CACHE_MAX_BYTES
+AUDIO_CACHE = AudioCache(
+    os.environ.get('TTS_CACHE_DIR', 'cache/tts'),
+    max_bytes=int(os.environ.get('TTS_CACHE_MAX_BYTES', 200 * 1024 * 1024)),
+)
+os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+# Retention: snapshots and overflowed chat messages kept per lobby, and how long a lobby that
+# isn't archived again is kept at all (0 for any of them keeps everything)
+ARCHIVE_KEEP_PER_LOBBY = int(os.environ.get('ARCHIVE_KEEP_PER_LOBBY', 5))
+ARCHIVE_MESSAGES_PER_LOBBY = int(os.environ.get('ARCHIVE_MESSAGES_PER_LOBBY', 5000))
+ARCHIVE_MAX_AGE = float(os.environ.get('ARCHIVE_MAX_AGE_DAYS', 90)) * 24 * 3600
+
+# Archived lobbies live in one SQLite file indexed by code; older per-lobby JSON files are imported once
+ARCHIVE = LobbyArchive(
+    os.environ.get('ARCHIVE_PATH', os.path.join(ARCHIVE_DIR, 'archive.sqlite3')),
+    compression=os.environ.get('ARCHIVE_COMPRESSION', 'zlib'),
+    keep_per_code=ARCHIVE_KEEP_PER_LOBBY or None,
+    keep_messages=ARCHIVE_MESSAGES_PER_LOBBY or None,
+)
+if ARCHIVE.created:
+    imported = ARCHIVE.import_json_dir(ARCHIVE_DIR)
+    if imported:
+        log.info("Imported %d legacy lobby archives into %s", imported, ARCHIVE.path)
+
+# Idle lobbies are archived and kept here in compact form, up to LOBBY_MEMORY_BUDGET bytes,
+# so a quick rejoin doesn't have to go to disk
+HIBERNATED = HibernationTier(budget_bytes=int(os.environ.get('LOBBY_MEMORY_BUDGET', 16 * 1024 * 1024)))
+
+# Local gazetteer (GeoNames dump or CSV) used for nearest-town lookups; Geobytes is the fallback
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', 'data/cities500.txt')
+GAZETTEER_INDEX_PATH = os.environ.get('GAZETTEER_INDEX_PATH') or None
+GAZETTEER_MIN_POPULATION = int(os.environ.get('GAZETTEER_MIN_POPULATION', 0))
+GAZETTEER_MAX_KM = float(os.environ['GAZETTEER_MAX_KM']) if os.environ.get('GAZETTEER_MAX_KM') else None
+GEOBYTES_URL = os.environ.get('GEOBYTES_URL', 'http://getnearbycities.geobytes.com/GetNearbyCities')
+GEO_INDEX = load_index(GAZETTEER_PATH, GAZETTEER_INDEX_PATH, min_population=GAZETTEER_MIN_POPULATION)
+
+
+def generate_lobby_code(length=8):
+    """Generate a unique, random, all-caps alphanumeric code."""
+    while True:
+        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+        if not lobby_exists(code):
+            return code
+
+
+def lobby_exists(lobby_code):
+    """True if the lobby is active, hibernated or archived. Unlike rehydrate_lobby, nothing is loaded."""
+    return lobby_code in LOBBIES or lobby_code in HIBERNATED or lobby_code in ARCHIVE
+
+
+def new_lobby():
+    return {
+        'participants': {},
+        'points': {},
+        'left_participants': {},
+        'seq': 0,
+        'midpoint_mode': DEFAULT_MIDPOINT_MODE,
+        'weights': {}
+    }
+
+
+def event_participant(data, action):
+    """The (lobby_code, user_id) a join or leave event is about, or None if either is missing."""
+    lobby_code = data.get('code')
+    user_id = data.get('userId')
+    if not lobby_code or not user_id:
+        log.warning("%s failed: missing lobby code or user id", action)
+        return None
+    return lobby_code, user_id
+
+
+def join_participant(lobby_code, lobby, user_id, sid):
+    """Seats a user who joined on sid. Returns the ops telling the others, none for a resumed session."""
+    joined = add_participant(lobby, user_id, sid)
+    log.info("User joined" if joined else "User reconnected", extra={'lobby': lobby_code, 'user': user_id})
+    return [{'op': 'participant_joined', 'id': user_id}] if joined else []
+
+
+def lobby_emptied(lobby_code, lobby):
+    """True once the last participant is gone, when the lobby should be scheduled for archiving."""
+    if lobby['participants']:
+        return False
+    log.info("Lobby empty, archiving in %ss", ARCHIVE_DELAY, extra={'lobby': lobby_code})
+    return True
+
+
+def add_participant(lobby, user_id, sid):
+    """Seats a user on a socket. Returns False if they were still a participant (a resumed session)."""
+    resumed = user_id in lobby['participants']
+    lobby['participants'][user_id] = {'id': user_id, 'sid': sid, 'seen': time.time()}
+    lobby['left_participants'].pop(user_id, None)
+    return not resumed
+
+
+def mark_disconnected(lobby, user_id, sid):
+    """Clears the socket of a participant whose connection closed. Returns False if they are on another socket now."""
+    participant = lobby['participants'].get(user_id)
+    if participant is None or participant.get('sid') != sid:
+        return False
+    participant['sid'] = None
+    participant['seen'] = time.time()
+    return True
+
+
+def evict_disconnected(lobby_code, lobby, user_id):
+    """Removes a participant who is still disconnected. Returns the patch ops."""
+    participant = lobby['participants'].get(user_id)
+    if participant is None or participant.get('sid') is not None:
+        return []
+    log.info("Evicting disconnected user", extra={'lobby': lobby_code, 'user': user_id})
+    return remove_participant(lobby_code, lobby, user_id)
+
+
+def needs_heartbeat(lobby, users, now):
+    """Whether a heartbeat has participants of the lobby to stamp (users, {user_id: sid}) or evict."""
+    return lobby is not None and bool(users or stale_participants(lobby, now))
+
+
+def heartbeat_lobby(lobby_code, lobby, users, now):
+    """Stamps the participants in users as seen and removes the stale ones. Returns the patch ops."""
+    refresh_participants(lobby, users, now)
+    return evict_stale(lobby_code, lobby, now)
+
+
+def refresh_participants(lobby, users, now):
+    """Stamps the participants in users ({user_id: sid}) as seen, if they are still on that socket."""
+    for user_id, sid in users.items():
+        participant = lobby['participants'].get(user_id)
+        if participant is not None and participant.get('sid') == sid:
+            participant['seen'] = now
+
+
+def stale_participants(lobby, now):
+    """Participants nobody stamped within STALE_PARTICIPANT_AFTER (or ever, for lobbies saved before stamps)."""
+    return [
+        user_id for user_id, participant in lobby['participants'].items()
+        if now - participant.get('seen', 0) > STALE_PARTICIPANT_AFTER
+    ]
+
+
+def evict_stale(lobby_code, lobby, now):
+    """Removes the stale participants. Returns the patch ops."""
+    ops = []
+    for user_id in stale_participants(lobby, now):
+        log.info("Evicting stale user", extra={'lobby': lobby_code, 'user': user_id})
+        ops += remove_participant(lobby_code, lobby, user_id)
+    return ops
+
+
+def remove_participant(lobby_code, lobby, user_id):
+    """Removes a user and their point from the lobby. Returns the patch ops describing it."""
+    ops = []
+    if user_id in lobby['participants']:
+        del lobby['participants'][user_id]
+        # Only the most recent LEFT_PARTICIPANTS_LIMIT leavers are remembered
+        left = lobby['left_participants']
+        left.pop(user_id, None)
+        left[user_id] = {'id': user_id, 'left_at': time.time()}
+        while len(left) > LEFT_PARTICIPANTS_LIMIT:
+            del left[next(iter(left))]
+        log.info("User left", extra={'lobby': lobby_code, 'user': user_id})
+        ops.append({'op': 'participant_left', 'id': user_id})
+    if user_id in lobby['points']:
+        del lobby['points'][user_id]
+        log.debug("Point removed", extra={'lobby': lobby_code, 'user': user_id})
+        ops.append({'op': 'point_removed', 'id': user_id})
+    return ops
+
+
+def set_point(lobby_code, lobby, user_id, point):
+    """Places or moves a participant's point. Returns the patch ops."""
+    if user_id not in lobby['participants']:
+        return []
+    lobby['points'][user_id] = point
+    log.debug("Point added", extra={'lobby': lobby_code, 'user': user_id})
+    return [{'op': 'point_changed', 'id': user_id, 'point': point}]
+
+
+def parse_midpoint_mode(lobby_code, data):
+    """The mode a set_midpoint_mode event asks for, or None if it isn't one of meeting_point.MODES."""
+    mode = data.get('mode')
+    if mode not in MIDPOINT_MODES:
+        log.info("Ignoring unknown midpoint mode %r", mode, extra={'lobby': lobby_code})
+        return None
+    return mode
+
+
+def set_midpoint_mode(lobby, mode):
+    """Switches the lobby's midpoint mode. Returns the patch ops, none if it already uses it."""
+    if lobby.get('midpoint_mode') == mode:
+        return []
+    lobby['midpoint_mode'] = mode
+    return [{'op': 'mode_changed', 'mode': mode}]
+
+
+def parse_weight(data):
+    """The positive weight a set_weight event asks for, or None if it isn't one."""
+    try:
+        weight = float(data.get('weight', 1.0))
+    except (TypeError, ValueError):
+        return None
+    return weight if weight > 0 else None
+
+
+def set_weight(lobby, user_id, weight):
+    """Sets a participant's weight. Returns the patch ops."""
+    if user_id not in lobby['participants']:
+        return []
+    lobby.setdefault('weights', {})[user_id] = weight
+    return [{'op': 'weight_changed', 'id': user_id, 'weight': weight}]
+
+
+def queue_places_fetch(lobby_code, *args):
+    """Records the arguments of the next places fetch, superseding any fetch already queued or running."""
+    fetch = PLACES_FETCHES.setdefault(lobby_code, {'generation': 0})
+    fetch['generation'] += 1
+    fetch['args'] = args
+
+
+def is_current_places_fetch(lobby_code, generation):
+    """False once a newer fetch was queued for the lobby than the one with this generation."""
+    fetch = PLACES_FETCHES.get(lobby_code)
+    if generation is None or (fetch is not None and fetch['generation'] == generation):
+        return True
+    # The points moved while we were fetching; a newer fetch will report instead
+    log.info("Dropped stale places data", extra={'lobby': lobby_code, 'generation': generation})
+    return False
+
+
+def places_categories(lobby):
+    """The categories shown for a lobby, in display order, with whether more can be loaded."""
+    tokens = lobby.get('midpoint_page_tokens', {})
+    return [
+        {'key': key, 'label': CATEGORY_CATALOG[key][0], 'has_more': bool(tokens.get(key))}
+        for key in PLACES_CATEGORIES
+    ]
+
+
+def travel_info(lobby):
+    """The travel_info_update payload: every category the lobby has results for."""
+    return {
+        'midpoint_details': lobby.get('midpoint_details'),
+        'fetch': lobby.get('midpoint_details_fetch'),
+        'categories': places_categories(lobby),
+    }
+
+
+def places_category_payload(lobby_code, lobby, category, places, append=False, complete=False):
+    return {
+        'code': lobby_code,
+        'city': lobby['midpoint_details'].get('city'),
+        'fetch': lobby.get('midpoint_details_fetch'),
+        'category': category,
+        'label': CATEGORY_CATALOG[category][0],
+        'index': PLACES_CATEGORIES.index(category),
+        'places': places,
+        'has_more': bool(lobby['midpoint_page_tokens'].get(category)),
+        'append': append,
+        'complete': complete,
+    }
+
+
+def accept_places_page(lobby_code, lobby, fetch_id, search, category, places, next_page_token, version, complete):
+    """Stores one category of a places fetch. Returns False if the lobby is gone or its points changed."""
+    if lobby is None:
+        return False
+    # Another worker may have moved the points since this fetch was scheduled
+    if version is not None and derived_version(lobby) != version:
+        log.info("Dropped places data: points changed", extra={'lobby': lobby_code})
+        return False
+    store_places_page(lobby, fetch_id, search, category, places, next_page_token, version, complete=complete)
+    return True
+
+
+def store_places_page(lobby, fetch_id, search, category, places, next_page_token, version=None, complete=False):
+    """Records one category from a places fetch; its first category replaces the previous fetch's results."""
+    if lobby.get('midpoint_details_fetch') != fetch_id:
+        lobby['midpoint_details'] = {'city': search['city']}
+        lobby['midpoint_page_tokens'] = {}
+        lobby['midpoint_details_fetch'] = fetch_id
+        lobby['midpoint_search'] = search
+    # Lobby state stays plain JSON; the room is sent the records themselves
+    lobby['midpoint_details'][category] = [place.as_dict() for place in places]
+    lobby['midpoint_page_tokens'][category] = next_page_token
+    # Only a complete set of categories gets a version for the AI caches to key on
+    lobby['midpoint_details_version'] = (version or fetch_id) if complete else None
+
+
+def append_places_page(lobby, category, places, next_page_token):
+    """Adds a further page of a category, as loaded by load_more_places."""
+    lobby['midpoint_details'].setdefault(category, []).extend(place.as_dict() for place in places)
+    lobby['midpoint_page_tokens'][category] = next_page_token
+    # The places changed, so let the AI caches hash the new set
+    lobby['midpoint_details_version'] = None
+
+
+def add_preferences_prompt(lobby_code, lobby):
+    """Has the AI ask for the group's preferences, once per lobby. Returns the message, or None if already asked."""
+    upgrade_messages(lobby)
+    if lobby['preferences_prompted']:
+        return None
+    return add_message(lobby_code, lobby, {
+        'name': 'AI Assistant',
+        'text': "A long list of fun attractions! Let me know your preferences, and I can suggest the best spots for your group."
+    })
+
+
+def more_places_request(lobby, category):
+    """(page_token, search, fetch_id) to load the next page of a category with, or None if there is none."""
+    if lobby is None:
+        return None
+    page_token = lobby.get('midpoint_page_tokens', {}).get(category)
+    search = lobby.get('midpoint_search')
+    if not page_token or not search:
+        return None
+    return page_token, search, lobby['midpoint_details_fetch']
+
+
+def accept_more_places(lobby, category, page_token, fetch_id, places, next_page_token):
+    """Appends a loaded page. Returns False if a new search replaced the results, or the page is loaded already."""
+    if lobby is None:
+        return False
+    if lobby.get('midpoint_details_fetch') != fetch_id or lobby['midpoint_page_tokens'].get(category) != page_token:
+        return False
+    append_places_page(lobby, category, places, next_page_token)
+    return True
+
+
+def archive_after_delay(lobby_code):
+    """Hibernates a lobby whose participants are all gone."""
+    # Re-read the lobby: someone may have rejoined through another worker
+    with LOBBIES.lock(lobby_code):
+        if is_idle(LOBBIES.get(lobby_code)):
+            hibernate_lobby(lobby_code)
+
+
+def is_idle(lobby):
+    """True if the lobby exists and none of its participants is connected."""
+    return lobby is not None and all(u.get('sid') is None for u in lobby['participants'].values())
+
+
+def expire_archives():
+    """Deletes lobbies not archived for ARCHIVE_MAX_AGE from the archive, unless they are live again."""
+    if not ARCHIVE_MAX_AGE:
+        return
+    expired = ARCHIVE.expire(ARCHIVE_MAX_AGE, keep=LOBBIES.__contains__)
+    if expired:
+        log.info("Expired %d archived lobbies older than %.0f days", expired, ARCHIVE_MAX_AGE / 86400)
+
+
+def cached_lobby_codes():
+    return set(PLACES_FETCHES) | set(LOBBY_DERIVED)
+
+
+def drop_lobby_caches(lobby_code, scheduler):
+    """Forgets an inactive lobby's places fetch and midpoints, unless a fetch or lookup is still pending on scheduler."""
+    if ('places', lobby_code) not in scheduler and ('town', lobby_code) not in scheduler:
+        PLACES_FETCHES.pop(lobby_code, None)
+        LOBBY_DERIVED.pop(lobby_code, None)
+
+
+def derived_version(lobby):
+    """Returns a stable hash of everything the midpoint depends on: points, mode and weights."""
+    blob = json.dumps(
+        [lobby['points'], lobby.get('midpoint_mode', DEFAULT_MIDPOINT_MODE), lobby.get('weights', {})],
+        sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def get_derived_state(lobby_code, lobby):
+    """
+    Returns the lobby's midpoints, recomputing them only when the points, mode or weights changed.
+    The second value is True when they were recomputed.
+
+    This runs inside lobby transactions, so it never waits on the network. If
+    the nearest town isn't known locally, the state comes back uncached with
+    'town_pending' set and no reachable midpoint; each server's
+    schedule_town_lookup then looks the town up once the lobby lock is released.
+    """
+    derived, version = cached_derived_state(lobby_code, lobby)
+    if derived is not None:
+        return derived, False
+    geometric_midpoint = lobby_midpoint(lobby)
+    if geometric_midpoint is None:
+        return remember_derived_state(lobby_code, version, None, None), True
+    town = indexed_town(geometric_midpoint, GAZETTEER_MAX_KM)
+    if town is None:
+        return {'version': version, 'geometric_midpoint': geometric_midpoint,
+                'reachable_midpoint': None, 'town_pending': True}, False
+    return remember_derived_state(lobby_code, version, geometric_midpoint, town), True
+
+
+def cached_derived_state(lobby_code, lobby):
+    """The lobby's cached midpoints, or None if its points, mode or weights changed; and their current version."""
+    version = derived_version(lobby)
+    derived = LOBBY_DERIVED.get(lobby_code)
+    if derived is not None and derived['version'] == version:
+        return derived, version
+    return None, version
+
+
+def remember_derived_state(lobby_code, version, geometric_midpoint, reachable_midpoint):
+    derived = {
+        'version': version,
+        'geometric_midpoint': geometric_midpoint,
+        'reachable_midpoint': reachable_midpoint,
+    }
+    LOBBY_DERIVED[lobby_code] = derived
+    return derived
+
+
+def lobby_midpoint(lobby):
+    """The geometric meeting point of the lobby's points, or None with fewer than two."""
+    user_ids = list(lobby['points'].keys())
+    if len(user_ids) < 2:
+        return None
+    points = [lobby['points'][u] for u in user_ids]
+    weights = [lobby.get('weights', {}).get(u, 1.0) for u in user_ids]
+    return calculate_midpoint(points, lobby.get('midpoint_mode', DEFAULT_MIDPOINT_MODE), weights)
+
+
+def lobby_snapshot(lobby_code, lobby, animation=True, derived=None):
+    """Builds the full lobby state sent on join and resync."""
+    if derived is None:
+        derived, _ = get_derived_state(lobby_code, lobby)
+    return {
+        'code': lobby_code,
+        'seq': lobby.get('seq', 0),
+        'participants': list(lobby['participants'].keys()),
+        'points': lobby['points'],
+        'geometric_midpoint': derived['geometric_midpoint'],
+        'reachable_midpoint': derived['reachable_midpoint'],
+        'midpoint_details': {},  # Sent separately via travel_info_update
+        'midpoint_mode': lobby.get('midpoint_mode', DEFAULT_MIDPOINT_MODE),
+        'weights': lobby.get('weights', {}),
+        'messages': lobby.get('messages', []),
+        'has_older_messages': lobby.get('has_older_messages', False),
+        'animation': animation
+    }
+
+
+def awaits_town(lobby_code, lobby, derived):
+    """True if the lobby's points are still those of the pending midpoint in derived."""
+    cached, version = cached_derived_state(lobby_code, lobby)
+    return cached is None and version == derived['version']
+
+
+def next_patch(lobby_code, lobby, ops, derived, points_changed, animation=True):
+    """Numbers a patch with the lobby's next seq, adding midpoint_changed if the points changed."""
+    ops = list(ops)
+    if points_changed:
+        ops.append({
+            'op': 'midpoint_changed',
+            'geometric_midpoint': derived['geometric_midpoint'],
+            'reachable_midpoint': derived['reachable_midpoint']
+        })
+
+    lobby['seq'] = lobby.get('seq', 0) + 1
+    return {
+        'code': lobby_code,
+        'seq': lobby['seq'],
+        'ops': ops,
+        'animation': animation
+    }
+
+
+def places_fetch_args(lobby, derived):
+    """The schedule_places_fetch arguments for new midpoints, or None without a town to search around."""
+    geometric_midpoint = derived['geometric_midpoint']
+    reachable_midpoint = derived['reachable_midpoint']
+    if not (reachable_midpoint and geometric_midpoint):
+        return None
+    return (reachable_midpoint['name'], geometric_midpoint, reachable_midpoint,
+            derived['version'], list(lobby['points'].values()))
+
+
+def indexed_town(midpoint, max_km=None):
+    """The nearest town in the local gazetteer index, within max_km if given, or None."""
+    if GEO_INDEX is None:
+        return None
+    return GEO_INDEX.nearest(midpoint['lat'], midpoint['lon'], max_km=max_km) or None
+
+
+def find_closest_town_remote(midpoint):
+    lat = midpoint['lat']
+    lon = midpoint['lon']
+
+    try:
+        # If Geobytes is down or saturated, take the nearest indexed town, however far
+        return provider('geobytes').call(
+            geobytes_nearest_town, lat, lon,
+            key=(round(lat, 4), round(lon, 4)), fallback=lambda: indexed_town(midpoint),
+        )
+    except Exception as e:
+        log.warning("Geobytes lookup failed at %s,%s: %s", lat, lon, e)
+        return None
+
+
+def geobytes_nearest_town(lat, lon):
+    resp = get_session().get(GEOBYTES_URL, params=geobytes_params(lat, lon), timeout=timeout_for('geobytes'))
+    resp.raise_for_status()
+    return town_from_geobytes(resp.json())
+
+
+def geobytes_params(lat, lon):
+    return {
+        'latitude': lat,
+        'longitude': lon,
+        'radius': 100000,         
+        'limit': 1            
+    }
+
+
+def town_from_geobytes(data):
+    """Turns a GetNearbyCities response into a town dict, or None if it is empty."""
+    if not data:
+        return None
+
+    # Data is an array of arrays; pick first
+    first = data[0]
+    # According to spec:
+    # [0] = bearing
+    # [1] = city name
+    # [2] = region/state code
+    # [3] = country name
+    # [4] = direction
+    # [5] = nautical miles
+    # [6] = internet country code
+    # [7] = kilometres
+    # [8] = latitude
+    # [9] = geobytes location code
+    # [10] = longitude
+    # [11] = miles
+    # [12] = region or state name
+    city_name = first[1]
+    country = first[3]
+    lat2 = first[8]
+    lon2 = first[10]
+    return {
+        'lat': lat2,
+        'lon': lon2,
+        'name': f"{city_name}, {country}"
+    }
+
+
+def calculate_midpoint(points, mode='centroid', weights=None):
+    """
+    Calculates the meeting point of a list of points.
+    Points are dictionaries with 'lat' and 'lon'. mode is 'centroid' (spherical
+    centroid), 'median' (least total travel) or 'minimax' (least travel for
+    whoever goes furthest); weights scale each participant's travel.
+    """
+    return meeting_point(points, mode, weights)
+
+
+def save_lobby_to_archive(lobby_code):
+    """Saves a lobby's state to the archive and removes it from memory. Returns the archive id, or None."""
+    lobby_data = LOBBIES.get(lobby_code)
+    if lobby_data is None:
+        log.warning("Cannot save: lobby not found", extra={'lobby': lobby_code})
+        return None
+
+    try:
+        archive_id = ARCHIVE.save(lobby_code, lobby_data)
+        log.info("Lobby archived as entry %s", archive_id, extra={'lobby': lobby_code})
+        del LOBBIES[lobby_code]  # remove from active memory
+        PLACES_FETCHES.pop(lobby_code, None)
+        LOBBY_DERIVED.pop(lobby_code, None)
+        return archive_id
+    except Exception as e:
+        log.exception("Error saving lobby: %s", e, extra={'lobby': lobby_code})
+        return None
+
+
+def hibernate_lobby(lobby_code):
+    """Archives an idle lobby and moves it from the active store into the compact tier."""
+    lobby_data = LOBBIES.get(lobby_code)
+    archive_id = save_lobby_to_archive(lobby_code) if lobby_data is not None else None
+    if archive_id is None:
+        return False
+    HIBERNATED.put(lobby_code, lobby_data, archive_id)
+    log.info("Lobby hibernated", extra={'lobby': lobby_code, 'tier_bytes': HIBERNATED.stats()['bytes']})
+    return True
+
+
+def rehydrate_lobby(lobby_code):
+    """
+    Makes sure a lobby is in the active store, restoring it from the compact
+    tier or the archive if needed. Returns False if the lobby doesn't exist.
+    """
+    if not lobby_code:
+        return False
+    if lobby_code in LOBBIES:
+        return True
+    with LOBBIES.lock(lobby_code):
+        if lobby_code in LOBBIES:
+            return True
+        # Another worker may have restored, changed and re-archived the lobby since we hibernated it
+        lobby_data = HIBERNATED.pop(lobby_code, ARCHIVE.latest_id(lobby_code)) if lobby_code in HIBERNATED else None
+        if lobby_data is not None:
+            LOBBIES.save(lobby_code, lobby_data)
+            log.info("Lobby rehydrated from compact tier", extra={'lobby': lobby_code})
+            return True
+        return load_archived_lobby(lobby_code)
+
+
+def load_archived_lobby(lobby_code):
+    """Loads the most recent archive of a lobby into active memory."""
+    try:
+        lobby_data = ARCHIVE.load(lobby_code)
+    except Exception as e:
+        log.exception("Error loading lobby: %s", e, extra={'lobby': lobby_code})
+        return False
+
+    if lobby_data is None:
+        log.info("No archived sessions found", extra={'lobby': lobby_code})
+        return False
+
+    LOBBIES.save(lobby_code, lobby_data)
+    log.info("Lobby restored from archive", extra={'lobby': lobby_code})
+    return True
+    
+def parse_chat_message(data):
+    """The message a chat_message event posts, or None if its text is blank."""
+    text = data.get('text', '').strip()
+    if not text:
+        return None
+    return {'name': data.get('name', 'Anon'), 'text': text}
+
+
+def post_chat_message(lobby_code, lobby, message):
+    """
+    Adds a participant's message. Returns the patch ops, and the (places_data,
+    places_version) for the AI to answer with if the message is meant for it, else None.
+    """
+    add_message(lobby_code, lobby, message)
+    ai_request = None
+    if is_for_ai(lobby, message['text']):
+        ai_request = (lobby.get('midpoint_details', {}), lobby.get('midpoint_details_version'))
+    return [{'op': 'message_appended', 'message': message}], ai_request
+
+
+def post_ai_message(lobby_code, lobby, text, stream_id=None):
+    """Adds the AI's answer; stream_id ties it to the provisional message streamed before. Returns the patch ops."""
+    message = {'name': 'AI Assistant', 'text': text}
+    if stream_id is not None:
+        message['stream_id'] = stream_id
+    add_message(lobby_code, lobby, message)
+    return [{'op': 'message_appended', 'message': message}]
+
+
+def ai_stream_start(lobby_code, stream_id):
+    """The ai_stream_start payload announcing a streamed AI answer."""
+    return {'code': lobby_code, 'id': stream_id, 'name': 'AI Assistant'}
+
+
+def ai_stream_chunk(lobby_code, stream_id, text):
+    return {'code': lobby_code, 'id': stream_id, 'text': text}
+
+
+def is_for_ai(lobby, text):
+    """True if the newest message mentions @ai or answers the AI's prompt for preferences."""
+    if "@ai" in text.lower():
+        return True
+    messages = lobby['messages']
+    return len(messages) > 1 and is_preferences_prompt(messages[-2])
+
+
+def add_message(lobby_code, lobby, message):
+    """Appends a chat message to the lobby's buffer, moving any overflow into the archive."""
+    overflow = append_message(lobby, message)
+    if overflow:
+        ARCHIVE.append_messages(lobby_code, overflow)
+    return message
+
+
+def read_history(lobby_code, before=None, limit=HISTORY_PAGE_SIZE):
+    """Returns a page of chat history for a live or archived lobby, or None if there is no such lobby."""
+    lobby = LOBBIES.get(lobby_code) or ARCHIVE.load(lobby_code)
+    if lobby is None:
+        return None
+    messages, has_more = history_page(lobby, ARCHIVE, lobby_code, before, limit)
+    return {'code': lobby_code, 'messages': messages, 'has_more': has_more}
+
+
+def parse_history_request(data):
+    """The (before, limit) of a load_history event, or None if they aren't numbers."""
+    try:
+        before = int(data['before']) if data.get('before') is not None else None
+        return before, int(data.get('limit', HISTORY_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return None
+
+
+# Cheap gauges are read when /metrics is scraped
+ACTIVE_LOBBIES.set_function(lambda: len(LOBBIES))
+HIBERNATED_LOBBIES.set_function(lambda: len(HIBERNATED))
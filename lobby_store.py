@@ -0,0 +1,209 @@
+import asyncio
+import json
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+
+
+class LobbyStore:
+    """
+    Where lobby state lives. Handlers read a lobby with get(), mutate the
+    returned dict and write it back with save(), holding lock() around the
+    whole read-modify-write so concurrent workers don't lose updates.
+    """
+
+    # True when calls wait on the network; coroutines then make them from a worker thread
+    blocking_io = False
+
+    def get(self, code):
+        raise NotImplementedError
+
+    def save(self, code, lobby):
+        raise NotImplementedError
+
+    def add(self, code, lobby):
+        """Stores a new lobby; returns False if the code is already taken."""
+        raise NotImplementedError
+
+    def delete(self, code):
+        raise NotImplementedError
+
+    def codes(self):
+        raise NotImplementedError
+
+    def lock(self, code):
+        raise NotImplementedError
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def __getitem__(self, code):
+        lobby = self.get(code)
+        if lobby is None:
+            raise KeyError(code)
+        return lobby
+
+    def __setitem__(self, code, lobby):
+        self.save(code, lobby)
+
+    def __delitem__(self, code):
+        self.delete(code)
+
+    def __len__(self):
+        return len(self.codes())
+
+
+class InMemoryLobbyStore(LobbyStore):
+    """Keeps lobbies as dicts in this process. get() returns the live object, so save() is free."""
+
+    def __init__(self):
+        self._lobbies = {}
+        # Held only while in use, so lookups of unknown codes leave nothing behind
+        self._locks = weakref.WeakValueDictionary()
+        self._locks_guard = threading.Lock()
+
+    def get(self, code):
+        return self._lobbies.get(code)
+
+    def save(self, code, lobby):
+        self._lobbies[code] = lobby
+
+    def add(self, code, lobby):
+        if code in self._lobbies:
+            return False
+        self._lobbies[code] = lobby
+        return True
+
+    def delete(self, code):
+        self._lobbies.pop(code, None)
+
+    def codes(self):
+        return list(self._lobbies.keys())
+
+    def __contains__(self, code):
+        return code in self._lobbies
+
+    def lock(self, code):
+        with self._locks_guard:
+            lock = self._locks.get(code)
+            if lock is None:
+                lock = self._locks[code] = threading.RLock()
+        return lock
+
+
+class RedisLobbyStore(LobbyStore):
+    """
+    Keeps lobbies as JSON documents in Redis so every worker process sees the
+    same rooms. Any client speaking the redis-py API works, e.g. fakeredis
+    for local runs.
+    """
+
+    blocking_io = True
+
+    def __init__(self, url=None, client=None, prefix='lobby:', lock_timeout=10):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self.index_key = f"{prefix}codes"
+        self.lock_timeout = lock_timeout
+
+    def _key(self, code):
+        return f"{self.prefix}{code}"
+
+    def get(self, code):
+        raw = self.redis.get(self._key(code))
+        return json.loads(raw) if raw is not None else None
+
+    def save(self, code, lobby):
+        pipe = self.redis.pipeline()
+        pipe.set(self._key(code), json.dumps(lobby, separators=(',', ':')))
+        pipe.sadd(self.index_key, code)
+        pipe.execute()
+
+    def add(self, code, lobby):
+        created = self.redis.set(self._key(code), json.dumps(lobby, separators=(',', ':')), nx=True)
+        if created:
+            self.redis.sadd(self.index_key, code)
+        return bool(created)
+
+    def delete(self, code):
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key(code))
+        pipe.srem(self.index_key, code)
+        pipe.execute()
+
+    def codes(self):
+        return [c.decode() if isinstance(c, bytes) else c for c in self.redis.smembers(self.index_key)]
+
+    def __contains__(self, code):
+        return bool(self.redis.exists(self._key(code)))
+
+    def lock(self, code):
+        # Not thread-local: asyncio callers take and release it from different worker threads
+        return self.redis.lock(f"{self.prefix}lock:{code}", timeout=self.lock_timeout,
+                               blocking_timeout=self.lock_timeout, thread_local=False)
+
+
+def create_lobby_store(url=None):
+    """Returns a Redis-backed store for a redis:// URL, otherwise an in-memory one."""
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisLobbyStore(url)
+    return InMemoryLobbyStore()
+
+
+@contextmanager
+def lobby_transaction(store, code):
+    """Locks a lobby and yields its state (None if it doesn't exist), saving it back on exit."""
+    with store.lock(code):
+        lobby = store.get(code)
+        yield lobby
+        if lobby is not None:
+            store.save(code, lobby)
+
+
+async def run_store(store, fn, *args):
+    """
+    Calls fn(*args), a store operation, from a coroutine. Redis calls (and a
+    contended Redis lock) would block the event loop, so they run in a worker
+    thread; in-memory ones are instant and run inline.
+    """
+    if store.blocking_io:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+_async_locks = weakref.WeakValueDictionary()  # (store id, code) -> asyncio.Lock, dropped once unused
+
+
+@asynccontextmanager
+async def async_lobby_lock(store, code):
+    """
+    store.lock() for asyncio handlers, which may await (emit, fetch) while they
+    hold a lobby. Coroutines first queue on an asyncio.Lock per lobby: the
+    in-memory store's RLock belongs to the event loop's thread, so it can't
+    keep them apart. The store lock still guards against other processes and
+    threads, and is waited for through run_store.
+    """
+    key = (id(store), code)
+    lock = _async_locks.get(key)
+    if lock is None:
+        lock = _async_locks[key] = asyncio.Lock()
+    async with lock:
+        store_lock = store.lock(code)
+        await run_store(store, store_lock.__enter__)
+        try:
+            yield
+        finally:
+            await run_store(store, store_lock.__exit__, None, None, None)
+
+
+@asynccontextmanager
+async def async_lobby_transaction(store, code):
+    """lobby_transaction() for asyncio handlers; see async_lobby_lock."""
+    async with async_lobby_lock(store, code):
+        lobby = await run_store(store, store.get, code)
+        yield lobby
+        if lobby is not None:
+            await run_store(store, store.save, code, lobby)
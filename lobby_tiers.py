@@ -0,0 +1,72 @@
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+
+class HibernationTier:
+    """
+    Compact copies of idle lobbies (zlib-compressed JSON) held between the
+    active store and the archive. The tier is bounded by a byte budget; when
+    it is exceeded the least recently hibernated lobbies are dropped, which is
+    safe because every lobby is archived before it is hibernated.
+
+    Each copy remembers the archive row it was saved as. The tier belongs to
+    one process while the archive (and a Redis lobby store) may be shared, so
+    another worker can archive a newer state; pop() then refuses the stale copy.
+    """
+
+    def __init__(self, budget_bytes=16 * 1024 * 1024, level=6):
+        self.budget_bytes = budget_bytes
+        self.level = level
+        self.bytes_used = 0
+        self.evictions = 0
+        self.stale = 0  # copies refused because another process archived the lobby since
+        self._blobs = OrderedDict()  # code -> (archive id, compressed lobby)
+        self._lock = threading.Lock()
+
+    def put(self, code, lobby, archive_id):
+        """Holds a lobby that was just archived as row archive_id."""
+        blob = zlib.compress(json.dumps(lobby, separators=(',', ':')).encode('utf-8'), self.level)
+        with self._lock:
+            old = self._blobs.pop(code, None)
+            if old is not None:
+                self.bytes_used -= len(old[1])
+            self._blobs[code] = (archive_id, blob)
+            self.bytes_used += len(blob)
+            while self.bytes_used > self.budget_bytes and self._blobs:
+                _, (_, dropped) = self._blobs.popitem(last=False)
+                self.bytes_used -= len(dropped)
+                self.evictions += 1
+
+    def pop(self, code, latest_archive_id):
+        """
+        Removes a lobby from the tier and returns it, or None if it isn't here.
+        A copy saved as an older archive row than latest_archive_id is dropped
+        and None returned, so the caller loads the archive instead.
+        """
+        with self._lock:
+            entry = self._blobs.pop(code, None)
+            if entry is None:
+                return None
+            archive_id, blob = entry
+            self.bytes_used -= len(blob)
+        if archive_id != latest_archive_id:
+            self.stale += 1
+            return None
+        return json.loads(zlib.decompress(blob))
+
+    def __contains__(self, code):
+        return code in self._blobs
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def stats(self):
+        return {
+            'lobbies': len(self._blobs),
+            'bytes': self.bytes_used,
+            'budget_bytes': self.budget_bytes,
+            'evictions': self.evictions,
+            'stale': self.stale,
+        }
@@ -0,0 +1,94 @@
+import numpy as np
+
+MODES = ('centroid', 'median', 'minimax')
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_unit_vectors(points):
+    """Converts a list of {'lat', 'lon'} dicts to an (n, 3) array of unit vectors."""
+    coords = np.radians(np.array([[p['lat'], p['lon']] for p in points], dtype=float).reshape(-1, 2))
+    lat, lon = coords[:, 0], coords[:, 1]
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def from_unit_vector(v):
+    lon = np.arctan2(v[1], v[0])
+    lat = np.arctan2(v[2], np.hypot(v[0], v[1]))
+    return {'lat': float(np.degrees(lat)), 'lon': float(np.degrees(lon))}
+
+
+def angular_distances(vecs, x):
+    """Great-circle angles (radians) from every row of vecs to the unit vector x."""
+    return np.arccos(np.clip(vecs @ x, -1.0, 1.0))
+
+
+def _normalize(v, fallback):
+    norm = np.linalg.norm(v)
+    # The points cancel out (e.g. two antipodes): no meaningful direction, keep the fallback
+    return v / norm if norm > 1e-12 else fallback
+
+
+def centroid(vecs, weights):
+    """Weighted spherical centroid: the normalized mean of the unit vectors."""
+    return _normalize(weights @ vecs, vecs[0])
+
+
+def geometric_median(vecs, weights, iterations=100, tol=1e-10):
+    """
+    Point minimising the weighted sum of great-circle distances (Weiszfeld
+    iteration, re-projected onto the sphere after every step).
+    """
+    x = centroid(vecs, weights)
+    for _ in range(iterations):
+        d = angular_distances(vecs, x)
+        # A participant sitting on the current estimate would divide by zero; cap their pull
+        inv = weights / np.maximum(d, 1e-12)
+        x_new = _normalize(inv @ vecs, x)
+        if np.linalg.norm(x_new - x) < tol:
+            return x_new
+        x = x_new
+    return x
+
+
+def minimax(vecs, weights, iterations=500):
+    """
+    Point minimising the largest weighted great-circle distance, i.e. the
+    fairest spot for whoever travels furthest. Repeatedly steps towards the
+    currently worst-off participant with a shrinking step (Badoiu-Clarkson).
+    """
+    x = centroid(vecs, weights)
+    best, best_cost = x, np.max(weights * angular_distances(vecs, x))
+    for t in range(1, iterations + 1):
+        cost = weights * angular_distances(vecs, x)
+        worst = int(np.argmax(cost))
+        if cost[worst] < best_cost:
+            best, best_cost = x, cost[worst]
+        x = _normalize(x + (vecs[worst] - x) / (t + 1), x)
+    return best
+
+
+SOLVERS = {
+    'centroid': centroid,
+    'median': geometric_median,
+    'minimax': minimax,
+}
+
+
+def meeting_point(points, mode='centroid', weights=None):
+    """
+    Computes the meeting point of a list of {'lat', 'lon'} dicts.
+    weights (same order as points) scales how much each participant's travel counts.
+    """
+    if not points:
+        return None
+    if mode not in SOLVERS:
+        raise ValueError(f"Unknown meeting point mode {mode!r}, expected one of {MODES}")
+    vecs = to_unit_vectors(points)
+    w = np.ones(len(points)) if weights is None else np.asarray(weights, dtype=float)
+    return from_unit_vector(SOLVERS[mode](vecs, w))
+
+
+def travel_distances_km(points, midpoint):
+    """Great-circle distance in km from each point to the midpoint."""
+    return angular_distances(to_unit_vectors(points), to_unit_vectors([midpoint])[0]) * EARTH_RADIUS_KM
@@ -0,0 +1,86 @@
+import functools
+import inspect
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from socketio.packet import EVENT, Packet
+
+# Socket handlers should finish in milliseconds; provider calls take up to the read timeouts
+EVENT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+PROVIDER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PAYLOAD_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+SOCKET_EVENT_SECONDS = Histogram(
+    'socket_event_seconds', 'Time spent handling an incoming Socket.IO event', ['event'],
+    buckets=EVENT_BUCKETS,
+)
+SOCKET_EVENT_ERRORS = Counter(
+    'socket_event_errors_total', 'Socket.IO event handlers that raised', ['event'],
+)
+PROVIDER_CALL_SECONDS = Histogram(
+    'provider_call_seconds', 'Duration of outbound provider calls', ['provider', 'outcome'],
+    buckets=PROVIDER_BUCKETS,
+)
+PROVIDER_REJECTIONS = Counter(
+    'provider_rejections_total', 'Provider calls refused by the gateway', ['provider', 'reason'],
+)
+PROVIDER_IN_FLIGHT = Gauge(
+    'provider_in_flight', 'Outbound provider calls currently running', ['provider'],
+)
+PAYLOAD_BYTES = Histogram(
+    'socket_payload_bytes', 'Size of encoded outgoing Socket.IO events', ['event'],
+    buckets=PAYLOAD_BUCKETS,
+)
+ACTIVE_LOBBIES = Gauge('active_lobbies', 'Lobbies held in the live store')
+ACTIVE_PARTICIPANTS = Gauge('active_participants', 'Connected participants across live lobbies')
+HIBERNATED_LOBBIES = Gauge('hibernated_lobbies', 'Lobbies held in the compact in-memory tier')
+SCHEDULER_PENDING = Gauge('scheduler_pending', 'Deadlines waiting in the background scheduler')
+
+
+def observe_event(name):
+    """Decorator recording a Socket.IO handler's latency (and failures) under `name`; async handlers too."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    SOCKET_EVENT_ERRORS.labels(name).inc()
+                    raise
+                finally:
+                    SOCKET_EVENT_SECONDS.labels(name).observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                SOCKET_EVENT_ERRORS.labels(name).inc()
+                raise
+            finally:
+                SOCKET_EVENT_SECONDS.labels(name).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class MeteredPacket(Packet):
+    """
+    Socket.IO packet that records the size of every outgoing event. The size is
+    taken from the encoding the server does anyway, so nothing is serialised twice;
+    text, binary (msgpack) and multi-part binary packets are all counted.
+    """
+
+    def encode(self):
+        encoded = super().encode()
+        if self.packet_type == EVENT and self.data:
+            size = len(encoded) if isinstance(encoded, (str, bytes)) else sum(len(part) for part in encoded)
+            PAYLOAD_BYTES.labels(self.data[0]).observe(size)
+        return encoded
+
+
+def render_metrics():
+    """Returns the current metrics in the Prometheus text format, with its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,165 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+# Largest height (px) of each size the proxy serves; every variant is cut from one upstream fetch
+PHOTO_VARIANTS = {
+    'thumb': 160,
+    'card': 400,
+    'large': 1200,
+}
+DEFAULT_VARIANT = 'card'
+SOURCE_HEIGHT = max(PHOTO_VARIANTS.values())
+
+
+class PhotoCache:
+    """
+    Disk cache for place photos. A photo is known by a short id (a hash of its
+    Places resource name); the first request for any size fetches the largest
+    one once and writes every variant from it. Ids are evicted as a whole,
+    least recently used first, once the directory grows past max_bytes. The
+    id -> resource name mapping is kept in a small side file that is part of
+    the id's entry: it counts towards max_bytes and is evicted with the
+    variants, including for ids whose photo was never requested.
+    """
+
+    def __init__(self, directory, max_bytes=500 * 1024 * 1024, quality=82):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self._photos = OrderedDict()  # id -> {'name' or variant: file size}, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def photo_id(resource_name):
+        return hashlib.sha256(resource_name.encode('utf-8')).hexdigest()[:32]
+
+    def variant_path(self, photo_id, variant):
+        return os.path.join(self.directory, f"{photo_id}.{variant}.jpg")
+
+    def _name_path(self, photo_id):
+        return os.path.join(self.directory, f"{photo_id}.name")
+
+    def _scan(self):
+        """Rebuilds the LRU index from the files on disk, oldest access first."""
+        entries = {}
+        used = {}
+        for name in os.listdir(self.directory):
+            photo_id, _, suffix = name.partition('.')
+            if suffix == 'name':
+                part = 'name'
+            elif suffix.endswith('.jpg') and suffix[:-4] in PHOTO_VARIANTS:
+                part = suffix[:-4]
+            else:
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.setdefault(photo_id, {})[part] = st.st_size
+            used[photo_id] = max(used.get(photo_id, 0), st.st_mtime)
+        for photo_id in sorted(entries, key=used.get):
+            self._photos[photo_id] = entries[photo_id]
+            self.bytes_used += sum(entries[photo_id].values())
+
+    def _store(self, photo_id, sizes):
+        """
+        Records files of an id's entry, marks it recently used and evicts down
+        to max_bytes. Call with the lock held; returns the evicted ids.
+        """
+        entry = self._photos.pop(photo_id, {})
+        self.bytes_used += sum(sizes.values()) - sum(entry.get(part, 0) for part in sizes)
+        entry.update(sizes)
+        self._photos[photo_id] = entry
+        evicted = []
+        while self.bytes_used > self.max_bytes and len(self._photos) > 1:
+            old_id, old_entry = self._photos.popitem(last=False)
+            self.bytes_used -= sum(old_entry.values())
+            evicted.append(old_id)
+        return evicted
+
+    def _remove(self, photo_ids):
+        for photo_id in photo_ids:
+            paths = [self.variant_path(photo_id, variant) for variant in PHOTO_VARIANTS]
+            for path in paths + [self._name_path(photo_id)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def remember(self, resource_name):
+        """Records which Places photo an id stands for and returns the id."""
+        photo_id = self.photo_id(resource_name)
+        with self._lock:
+            if 'name' in self._photos.get(photo_id, ()):
+                return photo_id
+        path = self._name_path(photo_id)
+        with open(path, 'w') as f:
+            f.write(resource_name)
+        size = os.path.getsize(path)
+        with self._lock:
+            evicted = self._store(photo_id, {'name': size})
+        self._remove(evicted)
+        return photo_id
+
+    def resource_name(self, photo_id):
+        try:
+            with open(self._name_path(photo_id)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def get(self, photo_id, variant):
+        """Returns the path of a cached variant (marking the photo recently used), or None."""
+        with self._lock:
+            if variant not in self._photos.get(photo_id, ()):
+                self.misses += 1
+                return None
+            self._photos.move_to_end(photo_id)
+            self.hits += 1
+        path = self.variant_path(photo_id, variant)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another worker sharing the directory
+            with self._lock:
+                self.bytes_used -= sum(self._photos.pop(photo_id, {}).values())
+            return None
+        return path
+
+    def store(self, photo_id, image_bytes):
+        """Writes every variant of a freshly fetched photo and enforces the size bound."""
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            source = source.convert('RGB')
+            sizes = {}
+            for variant, height in PHOTO_VARIANTS.items():
+                image = source
+                if source.height > height:
+                    image = source.resize((max(1, round(source.width * height / source.height)), height), Image.LANCZOS)
+                buffer = io.BytesIO()
+                image.save(buffer, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+                path = self.variant_path(photo_id, variant)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+                with open(tmp_path, 'wb') as f:
+                    f.write(buffer.getbuffer())
+                os.replace(tmp_path, path)
+                sizes[variant] = buffer.tell()
+
+        with self._lock:
+            evicted = self._store(photo_id, sizes)
+        self._remove(evicted)
+
+    def stats(self):
+        return {
+            'photos': len(self._photos),
+            'unfetched': sum(DEFAULT_VARIANT not in entry for entry in self._photos.values()),
+            'bytes': self.bytes_used,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,102 @@
+import os
+from dataclasses import replace
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+TOP_K = int(os.environ.get("PLACES_TOP_K", 15))
+
+# How much each normalised signal contributes to a place's score
+SCORE_WEIGHTS = {
+    "rating": 0.35,
+    "popularity": 0.15,
+    "max_distance": 0.25,
+    "mean_distance": 0.15,
+    "fairness": 0.10,
+}
+
+
+def distance_matrix_km(origins, destinations):
+    """
+    Great-circle distances between every origin and every destination.
+    Both are (n, 2) arrays of (lat, lon) in degrees; the result is (len(origins), len(destinations)).
+    """
+    o = np.radians(np.asarray(origins, dtype=float).reshape(-1, 2))
+    d = np.radians(np.asarray(destinations, dtype=float).reshape(-1, 2))
+    lat1, lon1 = o[:, 0:1], o[:, 1:2]
+    lat2, lon2 = d[:, 0], d[:, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _scaled(values):
+    """Scales to [0, 1] by the largest value, treating missing (NaN) as 0."""
+    values = np.nan_to_num(values, nan=0.0)
+    top = values.max() if values.size else 0.0
+    return values / top if top > 0 else np.zeros_like(values)
+
+
+def rank_places(places, participants, midpoint=None, top_k=TOP_K, weights=SCORE_WEIGHTS):
+    """
+    Scores places for a group and returns the best top_k, best first.
+
+    places are records (places_api.Place) with rating, userRatingCount and
+    lat/lon attributes; participants is a list of {'lat', 'lon'}. The returned
+    copies have max_km, mean_km (travel for the group), distance_km (from the
+    midpoint, if given) and score filled in.
+    """
+    if not places:
+        return []
+
+    located = np.array([p.lat is not None and p.lon is not None for p in places])
+    n = len(places)
+    max_km = np.full(n, np.nan)
+    mean_km = np.full(n, np.nan)
+    fairness = np.zeros(n)
+    to_midpoint = np.full(n, np.nan)
+
+    if located.any() and (participants or midpoint):
+        coords = [(p.lat, p.lon) for p, ok in zip(places, located) if ok]
+        origins = [(p["lat"], p["lon"]) for p in participants or []]
+        if midpoint:
+            origins.append((midpoint["lat"], midpoint["lon"]))
+        # One pass for the whole (participants + midpoint) x places matrix
+        matrix = distance_matrix_km(origins, coords)
+        if midpoint:
+            to_midpoint[located] = matrix[-1]
+            matrix = matrix[:-1]
+        if participants:
+            max_km[located] = matrix.max(axis=0)
+            mean_km[located] = matrix.mean(axis=0)
+            # 1 when everyone travels the same distance, towards 0 as the spread grows
+            spread = max_km[located] - matrix.min(axis=0)
+            fairness[located] = 1.0 - spread / np.maximum(max_km[located], 1e-9)
+
+    rating = np.array([p.rating or 0.0 for p in places], dtype=float) / 5.0
+    popularity = _scaled(np.log1p(np.array([p.userRatingCount or 0 for p in places], dtype=float)))
+    # Closer is better; places we can't locate get no distance credit
+    max_score = np.where(located, 1.0 - _scaled(max_km), 0.0)
+    mean_score = np.where(located, 1.0 - _scaled(mean_km), 0.0)
+
+    score = (
+        weights["rating"] * rating
+        + weights["popularity"] * popularity
+        + weights["max_distance"] * max_score
+        + weights["mean_distance"] * mean_score
+        + weights["fairness"] * fairness
+    )
+
+    k = min(top_k, n)
+    # Partial sort: only the k best are ordered
+    best = np.argpartition(-score, k - 1)[:k]
+    best = best[np.argsort(-score[best], kind="stable")]
+
+    return [
+        replace(
+            places[i],
+            max_km=None if np.isnan(max_km[i]) else round(float(max_km[i]), 1),
+            mean_km=None if np.isnan(mean_km[i]) else round(float(mean_km[i]), 1),
+            distance_km=None if np.isnan(to_midpoint[i]) else float(to_midpoint[i]),
+            score=round(float(score[i]), 3),
+        )
+        for i in best
+    ]
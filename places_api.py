@@ -1,30 +1,112 @@
 import os
-import requests
 import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from math import radians, cos, sin, asin, sqrt
+from ttl_cache import TTLCache
+from http_pool import get_session, timeout_for, get_async_client, async_timeout_for
+from gateway import provider
+from photo_cache import PhotoCache, DEFAULT_VARIANT, SOURCE_HEIGHT
+from place_ranking import rank_places
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 API_KEY = os.environ.get("GOOGLE_PLACES_API_KEY")
-TEXT_SEARCH_URL = "https://places.googleapis.com/v1/places:searchText"
+TEXT_SEARCH_URL = os.environ.get("PLACES_TEXT_SEARCH_URL", "https://places.googleapis.com/v1/places:searchText")
+
+# Text search results are cached per (city, location bias snapped to a grid, query type),
+# so lobbies meeting in the same town share a single upstream lookup.
+PLACES_CACHE_GRID = float(os.environ.get("PLACES_CACHE_GRID", 0.05))  # degrees, ~5 km
+PLACES_CACHE = TTLCache(
+    max_entries=int(os.environ.get("PLACES_CACHE_SIZE", 512)),
+    ttl=int(os.environ.get("PLACES_CACHE_TTL", 24 * 3600)),
+    path=os.environ.get("PLACES_CACHE_PATH", "cache/places.sqlite3") or None,
+)
+# Google's page tokens expire within minutes, so they (and pages fetched with one) are kept only this long
+PLACES_TOKEN_TTL = int(os.environ.get("PLACES_TOKEN_TTL", 120))
+
+def places_cache_key(city, place_type, location_bias=None, page_token=None):
+    """Builds the cache key for a text search page, snapping the bias to PLACES_CACHE_GRID."""
+    bias = ""
+    if location_bias:
+        lat = round(location_bias['lat'] / PLACES_CACHE_GRID) * PLACES_CACHE_GRID
+        lon = round(location_bias['lon'] / PLACES_CACHE_GRID) * PLACES_CACHE_GRID
+        bias = f"{lat:.4f},{lon:.4f}"
+    return f"{city.strip().lower()}|{bias}|{place_type}|{page_token or ''}"
+
+def cached_search_page(cache_key):
+    """The cached (places, next_page_token) of a search, or None. The token is None once it may have expired."""
+    cached = PLACES_CACHE.get(cache_key)
+    if cached is None:
+        return None
+    return cached['places'], PLACES_CACHE.get(f"{cache_key}#token")
 
-def get_places(city, place_type, location_bias=None):
+# Place photos are served through our /photo proxy from this disk cache, so the API key
+# stays on the server and each photo is fetched from Google once, not once per viewer
+PHOTO_MEDIA_URL = os.environ.get("PLACES_PHOTO_URL", "https://places.googleapis.com/v1")
+PHOTO_CACHE = PhotoCache(
+    os.environ.get("PHOTO_CACHE_DIR", "cache/photos"),
+    max_bytes=int(os.environ.get("PHOTO_CACHE_MAX_BYTES", 500 * 1024 * 1024)),
+)
+
+# Every category the places pipeline knows: key -> (label, text query).
+# PLACES_CATEGORIES picks which ones a lobby gets, in display order.
+CATEGORY_CATALOG = {
+    "hotels": ("Hotels", "hotel nearby"),
+    "attractions": ("Attractions", "closest local tourist attraction"),
+    "restaurants": ("Restaurants", "restaurant"),
+    "cafes": ("Cafés", "cafe"),
+    "bars": ("Bars", "bar"),
+    "parks": ("Parks", "park"),
+    "museums": ("Museums", "museum"),
+}
+PLACES_CATEGORIES = [
+    key for key in (k.strip() for k in os.environ.get("PLACES_CATEGORIES", "hotels,attractions").split(","))
+    if key in CATEGORY_CATALOG
+]
+
+# Category searches run side by side; under the eventlet worker these threads are green.
+SEARCH_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("PLACES_SEARCH_WORKERS", 8)))
+
+def get_places(city, place_type, location_bias=None, page_token=None):
     """
     Get places of a certain type in a city using the new Places API.
+    Returns (places, next_page_token); pass the token back to get the following page.
+    Results are served from PLACES_CACHE when the same search was made recently.
     """
+    cache_key = places_cache_key(city, place_type, location_bias, page_token)
+    cached = cached_search_page(cache_key)
+    if cached is not None:
+        return cached
+
     if not API_KEY:
         raise ValueError("GOOGLE_PLACES_API_KEY environment variable not set.")
 
+    # Identical searches from several lobbies share one request; if Places is
+    # failing or saturated the category comes back empty (and uncached) right away
+    page = provider('places').call(
+        search_places, city, place_type, location_bias, page_token, cache_key,
+        key=cache_key, fallback=lambda: {'places': []},
+    )
+    return page['places'], page.get('next_page_token')
+
+def search_request(city, place_type, location_bias=None, page_token=None):
+    """Returns the (body, headers) of a text search request."""
     headers = {
         "Content-Type": "application/json",
         "X-Goog-Api-Key": API_KEY,
-        "X-Goog-FieldMask": "places.id,places.displayName,places.photos.name,places.rating,places.location,places.userRatingCount,places.googleMapsUri"
+        "X-Goog-FieldMask": "places.id,places.displayName,places.photos.name,places.rating,places.location,places.userRatingCount,places.googleMapsUri,nextPageToken"
     }
 
     data = {
         "textQuery": f"{place_type} in {city}"
     }
+    if page_token:
+        data["pageToken"] = page_token
 
     if location_bias:
         data["locationBias"] = {
@@ -36,93 +118,208 @@ def get_places(city, place_type, location_bias=None):
                 "radius": 50000.0  # 50km radius
             }
         }
+    return data, headers
 
-    response = requests.post(TEXT_SEARCH_URL, json=data, headers=headers)
+def search_places(city, place_type, location_bias, page_token, cache_key):
+    """Runs one text search request against the Places API and caches the page under cache_key."""
+    data, headers = search_request(city, place_type, location_bias, page_token)
+    response = get_session().post(TEXT_SEARCH_URL, json=data, headers=headers, timeout=timeout_for('places'))
     
     # Check for errors and print response for debugging if needed
     if response.status_code != 200:
-        print(f"Error fetching {place_type} in {city}: {response.status_code}")
-        print(response.text)
+        log.error("Error fetching %s in %s: %s %s", place_type, city, response.status_code, response.text)
         response.raise_for_status()
-        
-    return response.json().get("places", [])
 
-def get_photo_url(photo_resource_name, max_height=400):
-    """Constructs a photo URL from its resource name."""
+    return cache_search_page(cache_key, response.json(), page_token)
+
+def cache_search_page(cache_key, body, page_token=None):
+    """
+    Caches a search page for PLACES_CACHE_TTL, or for PLACES_TOKEN_TTL when it was
+    fetched with a page token. The token to the next page is cached apart, for PLACES_TOKEN_TTL.
+    """
+    page = {'places': body.get("places", []), 'next_page_token': body.get("nextPageToken")}
+    PLACES_CACHE.set(cache_key, {'places': page['places']}, ttl=PLACES_TOKEN_TTL if page_token else None)
+    if page['next_page_token']:
+        PLACES_CACHE.set(f"{cache_key}#token", page['next_page_token'], ttl=PLACES_TOKEN_TTL)
+    return page
+
+async def get_places_async(city, place_type, location_bias=None, page_token=None):
+    """get_places() for the asyncio entry point; the request is made with httpx."""
+    cache_key = places_cache_key(city, place_type, location_bias, page_token)
+    # PLACES_CACHE may read from SQLite; keep that off the event loop
+    cached = await asyncio.to_thread(cached_search_page, cache_key)
+    if cached is not None:
+        return cached
+
+    if not API_KEY:
+        raise ValueError("GOOGLE_PLACES_API_KEY environment variable not set.")
+
+    page = await provider('places').acall(
+        search_places_async, city, place_type, location_bias, page_token, cache_key,
+        key=cache_key, fallback=lambda: {'places': []},
+    )
+    return page['places'], page.get('next_page_token')
+
+async def search_places_async(city, place_type, location_bias, page_token, cache_key):
+    data, headers = search_request(city, place_type, location_bias, page_token)
+    response = await get_async_client().post(TEXT_SEARCH_URL, json=data, headers=headers, timeout=async_timeout_for('places'))
+    if response.status_code != 200:
+        log.error("Error fetching %s in %s: %s %s", place_type, city, response.status_code, response.text)
+        response.raise_for_status()
+    return await asyncio.to_thread(cache_search_page, cache_key, response.json(), page_token)
+
+def get_photo_url(photo_resource_name, variant=DEFAULT_VARIANT):
+    """Returns the proxy URL for a photo (see PHOTO_VARIANTS for the sizes)."""
     if not photo_resource_name:
         return None
-    return f"https://places.googleapis.com/v1/{photo_resource_name}/media?maxHeightPx={max_height}&key={API_KEY}"
+    photo_id = PHOTO_CACHE.remember(photo_resource_name)
+    return f"/photo/{photo_id}" if variant == DEFAULT_VARIANT else f"/photo/{photo_id}/{variant}"
+
+def cached_photo(photo_id, variant=DEFAULT_VARIANT):
+    """
+    Returns the path of a cached photo variant, fetching the photo on a miss.
+    Returns None for ids we never handed out.
+    """
+    path = PHOTO_CACHE.get(photo_id, variant)
+    if path is not None:
+        return path
+    resource_name = PHOTO_CACHE.resource_name(photo_id)
+    if resource_name is None:
+        return None
+    # Concurrent misses for the same photo wait for a single fetch
+    provider('photos').call(fetch_photo, photo_id, resource_name, key=photo_id)
+    return PHOTO_CACHE.get(photo_id, variant)
+
+def fetch_photo(photo_id, resource_name):
+    """Downloads a photo at the largest variant size and stores every variant."""
+    response = get_session().get(
+        f"{PHOTO_MEDIA_URL}/{resource_name}/media",
+        params={"maxHeightPx": SOURCE_HEIGHT, "key": API_KEY},
+        timeout=timeout_for('photos'),
+    )
+    response.raise_for_status()
+    PHOTO_CACHE.store(photo_id, response.content)
+
+async def cached_photo_async(photo_id, variant=DEFAULT_VARIANT):
+    """cached_photo() for the asyncio entry point."""
+    path = PHOTO_CACHE.get(photo_id, variant)
+    if path is not None:
+        return path
+    resource_name = PHOTO_CACHE.resource_name(photo_id)
+    if resource_name is None:
+        return None
+    await provider('photos').acall(fetch_photo_async, photo_id, resource_name, key=photo_id)
+    return PHOTO_CACHE.get(photo_id, variant)
+
+async def fetch_photo_async(photo_id, resource_name):
+    response = await get_async_client().get(
+        f"{PHOTO_MEDIA_URL}/{resource_name}/media",
+        params={"maxHeightPx": SOURCE_HEIGHT, "key": API_KEY},
+        timeout=async_timeout_for('photos'),
+        follow_redirects=True,
+    )
+    response.raise_for_status()
+    # Resizing is CPU work; keep it off the event loop
+    await asyncio.to_thread(PHOTO_CACHE.store, photo_id, response.content)
 
-def get_city_data(city, midpoint=None, reachable_midpoint=None):
+@dataclass(slots=True)
+class Place:
     """
-    Get hotels and attractions for a given city.
+    One search result as the client shows it. The ranking fields are filled in
+    by rank_places. Socket payloads carry these records as they are; lobby
+    state stores as_dict() copies, since it must stay JSON.
     """
-    hotels = get_places(city, "hotel nearby", location_bias=reachable_midpoint)
-    attractions = get_places(city, "closest local tourist attraction", location_bias=reachable_midpoint)
+    name: dict | None  # displayName: {'text', 'languageCode'}
+    photo_url: str | None
+    rating: float | None
+    userRatingCount: int | None
+    googleMapsUri: str | None
+    lat: float | None
+    lon: float | None
+    max_km: float | None = None
+    mean_km: float | None = None
+    distance_km: float | None = None
+    score: float | None = None
 
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+def place_details(place):
+    """Extracts the fields the client needs from a Places search result."""
+    # Get the first photo's resource name, if available
+    photo_name = place.get("photos", [{}])[0].get("name")
+    location = place.get("location") or {}
+
+    return Place(
+        name=place.get("displayName"),
+        photo_url=get_photo_url(photo_name),
+        rating=place.get("rating"),
+        userRatingCount=place.get("userRatingCount"),
+        googleMapsUri=place.get("googleMapsUri"),
+        lat=location.get("latitude"),
+        lon=location.get("longitude"),
+    )
+
+def category_page(city, category, midpoint=None, reachable_midpoint=None, participants=None, page_token=None):
+    """
+    Fetches one page of a category and ranks it for the group on rating,
+    popularity and how far (and how fairly) the participants would travel,
+    trimmed to the best PLACES_TOP_K. Returns (Place records, next_page_token).
+    """
+    _, query = CATEGORY_CATALOG[category]
+    places, next_page_token = get_places(city, query, location_bias=reachable_midpoint, page_token=page_token)
     # The new API can return details in the search result, so we don't need a separate details call.
-    hotel_details = []
-    for hotel in hotels:
-        # Get the first photo's resource name, if available
-        photo_name = hotel.get("photos", [{}])[0].get("name")
-        
-        distance = None
-        if midpoint and hotel.get("location"):
-            place_loc = hotel["location"]
-            distance = haversine_distance(midpoint['lat'], midpoint['lon'], place_loc['latitude'], place_loc['longitude'])
-
-        hotel_details.append({
-            "name": hotel.get("displayName"),
-            "photo_url": get_photo_url(photo_name),
-            "rating": hotel.get("rating"),
-            "userRatingCount": hotel.get("userRatingCount"),
-            "googleMapsUri": hotel.get("googleMapsUri"),
-            "distance_km": distance
-        })
-
-    attraction_details = []
-    for attraction in attractions:
-        photo_name = attraction.get("photos", [{}])[0].get("name")
-
-        distance = None
-        if midpoint and attraction.get("location"):
-            place_loc = attraction["location"]
-            distance = haversine_distance(midpoint['lat'], midpoint['lon'], place_loc['latitude'], place_loc['longitude'])
-
-        attraction_details.append({
-            "name": attraction.get("displayName"),
-            "photo_url": get_photo_url(photo_name),
-            "rating": attraction.get("rating"),
-            "userRatingCount": attraction.get("userRatingCount"),
-            "googleMapsUri": attraction.get("googleMapsUri"),
-            "distance_km": distance
-        })
-
-    return json.dumps({
-        "city": city,
-        "hotels": hotel_details,
-        "attractions": attraction_details
-    }, indent=4)
-
-def haversine_distance(lat1, lon1, lat2, lon2):
+    details = [place_details(place) for place in places]
+    return rank_places(details, participants or [], midpoint=midpoint), next_page_token
+
+def iter_city_data(city, midpoint=None, reachable_midpoint=None, participants=None, categories=None):
     """
-    Calculate the great-circle distance between two points
-    on the earth (specified in decimal degrees).
+    Searches every category concurrently and yields (category, places, next_page_token)
+    as each one finishes, fastest first. A failed category yields no places.
     """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    futures = {
+        SEARCH_POOL.submit(category_page, city, key, midpoint, reachable_midpoint, participants): key
+        for key in categories or PLACES_CATEGORIES
+    }
+    for future in as_completed(futures):
+        key = futures[future]
+        try:
+            places, next_page_token = future.result()
+        except Exception as e:
+            log.warning("Places search for %s in %s failed: %s", key, city, e)
+            places, next_page_token = [], None
+        yield key, places, next_page_token
+
+async def category_page_async(city, category, midpoint=None, reachable_midpoint=None, participants=None, page_token=None):
+    """category_page() for the asyncio entry point."""
+    _, query = CATEGORY_CATALOG[category]
+    places, next_page_token = await get_places_async(city, query, location_bias=reachable_midpoint, page_token=page_token)
+    # place_details records each photo id, which can write to the photo cache directory
+    details = await asyncio.to_thread(lambda: [place_details(place) for place in places])
+    return rank_places(details, participants or [], midpoint=midpoint), next_page_token
+
+async def iter_city_data_async(city, midpoint=None, reachable_midpoint=None, participants=None, categories=None):
+    """iter_city_data() for the asyncio entry point: the searches are tasks on the event loop."""
+    async def search(key):
+        try:
+            return (key, *await category_page_async(city, key, midpoint, reachable_midpoint, participants))
+        except Exception as e:
+            log.warning("Places search for %s in %s failed: %s", key, city, e)
+            return key, [], None
+
+    for next_done in asyncio.as_completed([search(key) for key in categories or PLACES_CATEGORIES]):
+        yield await next_done
 
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of earth in kilometers.
-    return c * r
+def get_city_data(city, midpoint=None, reachable_midpoint=None, participants=None, categories=None):
+    """Get every category for a given city at once, ranked for the group."""
+    result = {"city": city}
+    for key, places, _ in iter_city_data(city, midpoint, reachable_midpoint, participants, categories):
+        result[key] = places
+    return result
 
 if __name__ == "__main__":
     city_name = "New York"
     # For testing, provide a sample midpoint
     sample_midpoint = {'lat': 40.7128, 'lon': -74.0060}
     data = get_city_data(city_name, sample_midpoint, sample_midpoint)
-    print(data)
+    print(json.dumps(data, indent=4, default=Place.as_dict))
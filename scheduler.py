@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DeadlineScheduler:
+    """
+    Runs keyed deadlines from a single background task.
+
+    Deadlines sit in a heap ordered by due time. Scheduling is a heap push;
+    cancelling (or rescheduling a key) only marks the old entry dead, and dead
+    entries are skipped when they surface or swept out once they make up most
+    of the heap. The task is started on first use with the server's own
+    start_background_task/create_event, so it is a green thread under eventlet
+    and an asyncio task when the event is an asyncio one (the ASGI entry point).
+    It waits on the event until the earliest deadline, or indefinitely when
+    nothing is pending; schedule() sets it when a deadline becomes the earliest.
+
+    The loop only finds due deadlines; each one then runs in a task of its
+    own, so a slow one (a places fetch, an archive write) doesn't hold up the
+    others. Under asyncio a deadline may be a coroutine function.
+    """
+
+    def __init__(self, start_task, create_event):
+        self._start_task = start_task
+        self._wakeup = create_event()
+        self._async = inspect.iscoroutinefunction(self._wakeup.wait)
+        self._heap = []
+        self._entries = {}  # key -> live heap entry
+        self._counter = itertools.count()
+        self._running = False
+        self.fired = 0
+        self.cancelled = 0
+        self.failed = 0
+
+    def schedule(self, key, delay, fn, *args):
+        """Runs fn(*args) after delay seconds, replacing any pending deadline with the same key."""
+        self.cancel(key)
+        entry = [time.monotonic() + delay, next(self._counter), key, fn, args, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if not self._running:
+            self._running = True
+            self._start_task(self._run_async if self._async else self._run)
+        elif self._heap[0] is entry:
+            self._wakeup.set()
+        return entry[0]
+
+    def cancel(self, key):
+        """Cancels a pending deadline. Returns True if one was pending."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[5] = False
+        self.cancelled += 1
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [e for e in self._heap if e[5]]
+            heapq.heapify(self._heap)
+        return True
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        next_due = None
+        while self._heap and not self._heap[0][5]:
+            heapq.heappop(self._heap)
+        if self._heap:
+            next_due = max(0.0, self._heap[0][0] - time.monotonic())
+        return {
+            'pending': len(self._entries),
+            'heap_size': len(self._heap),
+            'next_due_in': next_due,
+            'fired': self.fired,
+            'cancelled': self.cancelled,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            self._wakeup.wait(self._fire_due())
+
+    async def _run_async(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._fire_due())
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire_due(self):
+        """Starts a task for every deadline that is due. Returns how long until the next one, or None if none is pending."""
+        now = time.monotonic()
+        while self._heap and (not self._heap[0][5] or self._heap[0][0] <= now):
+            due, _, key, fn, args, live = heapq.heappop(self._heap)
+            if not live:
+                continue
+            self._entries.pop(key, None)
+            self.fired += 1
+            self._start_task(self._call_async if self._async else self._call, key, fn, args)
+
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - now)
+
+    def _call(self, key, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.failed += 1
+            log.exception("Scheduled task %s failed: %s", key, e)
+
+    async def _call_async(self, key, fn, args):
+        try:
+            result = fn(*args)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            self.failed += 1
+            log.exception("Scheduled task %s failed: %s", key, e)
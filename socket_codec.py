@@ -0,0 +1,110 @@
+"""
+Socket.IO packet encodings. SOCKETIO_SERIALIZER picks one for every worker:
+
+- json: the stdlib encoder (the default)
+- orjson: the same JSON text, encoded several times faster
+- msgpack: binary frames, smaller for numeric payloads such as ranked places;
+  browsers then need the msgpack build of the Socket.IO client (socketio_client_url)
+
+Every worker and client of a deployment must use the same one. All of them
+encode records such as places_api.Place directly, without copying them into
+dicts first, record payload sizes like metrics.MeteredPacket, and don't
+support bytes inside events. bench/serializers.py compares them.
+"""
+import json
+import logging
+import os
+from metrics import MeteredPacket
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder is used instead
+    orjson = None
+
+try:
+    import msgpack
+    from socketio.msgpack_packet import MsgPackPacket
+except ImportError:  # JSON packets only
+    msgpack = None
+
+log = logging.getLogger(__name__)
+
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'json')
+SOCKETIO_CLIENT_VERSION = '4.7.4'
+
+
+def encode_record(obj):
+    """default= hook for the encoders: records go out as their fields."""
+    as_dict = getattr(obj, 'as_dict', None)
+    if as_dict is None:
+        raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+    return as_dict()
+
+
+class StdJson:
+    """The json module as python-socketio calls it, able to encode records."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json.dumps(obj, default=encode_record, **kwargs)
+
+    loads = staticmethod(json.loads)
+
+
+class OrJson:
+    """orjson behind the json module's interface. Output is already compact, so separators are ignored."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # Slotted dataclasses are encoded natively; non-str keys become strings like in the stdlib
+        return orjson.dumps(obj, default=encode_record, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(s):
+        return orjson.loads(s)
+
+
+class JsonPacket(MeteredPacket):
+    # python-socketio walks every outgoing payload looking for bytes to send as
+    # attachments, which costs more than encoding it. Events carry no bytes here
+    # (audio and photos go over HTTP), so the walk is skipped; bytes would now
+    # fail to encode instead.
+    uses_binary_events = False
+    json = StdJson
+
+
+class OrJsonPacket(JsonPacket):
+    json = OrJson
+
+
+# Serializers whose library is installed
+PACKET_CLASSES = {'json': JsonPacket}
+if orjson is not None:
+    PACKET_CLASSES['orjson'] = OrJsonPacket
+
+if msgpack is not None:
+    class _RecordMsgPackPacket(MsgPackPacket):
+        def encode(self):
+            return msgpack.packb(self._to_dict(), default=encode_record)
+
+    class MsgPackRecordPacket(MeteredPacket, _RecordMsgPackPacket):
+        pass
+
+    PACKET_CLASSES['msgpack'] = MsgPackRecordPacket
+
+
+def packet_class(name):
+    """The packet class for a serializer name, falling back to stdlib JSON if it isn't available."""
+    if name not in PACKET_CLASSES:
+        log.warning("Socket.IO serializer %r is not available; using json", name)
+        return JsonPacket
+    return PACKET_CLASSES[name]
+
+
+PACKET_CLASS = packet_class(SOCKETIO_SERIALIZER)
+
+
+def socketio_client_url():
+    """The Socket.IO browser client for PACKET_CLASS; its msgpack build decodes binary packets."""
+    build = 'socket.io.msgpack.min.js' if PACKET_CLASS is PACKET_CLASSES.get('msgpack') else 'socket.io.min.js'
+    return f"https://cdn.socket.io/{SOCKETIO_CLIENT_VERSION}/{build}"
@@ -4,7 +4,8 @@ document.addEventListener('DOMContentLoaded', async () => {
 
     // --- User and Lobby State ---
     let lobbyId = null;
-    const socket = io();
+    // Websocket only: with several server workers, long-polling requests could land on a different process
+    const socket = io({ transports: ['websocket'] });
 
     // Wait for authentication to be ready
     const userId = await onAuthReady;
@@ -48,23 +49,104 @@ document.addEventListener('DOMContentLoaded', async () => {
         if (lobbyId) {
             document.getElementById('lobby-code').textContent = lobbyId;
             
-            // Join the lobby
-            socket.emit('join_lobby', { code: lobbyId, userId: userId });
+            // Join the lobby, and join again after every reconnect: the server keeps our
+            // place for a grace window after a dropped connection and resumes the session
+            const joinLobby = () => socket.emit('join_lobby', { code: lobbyId, userId: userId });
+            socket.on('connect', joinLobby);
+            if (socket.connected) joinLobby();
         } else {
             console.error('No lobby code found in URL.');
             alert('Could not find lobby. Please create or join one.');
             return;
         }
 
-        socket.on('lobby_update', (data) => {
-            console.log('Lobby update received:', data);
-            updateGlobe(data.points, data.geometric_midpoint, data.reachable_midpoint, data.participants, data.animation);
-            updateChat(data.messages);
+        // Local copy of the lobby, built from a snapshot and kept current by patches
+        let lobbyState = null;
+
+        // Meeting point mode: centroid, median (least total travel) or minimax (fairest worst case)
+        const midpointModeSelect = document.getElementById('midpoint-mode');
+        if (midpointModeSelect) {
+            midpointModeSelect.addEventListener('change', () => {
+                socket.emit('set_midpoint_mode', { code: lobbyId, mode: midpointModeSelect.value });
+            });
+        }
+
+        function renderLobby(animation) {
+            const s = lobbyState;
+            updateGlobe(s.points, s.geometric_midpoint, s.reachable_midpoint, s.participants, animation);
             // Update midpoint title if reachable midpoint name available
-            if (data.reachable_midpoint && data.reachable_midpoint.name) {
+            if (s.reachable_midpoint && s.reachable_midpoint.name) {
                 const cityEl = document.getElementById('midpoint-city');
-                if (cityEl) cityEl.textContent = data.reachable_midpoint.name;
+                if (cityEl) cityEl.textContent = s.reachable_midpoint.name;
+            }
+        }
+
+        // Full snapshot: sent when we join or after we ask for a resync
+        socket.on('lobby_update', (data) => {
+            console.log('Lobby snapshot received:', data);
+            lobbyState = {
+                seq: data.seq,
+                participants: data.participants || [],
+                points: data.points || {},
+                geometric_midpoint: data.geometric_midpoint,
+                reachable_midpoint: data.reachable_midpoint,
+                midpoint_mode: data.midpoint_mode,
+                weights: data.weights || {},
+                messages: data.messages || [],
+                hasOlderMessages: !!data.has_older_messages
+            };
+            if (midpointModeSelect && data.midpoint_mode) midpointModeSelect.value = data.midpoint_mode;
+            renderLobby(data.animation);
+            updateChat(lobbyState.messages);
+        });
+
+        // Incremental patch: applied in sequence order, a gap triggers a resync
+        socket.on('lobby_patch', (patch) => {
+            if (!lobbyState || patch.seq <= lobbyState.seq) return; // not joined yet, or already applied
+            if (patch.seq !== lobbyState.seq + 1) {
+                console.warn(`Missed lobby patch (have ${lobbyState.seq}, got ${patch.seq}); resyncing`);
+                lobbyState = null;
+                socket.emit('lobby_resync', { code: lobbyId });
+                return;
             }
+
+            let geometryChanged = false;
+            patch.ops.forEach(op => {
+                switch (op.op) {
+                    case 'participant_joined':
+                        if (!lobbyState.participants.includes(op.id)) lobbyState.participants.push(op.id);
+                        break;
+                    case 'participant_left':
+                        lobbyState.participants = lobbyState.participants.filter(id => id !== op.id);
+                        break;
+                    case 'point_changed':
+                        lobbyState.points[op.id] = op.point;
+                        geometryChanged = true;
+                        break;
+                    case 'point_removed':
+                        delete lobbyState.points[op.id];
+                        geometryChanged = true;
+                        break;
+                    case 'midpoint_changed':
+                        lobbyState.geometric_midpoint = op.geometric_midpoint;
+                        lobbyState.reachable_midpoint = op.reachable_midpoint;
+                        geometryChanged = true;
+                        break;
+                    case 'mode_changed':
+                        lobbyState.midpoint_mode = op.mode;
+                        if (midpointModeSelect) midpointModeSelect.value = op.mode;
+                        break;
+                    case 'weight_changed':
+                        lobbyState.weights[op.id] = op.weight;
+                        break;
+                    case 'message_appended':
+                        lobbyState.messages.push(op.message);
+                        appendChatMessage(op.message);
+                        break;
+                }
+            });
+            lobbyState.seq = patch.seq;
+            if (geometryChanged) renderLobby(patch.animation);
         });
 
         // --- Chat Box Setup ---
@@ -152,91 +234,75 @@ document.addEventListener('DOMContentLoaded', async () => {
             });
         }
 
-        // Listen for travel info details to populate midpoint content
-        socket.on('travel_info_update', (payload) => {
-            const container = document.getElementById('midpoint-content');
-            if (!container) return;
-            const details = payload.midpoint_details || {};
-            const hotels = details.hotels || [];
-            const attractions = details.attractions || [];
-            const cityName = details.city || '';
-            const cityEl = document.getElementById('midpoint-city');
-            if (cityEl && cityName) cityEl.textContent = cityName;
-
-            if (hotels.length === 0 && attractions.length === 0) {
-                container.innerHTML = '<p style="margin:10px; color:#cbd5e1;"><em>No data found.</em></p>';
-                return;
+        function updateChat(messages) {
+            chatMessages.innerHTML = '';
+            if (!messages || messages.length === 0) {
+                chatMessages.innerHTML = '<p class="chat-empty"><em>No messages yet.</em></p>';
+            } else {
+                messages.forEach(appendChatMessage);
             }
+            if (lobbyState && lobbyState.hasOlderMessages) showLoadEarlier();
+        }
 
-            // Build sections
-            const sections = [];
-            if (hotels.length) {
-                const hotelSection = document.createElement('div');
-                hotelSection.className = 'mid-list';
-                const title = document.createElement('div');
-                title.className = 'mid-section-title';
-                title.textContent = 'Hotels';
-                hotelSection.appendChild(title);
-                hotels.slice(0, 6).forEach(h => hotelSection.appendChild(renderMidCard(h)));
-                sections.push(hotelSection);
-            }
-            if (attractions.length) {
-                const attrSection = document.createElement('div');
-                attrSection.className = 'mid-list';
-                const title = document.createElement('div');
-                title.className = 'mid-section-title';
-                title.textContent = 'Attractions';
-                attrSection.appendChild(title);
-                attractions.slice(0, 6).forEach(a => attrSection.appendChild(renderMidCard(a)));
-                sections.push(attrSection);
-            }
+        // Only the newest messages come with the snapshot; older pages are fetched on demand
+        function showLoadEarlier() {
+            if (document.getElementById('chat-load-earlier')) return;
+            const btn = document.createElement('button');
+            btn.id = 'chat-load-earlier';
+            btn.type = 'button';
+            btn.textContent = 'Load earlier messages';
+            btn.addEventListener('click', () => {
+                const oldest = lobbyState && lobbyState.messages.length ? lobbyState.messages[0].id : null;
+                btn.disabled = true;
+                socket.emit('load_history', { code: lobbyId, before: oldest });
+            });
+            chatMessages.prepend(btn);
+        }
 
-            container.innerHTML = '';
-            sections.forEach(s => container.appendChild(s));
+        socket.on('chat_history', (page) => {
+            if (!lobbyState || page.code !== lobbyId) return;
+            const btn = document.getElementById('chat-load-earlier');
+            const anchor = btn ? btn.nextSibling : chatMessages.firstChild;
+            const scrollFromBottom = chatMessages.scrollHeight - chatMessages.scrollTop;
+            page.messages.forEach(msg => chatMessages.insertBefore(buildChatMessage(msg), anchor));
+            lobbyState.messages = page.messages.concat(lobbyState.messages);
+            lobbyState.hasOlderMessages = page.has_more;
+            if (btn) {
+                if (page.has_more) btn.disabled = false;
+                else btn.remove();
+            }
+            // Keep the messages the user was looking at in place
+            chatMessages.scrollTop = chatMessages.scrollHeight - scrollFromBottom;
         });
 
-        function renderMidCard(item) {
-            const card = document.createElement('div');
-            card.className = 'mid-card';
-            const img = document.createElement('img');
-            if (item.photo_url) img.src = item.photo_url; else img.style.opacity = '0.3';
-            const meta = document.createElement('div');
-            meta.className = 'mid-meta';
-            const name = document.createElement('div');
-            name.className = 'mid-name';
-            name.textContent = item.name || 'Unnamed';
-            const sub = document.createElement('div');
-            sub.className = 'mid-sub';
-            const rating = item.rating ? `⭐ ${item.rating.toFixed(1)}` : 'No rating';
-            const distance = item.distance_km ? `${item.distance_km.toFixed(1)} km` : '';
-            sub.textContent = [rating, distance].filter(Boolean).join(' · ');
-            meta.appendChild(name);
-            meta.appendChild(sub);
-            if (item.googleMapsUri) {
-                name.style.cursor = 'pointer';
-                name.addEventListener('click', () => window.open(item.googleMapsUri, '_blank'));
-            }
-            card.appendChild(img);
-            card.appendChild(meta);
-            return card;
-        }
+        const ttsUrls = new Map(); // message text -> audio URL, so replays skip the POST
 
-        function updateChat(messages) {
-            chatMessages.innerHTML = '';
-            if (!messages || messages.length === 0) {
-                chatMessages.innerHTML = '<p><em>No messages yet.</em></p>';
-                return;
+        function appendChatMessage(msg) {
+            const placeholder = chatMessages.querySelector('.chat-empty');
+            if (placeholder) placeholder.remove();
+            // A streamed AI reply is final now: drop its provisional copy
+            if (msg.stream_id) {
+                const provisional = document.getElementById(`ai-stream-${msg.stream_id}`);
+                if (provisional) provisional.remove();
             }
 
-            messages.forEach((msg, index) => {
-                const p = document.createElement('p');
-                p.innerHTML = `<strong>${msg.name}:</strong> ${msg.text} `;
+            chatMessages.appendChild(buildChatMessage(msg));
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
 
-                const speakBtn = document.createElement('button');
-                speakBtn.textContent = '🔊';
-                speakBtn.style.marginLeft = '6px';
-                speakBtn.addEventListener('click', async () => {
-                    try {
+        function buildChatMessage(msg) {
+            const p = document.createElement('p');
+            p.innerHTML = `<strong>${msg.name}:</strong> ${msg.text} `;
+
+            const speakBtn = document.createElement('button');
+            speakBtn.textContent = '🔊';
+            speakBtn.style.marginLeft = '6px';
+            speakBtn.addEventListener('click', async () => {
+                try {
+                    // The server answers with a content-addressed URL; the audio element
+                    // streams it, so playback starts before the whole file has arrived
+                    let audioUrl = ttsUrls.get(msg.text);
+                    if (!audioUrl) {
                         const res = await fetch('/tts', {
                             method: 'POST',
                             headers: { 'Content-Type': 'application/json' },
@@ -248,121 +314,185 @@ document.addEventListener('DOMContentLoaded', async () => {
                             return;
                         }
 
-                        const blob = await res.blob();
-                        const audioUrl = URL.createObjectURL(blob);
-                        const audio = new Audio(audioUrl);
-                        audio.play();
-                    } catch (err) {
-                        console.error('Error playing TTS:', err);
+                        audioUrl = (await res.json()).url;
+                        ttsUrls.set(msg.text, audioUrl);
                     }
-                });
 
-                p.appendChild(speakBtn);
-                chatMessages.appendChild(p);
+                    const audio = new Audio(audioUrl);
+                    audio.addEventListener('error', () => {
+                        console.error('TTS playback failed');
+                        ttsUrls.delete(msg.text);
+                    });
+                    audio.play();
+                } catch (err) {
+                    console.error('Error playing TTS:', err);
+                }
             });
-            chatMessages.scrollTop = chatMessages.scrollHeight;
+
+            p.appendChild(speakBtn);
+            return p;
         }
 
+        // Streamed AI replies: shown as they are generated, replaced by the final message
+        socket.on('ai_stream_start', (data) => {
+            const placeholder = chatMessages.querySelector('.chat-empty');
+            if (placeholder) placeholder.remove();
+            const p = document.createElement('p');
+            p.id = `ai-stream-${data.id}`;
+            p.className = 'chat-streaming';
+            const name = document.createElement('strong');
+            name.textContent = `${data.name}:`;
+            const text = document.createElement('span');
+            text.className = 'chat-stream-text';
+            p.append(name, ' ', text);
+            chatMessages.appendChild(p);
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
+
+        socket.on('ai_stream_chunk', (data) => {
+            const text = document.querySelector(`#ai-stream-${data.id} .chat-stream-text`);
+            if (!text) return;
+            text.textContent += data.text;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
+
         socket.on('error', (data) => {
             console.error('Socket error:', data.message);
             alert(`Error: ${data.message}`);
         });
 
+        // --- Places panel ---
+        // Categories arrive one at a time (travel_info_category), fastest search first.
+        // Each has its own section, kept in the server's category order; a new fetch id
+        // means the midpoint moved and the panel starts over.
+        let placesFetch = null;
+        let placeSections = {};
+
         socket.on('travel_info_update', (data) => {
-            console.log('Midpoint details update:', data);
-            updateMidpointInfo(data.midpoint_details);
+            // Everything the lobby already has, sent when we join
+            const details = data.midpoint_details || {};
+            resetPlaces(data.fetch, details.city);
+            (data.categories || []).forEach((category, index) => {
+                renderPlaceCategory({
+                    category: category.key,
+                    label: category.label,
+                    index,
+                    places: details[category.key] || [],
+                    has_more: category.has_more,
+                });
+            });
+            showPlacesPlaceholder(true);
         });
 
-        function updateMidpointInfo(details) {
-            const cityElem = document.getElementById('midpoint-city');
-            const container = document.getElementById('midpoint-content');
+        socket.on('travel_info_category', (data) => {
+            if (data.fetch !== placesFetch) resetPlaces(data.fetch, data.city);
+            renderPlaceCategory(data);
+            showPlacesPlaceholder(data.complete);
+        });
+
+        function resetPlaces(fetch, city) {
+            placesFetch = fetch;
+            placeSections = {};
+            document.getElementById('midpoint-city').textContent = city || 'Unknown';
+            document.getElementById('midpoint-content').innerHTML = '';
+        }
 
-            if (!details || Object.keys(details).length === 0) {
-                cityElem.textContent = '–';
-                container.innerHTML = '<p><em>No midpoint details available.</em></p>';
+        function showPlacesPlaceholder(complete) {
+            const container = document.getElementById('midpoint-content');
+            const hasPlaces = Object.values(placeSections).some(section => !section.root.hidden);
+            let placeholder = document.getElementById('places-placeholder');
+            if (hasPlaces) {
+                if (placeholder) placeholder.remove();
                 return;
             }
+            if (!placeholder) {
+                placeholder = document.createElement('p');
+                placeholder.id = 'places-placeholder';
+                container.appendChild(placeholder);
+            }
+            placeholder.innerHTML = complete ? '<em>No places found.</em>' : '<em>Looking for places…</em>';
+        }
 
-            cityElem.textContent = details.city || 'Unknown';
+        function renderPlaceCategory(data) {
+            let section = placeSections[data.category];
+            if (!section) {
+                section = createPlaceSection(data);
+                placeSections[data.category] = section;
+                // Insert before the first section that comes later in the category order
+                const next = Object.values(placeSections)
+                    .filter(other => other.index > section.index)
+                    .sort((x, y) => x.index - y.index)[0];
+                document.getElementById('midpoint-content').insertBefore(section.root, next ? next.root : null);
+            }
+            if (!data.append) section.list.innerHTML = '';
+            data.places.forEach(place => section.list.appendChild(createPlaceCard(place)));
+            section.more.hidden = !data.has_more;
+            section.more.disabled = false;
+            section.root.hidden = section.list.children.length === 0;
+        }
 
-            const sections = [];
+        function createPlaceSection(data) {
+            const root = document.createElement('div');
+            root.classList.add('place-section');
 
-            // --- Helper to build each place card ---
-            function createPlaceCard(place) {
-                const card = document.createElement('div');
-                card.classList.add('place-card');
+            const header = document.createElement('h4');
+            header.textContent = `Nearby ${data.label}`;
 
-                const img = document.createElement('img');
-                img.src = place.photo_url || 'https://via.placeholder.com/60x60?text=No+Image';
-                img.alt = place.name?.text || 'Place';
+            const list = document.createElement('div');
 
-                const detailsDiv = document.createElement('div');
-                detailsDiv.classList.add('place-details');
+            const more = document.createElement('button');
+            more.classList.add('place-load-more');
+            more.textContent = 'Load more';
+            more.addEventListener('click', () => {
+                more.disabled = true;
+                socket.emit('load_more_places', { code: lobbyId, category: data.category });
+            });
 
-                const nameEl = document.createElement('div');
-                nameEl.classList.add('place-name');
-                nameEl.textContent = place.name?.text || 'Unnamed place';
+            root.append(header, list, more);
+            return { root, list, more, index: data.index };
+        }
 
-                const ratingEl = document.createElement('div');
-                ratingEl.classList.add('place-rating');
-                if (place.rating) {
-                    ratingEl.textContent = `⭐ ${place.rating} (${place.userRatingCount || 0})`;
-                }
+        function createPlaceCard(place) {
+            const card = document.createElement('div');
+            card.classList.add('place-card');
 
-                const distanceEl = document.createElement('div');
-                distanceEl.classList.add('place-distance');
-                if (place.distance_km) {
-                    distanceEl.textContent = `${place.distance_km.toFixed(1)} km away`;
-                }
+            const img = document.createElement('img');
+            // Small card: ask the photo proxy for its thumbnail size
+            img.src = place.photo_url ? `${place.photo_url}/thumb` : 'https://via.placeholder.com/60x60?text=No+Image';
+            img.alt = place.name?.text || 'Place';
 
-                const linkEl = document.createElement('a');
-                linkEl.classList.add('place-link');
-                linkEl.href = place.googleMapsUri;
-                linkEl.target = '_blank';
-                linkEl.textContent = 'View on Google Maps';
+            const detailsDiv = document.createElement('div');
+            detailsDiv.classList.add('place-details');
 
-                detailsDiv.append(nameEl, ratingEl, distanceEl, linkEl);
-                card.append(img, detailsDiv);
+            const nameEl = document.createElement('div');
+            nameEl.classList.add('place-name');
+            nameEl.textContent = place.name?.text || 'Unnamed place';
 
-                return card;
+            const ratingEl = document.createElement('div');
+            ratingEl.classList.add('place-rating');
+            if (place.rating) {
+                ratingEl.textContent = `⭐ ${place.rating} (${place.userRatingCount || 0})`;
             }
 
-            // --- Build hotels section ---
-            if (Array.isArray(details.hotels) && details.hotels.length > 0) {
-                const hotelsDiv = document.createElement('div');
-                hotelsDiv.classList.add('place-section');
-
-                const header = document.createElement('h4');
-                header.textContent = 'Nearby Hotels';
-                hotelsDiv.appendChild(header);
-
-                details.hotels.slice(0, 15).forEach(hotel => {
-                    hotelsDiv.appendChild(createPlaceCard(hotel));
-                });
-                sections.push(hotelsDiv);
+            const distanceEl = document.createElement('div');
+            distanceEl.classList.add('place-distance');
+            if (place.max_km != null) {
+                // Places arrive ranked by the server; show the longest trip anyone in the group makes
+                distanceEl.textContent = `${place.max_km.toFixed(1)} km longest trip · ${place.mean_km.toFixed(1)} km average`;
+            } else if (place.distance_km) {
+                distanceEl.textContent = `${place.distance_km.toFixed(1)} km away`;
             }
 
-            // --- Build attractions section ---
-            if (Array.isArray(details.attractions) && details.attractions.length > 0) {
-                const attractionsDiv = document.createElement('div');
-                attractionsDiv.classList.add('place-section');
+            const linkEl = document.createElement('a');
+            linkEl.classList.add('place-link');
+            linkEl.href = place.googleMapsUri;
+            linkEl.target = '_blank';
+            linkEl.textContent = 'View on Google Maps';
 
-                const header = document.createElement('h4');
-                header.textContent = 'Nearby Attractions';
-                attractionsDiv.appendChild(header);
+            detailsDiv.append(nameEl, ratingEl, distanceEl, linkEl);
+            card.append(img, detailsDiv);
 
-                details.attractions.slice(0, 15).forEach(attraction => {
-                    attractionsDiv.appendChild(createPlaceCard(attraction));
-                });
-                sections.push(attractionsDiv);
-            }
-
-            if (sections.length === 0) {
-                container.innerHTML = '<p><em>No hotels or attractions found.</em></p>';
-            } else {
-                container.innerHTML = '';
-                sections.forEach(section => container.appendChild(section));
-            }
+            return card;
         }
 
         // --- Globe Interaction ---
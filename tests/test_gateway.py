@@ -0,0 +1,67 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway import CircuitBreaker, Provider, ProviderUnavailable  # noqa: E402
+
+
+def half_open_provider():
+    """A provider whose circuit opened after one failure and lets a trial through straight away."""
+    provider = Provider('test', failure_threshold=1, reset_timeout=0.0, queue_timeout=0.1)
+    with pytest.raises(RuntimeError):
+        with provider.slot():
+            raise RuntimeError("upstream down")
+    assert provider.breaker.state == CircuitBreaker.OPEN
+    return provider
+
+
+def test_closing_a_stream_during_half_open_gives_back_the_trial():
+    provider = half_open_provider()
+
+    def stream():
+        with provider.slot():
+            yield 'first'
+            yield 'second'
+
+    chunks = stream()
+    assert next(chunks) == 'first'
+    assert provider.breaker.state == CircuitBreaker.HALF_OPEN
+    chunks.close()
+
+    # The next call is let through as a new trial instead of being refused for good
+    with provider.slot():
+        pass
+    assert provider.breaker.state == CircuitBreaker.CLOSED
+    assert provider.in_flight == 0
+
+
+def test_cancelled_async_call_during_half_open_gives_back_the_trial():
+    provider = half_open_provider()
+
+    async def call():
+        async with provider.aslot():
+            await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.create_task(call())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        async with provider.aslot():
+            pass
+
+    asyncio.run(main())
+    assert provider.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_trial_in_progress_still_refuses_other_calls():
+    provider = half_open_provider()
+    with provider.slot():
+        with pytest.raises(ProviderUnavailable):
+            with provider.slot():
+                pass
@@ -0,0 +1,263 @@
+"""
+The Flask app with the plain HTTP routes: pages, assets, lobby creation, chat
+history, photos, speech and metrics. app.py attaches Flask-SocketIO to it;
+asgi_app.py serves it through WSGIMiddleware.
+"""
+import logging
+import os
+
+import requests
+from flask import Flask, Response, abort, render_template, jsonify, request, redirect, url_for, send_file, stream_with_context
+
+from assets import AssetManifest
+from chat_history import HISTORY_PAGE_SIZE
+from gateway import provider, ProviderUnavailable
+from http_pool import get_session, timeout_for
+from lobby_core import (
+    AUDIO_CACHE, ELEVENLABS_API_KEY, ELEVENLABS_BASE_URL, LOBBIES, TTS_MODEL_ID, TTS_VOICE_ID,
+    generate_lobby_code, lobby_exists, new_lobby, read_history,
+)
+from metrics import ACTIVE_PARTICIPANTS, render_metrics
+from photo_cache import PHOTO_VARIANTS, DEFAULT_VARIANT
+from places_api import cached_photo
+from socket_codec import socketio_client_url
+
+log = logging.getLogger(__name__)
+
+# Static files are served by serve_asset below
+app = Flask(__name__, static_folder=None)
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-very-secret-key')
+
+# static/, fonts/ and img/ are fingerprinted, precompressed and held in memory at startup.
+# Templates link to the fingerprinted URLs through asset_url(), which are cached forever;
+# plain names still work but are revalidated on every use.
+ASSETS = AssetManifest({
+    'static': os.path.join(app.root_path, 'static'),
+    'fonts': os.path.join(app.root_path, 'fonts'),
+    'img': os.path.join(app.root_path, 'img'),
+}).build()
+ASSET_MAX_AGE = 365 * 24 * 3600
+TTS_MAX_AGE = 365 * 24 * 3600  # cached audio never changes for a given key
+PHOTO_MAX_AGE = 30 * 24 * 3600
+
+
+@app.template_global()
+def asset_url(prefix, filename):
+    return ASSETS.url(prefix, filename)
+
+
+app.add_template_global(socketio_client_url)
+
+
+def serve_asset(prefix, filename):
+    """Serves an asset from the manifest, brotli or gzip encoded when the client accepts it."""
+    if app.debug:
+        ASSETS.reload_if_changed()
+    asset, immutable = ASSETS.get(prefix, filename)
+    if asset is None:
+        abort(404)
+
+    encoding = next((e for e in ('br', 'gzip') if e in asset.encoded and request.accept_encodings[e]), None)
+    response = Response(asset.encoded[encoding] if encoding else asset.body, mimetype=asset.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{asset.digest}-{encoding}" if encoding else asset.digest)
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable' if immutable else 'no-cache'
+    return response.make_conditional(request)
+
+
+@app.route('/static/<path:filename>', endpoint='static')
+def serve_static(filename):
+    return serve_asset('static', filename)
+
+# Fonts and images live in top-level directories outside 'static'; CSS references /fonts/Pentagra.woff2 etc.
+@app.route('/fonts/<path:filename>')
+def serve_font(filename):
+    return serve_asset('fonts', filename)
+
+@app.route('/img/<path:filename>')
+def serve_image(filename):
+    return serve_asset('img', filename)
+
+@app.route('/')
+def index():
+    """Serves the entry page."""
+    return render_template('index.html')
+
+@app.route('/lobby')
+def lobby():
+    return render_template('lobby.html')
+
+@app.route('/about')
+def about():
+    return render_template('about.html')
+
+@app.route('/planet/<lobby_code>')
+def planet(lobby_code):
+    """Serves the planet/lobby page."""
+    # Only joining loads the lobby back: a page view alone would leave it active with
+    # nobody in it and no archive deadline
+    if not lobby_code or not lobby_exists(lobby_code):
+        # Redirect to home page if lobby doesn't exist
+        return redirect(url_for('index'))
+    return render_template('planet.html', lobby_code=lobby_code)
+
+@app.route('/create_lobby', methods=['POST'])
+def create_lobby():
+    """Creates a new lobby and returns the code."""
+    lobby_code = generate_lobby_code()
+    # add() refuses codes another worker claimed since we checked
+    while not LOBBIES.add(lobby_code, new_lobby()):
+        lobby_code = generate_lobby_code()
+    log.info("Lobby created", extra={'lobby': lobby_code})
+    return jsonify({'code': lobby_code})
+
+@app.route('/lobby/<lobby_code>/messages')
+def lobby_messages(lobby_code):
+    """Paginated chat history: ?before=<message id>&limit=<n>, oldest first."""
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+    page = read_history(lobby_code, before, limit)
+    if page is None:
+        return jsonify({"error": "Unknown lobby"}), 404
+    return jsonify(page)
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint. Each worker process reports its own counters."""
+    connected = 0
+    for code in LOBBIES.codes():
+        lobby = LOBBIES.get(code)
+        if lobby is not None:
+            connected += sum(1 for u in lobby['participants'].values() if u.get('sid') is not None)
+    ACTIVE_PARTICIPANTS.set(connected)
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
+@app.route('/debug')
+def api_debug():
+    return render_template('api_debug.html')
+
+
+@app.route('/photo/<photo_id>')
+@app.route('/photo/<photo_id>/<variant>')
+def photo(photo_id, variant=DEFAULT_VARIANT):
+    """
+    Serves a place photo from the local photo cache, fetching it from Places on
+    the first request. Variants are sizes cut from the same fetch.
+    """
+    if variant not in PHOTO_VARIANTS or len(photo_id) != 32 or not all(c in '0123456789abcdef' for c in photo_id):
+        return jsonify({"error": "Unknown photo"}), 404
+
+    try:
+        path = cached_photo(photo_id, variant)
+    except ProviderUnavailable as e:
+        log.warning("Photo fetch refused: %s", e)
+        response = jsonify({"error": "Photos are busy, try again shortly"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except (requests.RequestException, OSError) as e:
+        log.warning("Photo fetch failed for %s: %s", photo_id, e)
+        return jsonify({"error": "Photo fetch failed"}), 502
+    if path is None:
+        return jsonify({"error": "Unknown photo"}), 404
+
+    response = send_file(path, mimetype='image/jpeg', conditional=True, etag=f"{photo_id}-{variant}", max_age=PHOTO_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={PHOTO_MAX_AGE}, immutable'
+    return response
+
+
+@app.route('/tts', methods=['POST'])
+def text_to_speech():
+    """
+    Registers a text for speech synthesis and returns the URL to play it from.
+    The URL is content-addressed, so replays of the same message hit the cache.
+    """
+    data = request.json
+    text = data.get('text', '').strip()
+    if not text:
+        return jsonify({"error": "Missing text"}), 400
+
+    key = AUDIO_CACHE.key(TTS_VOICE_ID, TTS_MODEL_ID, text)
+    cached = AUDIO_CACHE.get(key) is not None
+    if not cached:
+        AUDIO_CACHE.remember_request(key, {'text': text, 'voice_id': TTS_VOICE_ID, 'model_id': TTS_MODEL_ID})
+    return jsonify({"url": url_for('tts_audio', key=key), "cached": cached})
+
+
+def open_tts_stream(url, headers, payload):
+    """Starts a streamed ElevenLabs request; anything but a 200 is raised so the gateway counts it."""
+    upstream = get_session().post(url, headers=headers, json=payload, timeout=timeout_for('elevenlabs'), stream=True)
+    if upstream.status_code != 200:
+        log.error("ElevenLabs returned %s: %s", upstream.status_code, upstream.text)
+        upstream.close()
+        raise requests.HTTPError(f"ElevenLabs returned {upstream.status_code}", response=upstream)
+    return upstream
+
+
+@app.route('/tts/<key>.mp3')
+def tts_audio(key):
+    """
+    Serves synthesized speech. Cache hits are sent from disk with ETag and Range
+    support; misses are relayed from ElevenLabs chunk by chunk while being
+    written into the cache.
+    """
+    if len(key) != 64 or not all(c in '0123456789abcdef' for c in key):
+        return jsonify({"error": "Unknown audio"}), 404
+
+    path = AUDIO_CACHE.get(key)
+    if path is not None:
+        response = send_file(path, mimetype='audio/mpeg', conditional=True, etag=key, max_age=TTS_MAX_AGE)
+        response.headers['Cache-Control'] = f'public, max-age={TTS_MAX_AGE}, immutable'
+        return response
+
+    tts_request = AUDIO_CACHE.load_request(key)
+    if tts_request is None:
+        return jsonify({"error": "Unknown audio"}), 404
+
+    url = f"{ELEVENLABS_BASE_URL}/v1/text-to-speech/{tts_request['voice_id']}"
+    headers = {
+        "Accept": "audio/mpeg",
+        "Content-Type": "application/json",
+        "xi-api-key": ELEVENLABS_API_KEY
+    }
+    payload = {
+        "text": tts_request['text'],
+        "model_id": tts_request['model_id']
+    }
+
+    try:
+        upstream = provider('elevenlabs').call(open_tts_stream, url, headers, payload)
+    except ProviderUnavailable as e:
+        log.warning("TTS unavailable: %s", e)
+        response = jsonify({"error": "TTS is busy, try again shortly"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except requests.RequestException as e:
+        log.warning("TTS request error: %s", e)
+        return jsonify({"error": "TTS request failed"}), 502
+
+    def relay():
+        temp_path = AUDIO_CACHE.temp_path(key)
+        complete = False
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in upstream.iter_content(chunk_size=16384):
+                    if chunk:
+                        f.write(chunk)
+                        yield chunk
+            complete = True
+        finally:
+            upstream.close()
+            if complete:
+                AUDIO_CACHE.commit(key, temp_path)
+            elif os.path.exists(temp_path):
+                # The listener went away or the upstream failed; don't cache a truncated file
+                os.remove(temp_path)
+
+    response = Response(stream_with_context(relay()), mimetype='audio/mpeg')
+    response.headers['Cache-Control'] = 'no-store'
+    return response